@@ -1,2 +1,4 @@
 __version__ = '0.1.0'
 __module_name__ = 'django_mongo_storage'
+
+default_app_config = 'django_mongo_storage.apps.StorageConfig'
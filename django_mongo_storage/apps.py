@@ -3,11 +3,13 @@ from django.apps import AppConfig
 
 class StorageConfig(AppConfig):
 
-    name = 'django-mongo-storage'
+    name = 'django_mongo_storage'
     verbose_name = "Django-Mongo-Storage"
 
     def ready(self):
-        import django_mongo_storage.signals
-
-
+        from django_mongo_storage.registry import registry
+        from django_mongo_storage.signals import connect_signals
 
+        # models and their mongo fields, so views and signals don't inspect models on every request
+        registry.build()
+        connect_signals()
@@ -1,5 +1,4 @@
 import os
-import time
 import logging
 from gridfs.errors import NoFile
 
@@ -7,65 +6,125 @@ from django.utils._os import safe_join
 from django.conf import settings
 from django.db import models
 from django.db.models.fields.files import FieldFile, ImageFieldFile
-from django.core.exceptions import ObjectDoesNotExist
+from django.db.models.signals import post_init, post_save
+
+from django_mongo_storage.utils.deletion import delete_on_commit
 
 logger = logging.getLogger(__name__)
 
 
-class _MongoFieldFile(FieldFile):
+# names of files stored in the database row of the instance, tracked by mongo fields when the instance
+# is loaded or saved (post_init, post_save), so replaced file is known without a query
+def _track_original_name(field, instance):
+    # deferred fields are not loaded
+    if field.attname in instance.__dict__:
+        value = instance.__dict__[field.attname]
+        instance.__dict__.setdefault('_mongo_original_names', {})[field.attname] = getattr(value, 'name', value)
+
+
+def _get_original_name(field_file):
+    instance = field_file.instance
+    # not saved yet, nothing to replace
+    if instance._state.adding or instance.pk is None:
+        return None
+
+    names = instance.__dict__.get('_mongo_original_names', {})
+    if field_file.field.attname in names:
+        return names[field_file.field.attname]
+    # field was deferred
+    return instance.__class__._default_manager.filter(pk=instance.pk).values_list(
+        field_file.field.attname, flat=True).first()
+
+
+def _replace_original_file(field_file, original_name, saved=False):
+    # content saved again deduplicated to the same file, the reference added by the save is removed
+    resaved = saved and original_name == field_file.name and getattr(field_file.storage, 'deduplicate', False)
+    if original_name and (original_name != field_file.name or resaved):
+        try:
+            delete_on_commit(field_file.storage, original_name, using=field_file.instance._state.db)
+            logger.debug("Scheduled deletion of file:{} from {} model, {} field.".format(
+                original_name,
+                field_file.instance.__class__.__name__,
+                field_file.field.name
+            ))
+        except:
+            pass
+    _track_original_name(field_file.field, field_file.instance)
+
+
+class _MongoFieldFileMixin(object):
     """
-    Class to be used in MongoFileField attr_class attribute.
+    Replacing of files shared by _MongoFieldFile and _MongoImageFieldFile.
+    """
+
+    # in change admin view delete the old file (replace it), after commit so rollback keeps it
+    def save(self, name, content, save=True):
+        original_name = _get_original_name(self)
+        super(_MongoFieldFileMixin, self).save(name, content, save)
+        _replace_original_file(self, original_name, saved=True)
+
+    # set file already stored in the storage (ex. finished resumable upload) as the file of the field
+    def attach(self, oid, save=True):
+        original_name = _get_original_name(self)
+        self.name = oid
+        setattr(self.instance, self.field.attname, self.name)
+        self._committed = True
+        if save:
+            self.instance.save()
+        _replace_original_file(self, original_name)
+
+
+class _MongoFieldMixin(object):
+    """
+    Tracking of original file names shared by MongoFileField and MongoImageField.
     """
 
-    RETRY_LIMIT = 4
+    def contribute_to_class(self, cls, name, **kwargs):
+        super(_MongoFieldMixin, self).contribute_to_class(cls, name, **kwargs)
+        if not cls._meta.abstract:
+            post_init.connect(self.track_original_name, sender=cls)
+            post_save.connect(self.track_original_name, sender=cls)
 
-    # url to be a link to in admin change model view
+    def track_original_name(self, instance, **kwargs):
+        _track_original_name(self, instance)
+
+    # when changing or clearing field in admin site, replaced file is deleted after commit by save
+    # of the new one (see _MongoFieldFileMixin.save), cleared one after commit here
+    def save_form_data(self, instance, data):
+        file = getattr(instance, self.attname)
+        original_name = _get_original_name(file) if data is False else None
+        super(_MongoFieldMixin, self).save_form_data(instance, data)
+        if original_name:
+            delete_on_commit(file.storage, original_name, using=instance._state.db)
+            # released, so it isn't deleted again when the instance is saved
+            _track_original_name(self, instance)
+
+
+class _MongoFieldFile(_MongoFieldFileMixin, FieldFile):
+    """
+    Class to be used in MongoFileField attr_class attribute.
+    """
+
+    # url to be a link to in admin change model view (built without querying mongo)
     @property
     def url(self):
         self._require_file()
-        for i in range(self.RETRY_LIMIT - 1):
-            try:
-                url = self.storage.url(self.name, self.instance._meta.app_label,
-                                       self.instance.__class__.__name__.lower(), self.instance.pk)
-                return url
-            except NoFile as e:
-                time.sleep(0.5)
-
-        # last call if file not found should raise an error
         return self.storage.url(self.name, self.instance._meta.app_label,
                                 self.instance.__class__.__name__.lower(), self.instance.pk)
 
     # name that is shown in admin change model view
     def __html__(self):
-        for i in range(self.RETRY_LIMIT):
-            try:
-                html = self.storage.get_file_name(self.name)
-                return html
-            except NoFile as e:
-                time.sleep(0.5)
+        # metadata attached by prefetch_mongo_files (None if file is missing), valid if name didn't change since
+        if getattr(self, '_mongo_metadata_name', None) == self.name:
+            metadata = self._mongo_metadata
+            return metadata['filename'] if metadata else ""
 
-        # if file not found return empty string
-        return ""
-
-    # in change admin view delete the old file (replace it)
-    def save(self, name, content, save=True):
+        # just written files are read from primary by storage, so missing file is really gone
         try:
-            obj = self.instance.__class__.objects.get(pk=self.instance.pk)
-            # the model already exists so we have to replace desired file inside it
-            obj_field_file = getattr(obj, self.field.name)
-            try:
-                obj_field_file.storage.delete(obj_field_file.name)
-                logger.debug("Deleted file:{} from {} model, {} field.".format(
-                    obj_field_file.name,
-                    self.instance.__class__.__name__,
-                    self.field.name
-                ))
-            except:
-                pass
-        except ObjectDoesNotExist:
-            # if the file did not exist before, that's totally fine, just proceed
-            pass
-        super(_MongoFieldFile, self).save(name, content, save)
+            return self.storage.get_file_name(self.name)
+        except NoFile:
+            # if file not found return empty string
+            return ""
 
     # method saving the file from mongo to media dir in local filesystem
     def save_to_media(self):
@@ -91,61 +150,32 @@ class _MongoFieldFile(FieldFile):
         return location
 
 
-class _MongoImageFieldFile(ImageFieldFile):
+class _MongoImageFieldFile(_MongoFieldFileMixin, ImageFieldFile):
     """
     Class to be used in MongoImageField attr_class attribute.
     Identical to _MongoFieldFile, just other parent.
     """
 
-    RETRY_LIMIT = 4
-
-    # url to be a link to in admin change model view
+    # url to be a link to in admin change model view (built without querying mongo)
     @property
     def url(self):
         self._require_file()
-        for i in range(self.RETRY_LIMIT - 1):
-            try:
-                url = self.storage.url(self.name, self.instance._meta.app_label,
-                                       self.instance.__class__.__name__.lower(), self.instance.pk)
-                return url
-            except NoFile as e:
-                time.sleep(0.5)
-
-        # last call if file not found should raise an error
         return self.storage.url(self.name, self.instance._meta.app_label,
                                 self.instance.__class__.__name__.lower(), self.instance.pk)
 
     # name that is shown in admin change model view
     def __html__(self):
-        for i in range(self.RETRY_LIMIT):
-            try:
-                html = self.storage.get_file_name(self.name)
-                return html
-            except NoFile as e:
-                time.sleep(0.5)
-
-        # if file not found return empty string
-        return ""
+        # metadata attached by prefetch_mongo_files (None if file is missing), valid if name didn't change since
+        if getattr(self, '_mongo_metadata_name', None) == self.name:
+            metadata = self._mongo_metadata
+            return metadata['filename'] if metadata else ""
 
-    # in change admin view delete the old file (replace it)
-    def save(self, name, content, save=True):
+        # just written files are read from primary by storage, so missing file is really gone
         try:
-            obj = self.instance.__class__.objects.get(pk=self.instance.pk)
-            # the model already exists so we have to replace desired file inside it
-            obj_field_file = getattr(obj, self.field.name)
-            try:
-                obj_field_file.storage.delete(obj_field_file.name)
-                logger.debug("Deleted file:{} from {} model, {} field.".format(
-                    obj_field_file.name,
-                    self.instance.__class__.__name__,
-                    self.field.name
-                ))
-            except:
-                pass
-        except ObjectDoesNotExist:
-            # if the file did not exist before, that's totally fine, just proceed
-            pass
-        super(_MongoImageFieldFile, self).save(name, content, save)
+            return self.storage.get_file_name(self.name)
+        except NoFile:
+            # if file not found return empty string
+            return ""
 
     # method saving the file from mongo to media dir in local filesystem
     def save_to_media(self):
@@ -171,28 +201,44 @@ class _MongoImageFieldFile(ImageFieldFile):
 
         return location
 
+    # ObjectID of derivative of the image (ex. thumbnail), generated on first request
+    def derivative(self, name):
+        self._require_file()
+        return self.storage.get_derivative(self.name, name, self._get_derivative_spec(name))
 
-class MongoFileField(models.FileField):
-    attr_class = _MongoFieldFile
+    # url of derivative, it is generated by view_file when requested for the first time
+    def derivative_url(self, name):
+        self._get_derivative_spec(name)
+        return '{}?derivative={}'.format(self.url, name)
 
-    # when changing or clearing field in admin site
-    def save_form_data(self, instance, data):
-        if data is not None:
-            file = getattr(instance, self.attname)
-            if file != data:
-                file.delete(save=False)
+    def _get_derivative_spec(self, name):
+        try:
+            return self.field.derivatives[name]
+        except KeyError:
+            raise ValueError("Field {} has no derivative {}".format(self.field.name, name))
 
-        super(MongoFileField, self).save_form_data(instance, data)
 
+class MongoFileField(_MongoFieldMixin, models.FileField):
+    attr_class = _MongoFieldFile
 
-class MongoImageField(models.ImageField):
+
+class MongoImageField(_MongoFieldMixin, models.ImageField):
+    """
+    ImageField stored in MongoStorage, with optional derivatives (thumbnails) of the image, ex.:
+        photo = MongoImageField(storage=..., derivatives={
+            'thumbnail': {'size': (200, 200), 'crop': True, 'format': 'JPEG', 'quality': 80},
+        })
+        obj.photo.derivative_url('thumbnail')
+    See django_mongo_storage.utils.derivatives.render_derivative for options of derivatives.
+    """
     attr_class = _MongoImageFieldFile
 
-    # when changing or clearing field in admin site ex. checked the clear checkbox in image field
-    def save_form_data(self, instance, data):
-        if data is not None:
-            file = getattr(instance, self.attname)
-            if file != data:
-                file.delete(save=False)
+    def __init__(self, *args, derivatives=None, **kwargs):
+        self.derivatives = derivatives or {}
+        super(MongoImageField, self).__init__(*args, **kwargs)
 
-        super(MongoImageField, self).save_form_data(instance, data)
+    def deconstruct(self):
+        name, path, args, kwargs = super(MongoImageField, self).deconstruct()
+        if self.derivatives:
+            kwargs['derivatives'] = self.derivatives
+        return name, path, args, kwargs
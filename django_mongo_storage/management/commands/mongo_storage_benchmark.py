@@ -0,0 +1,307 @@
+import json
+import math
+import os
+import platform
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+
+import django
+import mongoengine
+import pymongo
+
+from bson import ObjectId
+
+from django.core.files.base import ContentFile
+from django.core.management.base import BaseCommand, CommandError
+from django.test import RequestFactory
+
+from django_mongo_storage import __version__
+from django_mongo_storage.utils.instrumentation import storage_operation
+from django_mongo_storage.utils.storage import MongoStorage
+from django_mongo_storage.views import _file_response
+
+try:
+    import mongomock
+    import mongomock.gridfs
+except ImportError:
+    mongomock = None
+
+
+# db alias of in-process stand-in of mongod (--mongomock)
+MONGOMOCK_ALIAS = 'mongo_storage_benchmark'
+
+UNITS = {'k': 1024, 'm': 1024 ** 2, 'g': 1024 ** 3}
+
+# main metric of each benchmark and if higher value is better, compared by --compare
+METRICS = {
+    'upload': ('mb_per_s', True),
+    'download': ('mb_per_s', True),
+    'view_file': ('p99_ms', False),
+    'metadata': ('round_trips_per_file', False),
+    'delete': ('files_per_s', True),
+}
+
+# change of the main metric in percent reported as regression
+REGRESSION_THRESHOLD = 5
+
+
+def parse_size(value):
+    """
+        Parse size in bytes with optional unit, ex. '64k', '16m'.
+    """
+    value = value.strip().lower()
+    try:
+        if value and value[-1] in UNITS:
+            return int(float(value[:-1]) * UNITS[value[-1]])
+        return int(value)
+    except ValueError:
+        raise CommandError('Invalid size {}'.format(value))
+
+
+def _parse_list(value, parse=int):
+    try:
+        return [parse(item) for item in value.split(',') if item.strip()]
+    except ValueError:
+        raise CommandError('Invalid list {}'.format(value))
+
+
+def percentile(values, percent):
+    """
+        Nearest-rank percentile of values.
+    """
+    values = sorted(values)
+    if not values:
+        return None
+    index = max(int(math.ceil(percent / 100.0 * len(values))) - 1, 0)
+    return values[min(index, len(values) - 1)]
+
+
+def _result_key(result):
+    return tuple((key, result[key]) for key in ('benchmark', 'size', 'concurrency', 'files') if key in result)
+
+
+class Command(BaseCommand):
+    help = ("Benchmark MongoStorage: upload/download throughput (MB/s) for file sizes and concurrency levels, "
+            "latency of view_file (p50/p99), round trips of metadata calls and speed of bulk delete. "
+            "Files are written to a temporary collection removed afterwards, results are written as JSON.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--db-alias', default=mongoengine.DEFAULT_CONNECTION_NAME,
+                            help="mongoengine db alias of the database to run benchmarks in.")
+        parser.add_argument('--mongomock', action='store_true', default=False,
+                            help="Run against in-process stand-in of mongod (requires mongomock), "
+                                 "round trips are not counted.")
+        parser.add_argument('--sizes', default='1k,64k,1m,16m',
+                            help="Comma separated sizes of files, ex. 1k,64k,1m.")
+        parser.add_argument('--concurrency', default='1,8',
+                            help="Comma separated numbers of threads.")
+        parser.add_argument('--files', type=int, default=20,
+                            help="Number of files uploaded and downloaded per size and concurrency level.")
+        parser.add_argument('--requests', type=int, default=200,
+                            help="Number of view_file requests per size and concurrency level.")
+        parser.add_argument('--delete-counts', default='100,1000',
+                            help="Comma separated numbers of files deleted at once.")
+        parser.add_argument('--output', default='-',
+                            help="File to write results to (default: stdout).")
+        parser.add_argument('--compare', default=None,
+                            help="Results of previous run (JSON file) to compare with.")
+
+    def handle(self, *args, **options):
+        db_alias = self._get_db_alias(options)
+        sizes = _parse_list(options['sizes'], parse_size)
+        concurrency = _parse_list(options['concurrency'])
+        self.files = max(options['files'], 1)
+        self.requests = max(options['requests'], 1)
+        self.verbosity = options['verbosity']
+
+        self.storage = MongoStorage(db_alias, 'benchmark_{}'.format(ObjectId()))
+        self.operations = []
+        storage_operation.connect(self._receive_operation)
+        try:
+            results = []
+            for size in sizes:
+                content = os.urandom(size)
+                for threads in concurrency:
+                    oids, upload = self._upload(content, threads)
+                    results += [upload, self._download(oids, size, threads), self._view_file(oids, size, threads)]
+            results.append(self._metadata())
+            for count in _parse_list(options['delete_counts']):
+                results.append(self._delete(count))
+        finally:
+            storage_operation.disconnect(self._receive_operation)
+            self.storage.primary_db.drop_collection('{}.files'.format(self.storage.collection))
+            self.storage.primary_db.drop_collection('{}.chunks'.format(self.storage.collection))
+
+        report = {
+            'version': __version__,
+            'created': datetime.now(timezone.utc).isoformat(),
+            'environment': self._get_environment(),
+            'storage': {name: getattr(self.storage, name) for name in (
+                'chunk_size', 'write_batch_size', 'overlap_writes', 'read_ahead', 'deduplicate', 'compress',
+                'local_cache_dir', 'metadata_cache_size', 'read_preference', 'inline_threshold')},
+            'results': results,
+        }
+        self._write(report, options['output'])
+        if options['compare']:
+            self._compare(report, options['compare'], options['output'])
+
+    def _get_db_alias(self, options):
+        if not options['mongomock']:
+            return options['db_alias']
+        if mongomock is None:
+            raise CommandError('--mongomock requires mongomock package.')
+        # GridFS of pymongo accepts mongomock collections only then
+        mongomock.gridfs.enable_gridfs_integration()
+        mongoengine.register_connection(MONGOMOCK_ALIAS, 'benchmark', mongo_client_class=mongomock.MongoClient)
+        return MONGOMOCK_ALIAS
+
+    def _get_environment(self):
+        client = self.storage.primary_db.client
+        return {
+            'python': platform.python_version(),
+            'django': django.get_version(),
+            'pymongo': pymongo.version,
+            'mongodb': client.server_info().get('version'),
+            'client': '{}.{}'.format(client.__class__.__module__, client.__class__.__name__),
+            'platform': platform.platform(),
+            'cpus': os.cpu_count(),
+        }
+
+    def _receive_operation(self, sender, storage, operation, **kwargs):
+        if storage is self.storage and not operation.nested:
+            self.operations.append(operation)
+
+    def _log(self, result):
+        if self.verbosity > 1:
+            self.stderr.write(json.dumps(result, sort_keys=True))
+
+    # run function for every item in threads, returns (wall time, latencies of calls in seconds, results)
+    def _run(self, function, items, threads):
+        def timed(item):
+            start = time.perf_counter()
+            result = function(item)
+            return time.perf_counter() - start, result
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            timings = list(executor.map(timed, items))
+        elapsed = time.perf_counter() - start
+        return elapsed, [latency for latency, _ in timings], [result for _, result in timings]
+
+    def _throughput(self, benchmark, size, threads, elapsed, latencies, **extra):
+        result = dict(extra, benchmark=benchmark, size=size, concurrency=threads, files=len(latencies),
+                      mb_per_s=round(size * len(latencies) / elapsed / 1024 ** 2, 3),
+                      files_per_s=round(len(latencies) / elapsed, 1),
+                      p50_ms=round(percentile(latencies, 50) * 1000, 3),
+                      p99_ms=round(percentile(latencies, 99) * 1000, 3))
+        self._log(result)
+        return result
+
+    def _upload(self, content, threads):
+        def save(_):
+            return self.storage.save('benchmark.bin', ContentFile(content))
+
+        elapsed, latencies, oids = self._run(save, range(self.files), threads)
+        return oids, self._throughput('upload', len(content), threads, elapsed, latencies)
+
+    def _download(self, oids, size, threads):
+        def read(oid):
+            mongo_file = self.storage.open(oid)
+            try:
+                while mongo_file.read(self.storage.chunk_size * 16):
+                    pass
+            finally:
+                mongo_file.close()
+
+        elapsed, latencies, _ = self._run(read, oids, threads)
+        return self._throughput('download', size, threads, elapsed, latencies)
+
+    def _view_file(self, oids, size, threads):
+        # view_file without login and lookup of model instance (one SQL query)
+        factory = RequestFactory()
+
+        def serve(index):
+            oid = oids[index % len(oids)]
+            response = _file_response(factory.get('/'), self.storage, self.storage.get_file(oid))
+            try:
+                for _ in response:
+                    pass
+            finally:
+                response.close()
+
+        elapsed, latencies, _ = self._run(serve, range(self.requests), threads)
+        return self._throughput('view_file', size, threads, elapsed, latencies,
+                                requests_per_s=round(self.requests / elapsed, 1))
+
+    def _round_trips(self, function, *args):
+        self.operations = []
+        start = time.perf_counter()
+        function(*args)
+        return time.perf_counter() - start, sum(operation.round_trips for operation in self.operations)
+
+    def _metadata(self):
+        oids = [self.storage.save('benchmark.bin', ContentFile(b'x')) for _ in range(self.files)]
+
+        self.storage._metadata_cache.clear()
+        cold_time, cold = self._round_trips(lambda: [self.storage.get_metadata(oid) for oid in oids])
+        warm_time, warm = self._round_trips(lambda: [self.storage.get_metadata(oid) for oid in oids])
+        self.storage._metadata_cache.clear()
+        prefetch_time, prefetch = self._round_trips(self.storage.prefetch_metadata, oids)
+        self.storage.delete_many(oids)
+
+        result = {
+            'benchmark': 'metadata', 'files': len(oids),
+            'round_trips_per_file': round(cold / len(oids), 3),
+            'cached_round_trips_per_file': round(warm / len(oids), 3),
+            'prefetch_round_trips': prefetch,
+            'ms_per_file': round(cold_time / len(oids) * 1000, 3),
+            'cached_ms_per_file': round(warm_time / len(oids) * 1000, 3),
+            'prefetch_ms': round(prefetch_time * 1000, 3),
+        }
+        self._log(result)
+        return result
+
+    def _delete(self, count):
+        oids = [self.storage.save('benchmark.bin', ContentFile(b'x' * 1024)) for _ in range(count)]
+        elapsed, round_trips = self._round_trips(self.storage.delete_many, oids)
+        result = {
+            'benchmark': 'delete', 'files': count, 'files_per_s': round(count / elapsed, 1),
+            'ms': round(elapsed * 1000, 3), 'round_trips': round_trips,
+        }
+        self._log(result)
+        return result
+
+    def _write(self, report, output):
+        data = json.dumps(report, indent=2, sort_keys=True)
+        if output == '-':
+            self.stdout.write(data)
+        else:
+            with open(output, 'w') as file:
+                file.write(data + '\n')
+
+    def _compare(self, report, path, output):
+        """
+            Print change of the main metric of every benchmark found in both reports.
+        """
+        try:
+            with open(path) as file:
+                previous = {_result_key(result): result for result in json.load(file)['results']}
+        except (OSError, ValueError, KeyError) as e:
+            raise CommandError("Can't read results to compare {}: {}".format(path, e))
+
+        # results are on stdout, comparison goes to stderr then
+        stream = self.stderr if output == '-' else self.stdout
+        for result in report['results']:
+            before = previous.get(_result_key(result))
+            metric, higher_is_better = METRICS[result['benchmark']]
+            if before is None or not before.get(metric):
+                continue
+            change = (result[metric] - before[metric]) / before[metric] * 100
+            regression = change < 0 if higher_is_better else change > 0
+            flag = ' REGRESSION' if regression and abs(change) > REGRESSION_THRESHOLD else ''
+            stream.write("{} {}: {} -> {} ({:+.1f}%){}".format(
+                ' '.join('{}={}'.format(key, value) for key, value in _result_key(result)),
+                metric, before[metric], result[metric], change, flag
+            ))
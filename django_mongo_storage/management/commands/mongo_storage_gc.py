@@ -0,0 +1,231 @@
+import heapq
+import time
+
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+
+from bson import ObjectId
+from bson.errors import InvalidId
+
+from django.core.management.base import BaseCommand, CommandError
+
+from django_mongo_storage.registry import registry
+
+PHASES = ('files', 'chunks')
+
+
+def _is_old(oid, cutoff):
+    # ObjectID is created when upload starts, so files being uploaded are never old
+    return isinstance(oid, ObjectId) and oid.generation_time < cutoff
+
+
+class Command(BaseCommand):
+    help = ("Delete GridFS files not referenced by any mongo field of any model (orphans) "
+            "and chunks without files. Runs in bounded memory: referenced oids are streamed "
+            "from the database sorted and merged with fs.files cursor sorted by _id.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true', default=False,
+                            help="Only report orphans, don't delete anything.")
+        parser.add_argument('--batch-size', type=int, default=1000,
+                            help="Number of files checked and deleted at once.")
+        parser.add_argument('--rate', type=float, default=0,
+                            help="Max number of files deleted per second (0 - no limit).")
+        parser.add_argument('--grace-hours', type=float, default=24,
+                            help="Files younger than that are kept (uploaded, but model not saved yet).")
+        parser.add_argument('--collection', action='append', default=[],
+                            help="Only given collection, as db_alias/collection (can be repeated).")
+        parser.add_argument('--resume-after', default=None,
+                            help="Resume token printed by previous run (db_alias/collection/phase/oid).")
+
+    def handle(self, *args, **options):
+        self.dry_run = options['dry_run']
+        self.batch_size = max(options['batch_size'], 1)
+        self.rate = options['rate']
+        self.verbosity = options['verbosity']
+        self.cutoff = datetime.now(timezone.utc) - timedelta(hours=options['grace_hours'])
+
+        resume = self._parse_resume_token(options['resume_after'])
+        collections = registry.get_collections()
+        selected = set(tuple(name.split('/', 1)) for name in options['collection'])
+
+        for key in sorted(collections):
+            if selected and key not in selected:
+                continue
+            if resume and key < resume[0]:
+                continue
+            storage, fields = collections[key]
+
+            for phase in PHASES:
+                after = None
+                if resume and key == resume[0]:
+                    if PHASES.index(phase) < PHASES.index(resume[1]):
+                        continue
+                    if phase == resume[1]:
+                        after = resume[2]
+
+                if phase == 'files':
+                    deleted = self._collect_files(storage, fields, after)
+                else:
+                    deleted = self._collect_chunks(storage, after)
+                self.stdout.write("{}/{}: {} {} {}.".format(
+                    storage.db_alias, storage.collection, 'found' if self.dry_run else 'deleted', deleted,
+                    'orphaned files' if phase == 'files' else 'files of orphaned chunks'
+                ))
+
+    def _parse_resume_token(self, token):
+        if not token:
+            return None
+        try:
+            db_alias, collection, phase, oid = token.rsplit('/', 3)
+            if phase not in PHASES:
+                raise ValueError(phase)
+            return (db_alias, collection), phase, ObjectId(oid)
+        except (ValueError, InvalidId):
+            raise CommandError("Invalid resume token {}".format(token))
+
+    def _progress(self, storage, phase, oid):
+        if self.verbosity > 1:
+            self.stdout.write("Resume token: {}/{}/{}/{}".format(storage.db_alias, storage.collection, phase, oid))
+
+    def _throttle(self, deleted):
+        if self.rate and deleted and not self.dry_run:
+            time.sleep(deleted / self.rate)
+
+    # oids stored in the fields, sorted (merge of sorted streams of all fields of the collection)
+    def _iter_referenced(self, fields, after=None):
+        iterators = []
+        for model, field in fields:
+            queryset = model._base_manager.exclude(**{field.attname: ''}).exclude(**{field.attname + '__isnull': True})
+            if after is not None:
+                queryset = queryset.filter(**{field.attname + '__gt': str(after)})
+            queryset = queryset.order_by(field.attname).values_list(field.attname, flat=True)
+            iterators.append(queryset.iterator())
+        return heapq.merge(*iterators)
+
+    def _count_references(self, fields, oids):
+        counts = Counter()
+        for model, field in fields:
+            counts.update(model._base_manager.filter(**{field.attname + '__in': oids})
+                          .values_list(field.attname, flat=True))
+        return counts
+
+    def _collect_files(self, storage, fields, after=None):
+        files = storage.primary_files_collection
+        query = {'_id': {'$gt': after}} if after is not None else {}
+        cursor = files.find(query, {'source_id': 1, 'refcount': 1}, no_cursor_timeout=True).sort('_id', 1)
+        cursor.batch_size(self.batch_size)
+
+        referenced = self._iter_referenced(fields, after)
+        current = next(referenced, None)
+
+        deleted = 0
+        # refcount of deduplicated files as read by the cursor (None for other files)
+        candidates = {}
+        derivatives = {}
+        try:
+            for document in cursor:
+                oid = str(document['_id'])
+                while current is not None and current < oid:
+                    current = next(referenced, None)
+                if current == oid or not _is_old(document['_id'], self.cutoff):
+                    continue
+
+                # derivatives are orphans if their source file doesn't exist
+                if 'source_id' in document:
+                    derivatives[oid] = document['source_id']
+                else:
+                    candidates[oid] = document.get('refcount')
+
+                if len(candidates) + len(derivatives) >= self.batch_size:
+                    deleted += self._delete_files(storage, fields, candidates, derivatives)
+                    self._progress(storage, 'files', oid)
+                    candidates, derivatives = {}, {}
+
+            deleted += self._delete_files(storage, fields, candidates, derivatives)
+        finally:
+            cursor.close()
+        return deleted
+
+    def _delete_files(self, storage, fields, candidates, derivatives):
+        if derivatives:
+            sources = storage.primary_files_collection.find({'_id': {'$in': list(set(derivatives.values()))}},
+                                                            {'_id': 1})
+            existing = set(document['_id'] for document in sources)
+            candidates = dict(candidates)
+            candidates.update((oid, None) for oid, source_id in derivatives.items() if source_id not in existing)
+        if not candidates:
+            return 0
+
+        # rows saved since the rows were streamed
+        references = self._count_references(fields, list(candidates))
+        orphans = [oid for oid in candidates if oid not in references]
+        if not self.dry_run:
+            orphans = self._delete_unchanged(storage, orphans, candidates)
+        for oid in orphans:
+            if self.verbosity > 2:
+                self.stdout.write("Orphaned file {}/{}/{}".format(storage.db_alias, storage.collection, oid))
+        self._throttle(len(orphans))
+        return len(orphans)
+
+    def _delete_unchanged(self, storage, orphans, refcounts):
+        """
+            Delete files documents of orphans, deduplicated files are deleted only if their refcount
+            is the same as read by the cursor (not referenced by an upload since), then their chunks.
+        :return: list of deleted orphans
+        """
+        files = storage.primary_files_collection
+        groups = {}
+        for oid in orphans:
+            groups.setdefault(refcounts[oid], []).append(ObjectId(oid))
+        for refcount, oids in groups.items():
+            files.delete_many({'_id': {'$in': oids},
+                               'refcount': {'$exists': False} if refcount is None else refcount})
+
+        kept = files.find({'_id': {'$in': [ObjectId(oid) for oid in orphans]}}, {'_id': 1})
+        kept = set(str(document['_id']) for document in kept)
+        orphans = [oid for oid in orphans if oid not in kept]
+        # chunks, derivatives and cached metadata of deleted files
+        storage.delete_many(orphans, ignore_references=True)
+        return orphans
+
+    def _collect_chunks(self, storage, after=None):
+        chunks = storage.primary_db['{}.chunks'.format(storage.collection)]
+        query = {'files_id': {'$gt': after}} if after is not None else {}
+        # covered by files_id_1_n_1 index, files_id of the same file are consecutive
+        cursor = chunks.find(query, {'files_id': 1, '_id': 0}, no_cursor_timeout=True).sort('files_id', 1)
+        cursor.batch_size(self.batch_size)
+
+        deleted = 0
+        batch = []
+        try:
+            for chunk in cursor:
+                files_id = chunk['files_id']
+                if batch and batch[-1] == files_id:
+                    continue
+                batch.append(files_id)
+                if len(batch) >= self.batch_size:
+                    deleted += self._delete_chunks(storage, batch)
+                    self._progress(storage, 'chunks', files_id)
+                    batch = []
+            deleted += self._delete_chunks(storage, batch)
+        finally:
+            cursor.close()
+        return deleted
+
+    def _delete_chunks(self, storage, files_ids):
+        files_ids = [files_id for files_id in files_ids if _is_old(files_id, self.cutoff)]
+        if not files_ids:
+            return 0
+
+        # chunks of unfinished resumable uploads (checked before files, finish() writes the file first)
+        uploads = storage.primary_db['{}.uploads'.format(storage.collection)].find({'_id': {'$in': files_ids}},
+                                                                                   {'_id': 1})
+        existing = set(document['_id'] for document in uploads)
+        files = storage.primary_files_collection.find({'_id': {'$in': files_ids}}, {'_id': 1})
+        existing.update(document['_id'] for document in files)
+        orphans = [files_id for files_id in files_ids if files_id not in existing]
+        if orphans and not self.dry_run:
+            storage.primary_db['{}.chunks'.format(storage.collection)].delete_many({'files_id': {'$in': orphans}})
+        self._throttle(len(orphans))
+        return len(orphans)
@@ -0,0 +1,154 @@
+from django.db import models
+
+from django_mongo_storage.fields import MongoFileField, MongoImageField
+
+
+def _get_mongo_fields(model, field_names=None):
+    fields = [field for field in model._meta.get_fields() if isinstance(field, (MongoFileField, MongoImageField))]
+    if field_names:
+        fields = [field for field in fields if field.name in field_names]
+    return fields
+
+
+def prefetch_mongo_files(instances, *field_names):
+    """
+        Fetch metadata (fs.files documents) of files in mongo fields of many model instances,
+        with one query per mongo collection, and attach it to the field files.
+        Use case:
+            objects = list(TestModel.objects.all()[:100])
+            prefetch_mongo_files(objects)  # or prefetch_mongo_files(objects, 'file')
+            objects[0].file.__html__()  # no query to mongo
+
+    :param instances: list of model instances of the same model
+    :param field_names: names of mongo fields to prefetch, all mongo fields if empty
+    :return: instances
+    """
+    if not instances:
+        return instances
+
+    # group field files by collection, so each collection is queried once
+    groups = {}
+    for field in _get_mongo_fields(instances[0].__class__, field_names):
+        for instance in instances:
+            field_file = getattr(instance, field.name)
+            if not field_file:
+                continue
+            key = (field_file.storage.db_alias, field_file.storage.collection)
+            storage, field_files = groups.setdefault(key, (field_file.storage, []))
+            field_files.append(field_file)
+
+    for storage, field_files in groups.values():
+        documents = storage.prefetch_metadata(field_file.name for field_file in field_files)
+        for field_file in field_files:
+            field_file._mongo_metadata = documents.get(field_file.name)
+            field_file._mongo_metadata_name = field_file.name
+
+    return instances
+
+
+def generate_derivatives(instances, field_name, *names):
+    """
+        Generate missing derivatives (thumbnails) of images of many model instances in parallel,
+        existing ones are looked up with one query per collection. Afterwards derivative() and
+        derivative_url() of the field files don't wait for generation.
+        Use case:
+            objects = list(TestModel.objects.all()[:50])
+            generate_derivatives(objects, 'photo', 'thumbnail')
+
+    :param instances: list of model instances of the same model
+    :param field_name: name of MongoImageField with derivatives
+    :param names: names of derivatives, all derivatives of the field if empty
+    :return: instances
+    """
+    if not instances:
+        return instances
+
+    field = instances[0]._meta.get_field(field_name)
+    names = names or list(field.derivatives)
+
+    groups = {}
+    for instance in instances:
+        field_file = getattr(instance, field.name)
+        if not field_file:
+            continue
+        key = (field_file.storage.db_alias, field_file.storage.collection)
+        storage, oids = groups.setdefault(key, (field_file.storage, []))
+        oids.append(field_file.name)
+
+    for storage, oids in groups.values():
+        for name in names:
+            storage.generate_derivatives(oids, name, field.derivatives[name])
+
+    return instances
+
+
+def save_mongo_files(instances, field_name, contents):
+    """
+        Save files of mongo field of many model instances with a few queries (storage.save_many),
+        names of the files are set on the instances, which are not saved, so they can be created
+        with bulk_create. Files of rows which aren't created end up as orphans (see mongo_storage_gc).
+        Use case:
+            objects = [TestModel(title=title) for title, _ in uploads]
+            save_mongo_files(objects, 'file', [(upload.name, upload) for _, upload in uploads])
+            TestModel.objects.bulk_create(objects)
+
+    :param instances: list of model instances of the same model (new, replaced files of saved ones are kept)
+    :param field_name: name of mongo field
+    :param contents: list of (name, content) pairs, one per instance, content as in FieldFile.save()
+    :return: instances
+    """
+    if len(instances) != len(contents):
+        raise ValueError('Number of contents ({}) differs from number of instances ({}).'.format(
+            len(contents), len(instances)))
+    if not instances:
+        return instances
+
+    field = instances[0]._meta.get_field(field_name)
+    names = [field.generate_filename(instance, name) for instance, (name, _) in zip(instances, contents)]
+    oids = field.storage.save_many(zip(names, (content for _, content in contents)))
+
+    for instance, oid in zip(instances, oids):
+        setattr(instance, field.attname, oid)
+        # width_field and height_field of image fields
+        if hasattr(field, 'update_dimension_fields'):
+            field.update_dimension_fields(instance, force=True)
+
+    return instances
+
+
+class MongoFileQuerySet(models.QuerySet):
+    """
+    QuerySet able to prefetch metadata of mongo files, like prefetch_related does for relations.
+    Use case:
+        class TestModel(models.Model):
+            ...
+            objects = MongoFileManager()
+
+        TestModel.objects.prefetch_mongo_files()  # or .prefetch_mongo_files('file1', 'file2')
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(MongoFileQuerySet, self).__init__(*args, **kwargs)
+        self._prefetch_mongo_fields = None
+
+    def prefetch_mongo_files(self, *field_names):
+        clone = self._clone()
+        clone._prefetch_mongo_fields = field_names
+        return clone
+
+    def _clone(self, *args, **kwargs):
+        clone = super(MongoFileQuerySet, self)._clone(*args, **kwargs)
+        clone._prefetch_mongo_fields = self._prefetch_mongo_fields
+        return clone
+
+    def _fetch_all(self):
+        prefetch_done = self._result_cache is not None
+        super(MongoFileQuerySet, self)._fetch_all()
+        if self._prefetch_mongo_fields is not None and not prefetch_done:
+            # values() and values_list() querysets don't return model instances
+            instances = [obj for obj in self._result_cache if isinstance(obj, self.model)]
+            prefetch_mongo_files(instances, *self._prefetch_mongo_fields)
+
+
+class MongoFileManager(models.Manager.from_queryset(MongoFileQuerySet)):
+    pass
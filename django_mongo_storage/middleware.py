@@ -0,0 +1,39 @@
+import logging
+
+from django.conf import settings
+from django.utils.deprecation import MiddlewareMixin
+
+from django_mongo_storage.utils.instrumentation import start_summary, finish_summary
+
+logger = logging.getLogger(__name__)
+
+
+class StorageMetricsMiddleware(MiddlewareMixin):
+    """
+    Summary of MongoStorage operations run while handling the request (request.storage_metrics,
+    see django_mongo_storage.utils.instrumentation.RequestSummary), logged on debug level.
+    If settings.STORAGE_SERVER_TIMING is True the summary is sent in Server-Timing header, ex.:
+        Server-Timing: mongo-storage-open;dur=3.1;desc="1 ops, 2 round trips"
+
+        NOTE: content of streamed files is read after the response is returned, it isn't included.
+    """
+    def process_request(self, request):
+        request.storage_metrics = start_summary()
+
+    def process_response(self, request, response):
+        summary = finish_summary()
+        if not summary:
+            return response
+
+        logger.debug("Storage operations of {} {}: {} round trips, {:.1f} ms, {}".format(
+            request.method, request.path, summary.total('round_trips'), summary.total('duration') * 1000,
+            summary.as_dict()
+        ))
+        if getattr(settings, 'STORAGE_SERVER_TIMING', False):
+            timings = ['mongo-storage-{};dur={:.1f};desc="{} ops, {} round trips"'.format(
+                name, totals['duration'] * 1000, totals['count'], totals['round_trips']
+            ) for name, totals in sorted(summary.operations.items())]
+            if response.has_header('Server-Timing'):
+                timings.insert(0, response['Server-Timing'])
+            response['Server-Timing'] = ', '.join(timings)
+        return response
@@ -0,0 +1,89 @@
+import threading
+
+from django.apps import apps
+from django.db.models import FileField
+
+from django_mongo_storage.utils.storage import MongoStorage
+
+
+class MongoFieldRegistry(object):
+    """
+    Mongo fields (FileField with MongoStorage) of all installed models, built once
+    (at StorageConfig.ready()) instead of inspecting models on every request.
+    Use case:
+        from django_mongo_storage.registry import registry
+
+        model, fields = registry.get_model_fields('app_label', 'model_name')
+        field = registry.get_field('app_label', 'model_name', pk, oid)  # field of the row storing oid
+    """
+    def __init__(self):
+        self._models = None
+        self._lock = threading.Lock()
+
+    def build(self):
+        models = {}
+        for model in apps.get_models():
+            fields = [field for field in model._meta.get_fields()
+                      if isinstance(field, FileField) and isinstance(field.storage, MongoStorage)]
+            if fields:
+                models[(model._meta.app_label, model._meta.model_name)] = (model, fields)
+        self._models = models
+
+    def _ensure_built(self):
+        if self._models is None:
+            with self._lock:
+                if self._models is None:
+                    self.build()
+
+    @property
+    def models(self):
+        """
+            dict {(app_label, model_name): (model, [mongo fields])}
+        """
+        self._ensure_built()
+        return self._models
+
+    def get_model_fields(self, app_label, model_name):
+        """
+        :return: tuple (model, [mongo fields])
+        :raise LookupError: if the model has no mongo fields (or doesn't exist)
+        """
+        try:
+            return self.models[(app_label, model_name.lower())]
+        except KeyError:
+            raise LookupError("Model {}.{} has no mongo fields.".format(app_label, model_name))
+
+    def get_collections(self):
+        """
+            Mongo fields grouped by collection.
+        :return: dict {(db_alias, collection): (storage, [(model, field)])}
+        """
+        collections = {}
+        for model, fields in self.models.values():
+            for field in fields:
+                key = (field.storage.db_alias, field.storage.collection)
+                storage, collection_fields = collections.setdefault(key, (field.storage, []))
+                collection_fields.append((model, field))
+        return collections
+
+    def get_field(self, app_label, model_name, pk, oid):
+        """
+            Find mongo field of model instance storing given file, with one query
+            fetching only columns of mongo fields.
+        :return: field or None if there is no such instance or no field of the instance stores the file
+        """
+        try:
+            model, fields = self.get_model_fields(app_label, model_name)
+        except LookupError:
+            return None
+
+        values = model._default_manager.filter(pk=pk).values(*[field.attname for field in fields]).first()
+        if values is None:
+            return None
+        for field in fields:
+            if values[field.attname] == oid:
+                return field
+        return None
+
+
+registry = MongoFieldRegistry()
@@ -1,29 +1,41 @@
 import logging
 
-from django.db.models import FileField
 from django.db.models.signals import post_delete
-from django.dispatch import receiver
 
-from django_mongo_storage.utils.storage import MongoStorage
+from django_mongo_storage.registry import registry
+from django_mongo_storage.utils.deletion import delete_on_commit
 
 logger = logging.getLogger(__name__)
 
 
-# delete associated files from mongo after model deletion
-# dispatch uid is set for no duplication
-
-@receiver(post_delete, dispatch_uid="post_delete_file_removal")
-def post_delete_receiver(sender, instance, **kwargs):
-    for field in sender._meta.get_fields():
-        if isinstance(field, FileField):
-            if isinstance(field.storage, MongoStorage):
-                field_file = getattr(instance, field.name)
-                try:
-                    field_file.storage.delete(field_file.name)
-                    logger.debug("Deleted file:{} from {} model, {} field.".format(
-                        field_file.name,
-                        sender.__class__.__name__,
-                        field.name
-                    ))
-                except:
-                    pass
+# delete associated files from mongo after model deletion, after commit of the transaction
+# in batches (queryset.delete() of many rows takes a few queries to mongo)
+# connected only to models with mongo fields (see connect_signals)
+
+def post_delete_receiver(sender, instance, using=None, **kwargs):
+    _, fields = registry.get_model_fields(sender._meta.app_label, sender._meta.model_name)
+    for field in fields:
+        field_file = getattr(instance, field.name)
+        if not field_file:
+            continue
+        try:
+            delete_on_commit(field_file.storage, field_file.name, using=using)
+            logger.debug("Scheduled deletion of file:{} from {} model, {} field.".format(
+                field_file.name,
+                sender.__name__,
+                field.name
+            ))
+        except:
+            pass
+
+
+def connect_signals():
+    """
+        Connect post_delete_receiver to models with mongo fields, deletes of other models
+        don't run it at all. Called by StorageConfig.ready().
+    """
+    for model, fields in registry.models.values():
+        # dispatch uid is set for no duplication
+        post_delete.connect(post_delete_receiver, sender=model,
+                            dispatch_uid="post_delete_file_removal_{}.{}".format(
+                                model._meta.app_label, model._meta.model_name))
@@ -1,5 +1,6 @@
+from unittest import mock
+
 from django.db import models
-from mock import mock
 
 from django_mongo_storage.fields import MongoFileField
 from django_mongo_storage.utils.storage import MongoStorage
@@ -0,0 +1,54 @@
+import io
+import json
+import os
+import tempfile
+from unittest import skipIf
+
+from django.core.management import call_command
+from django.test import SimpleTestCase
+
+from django_mongo_storage.management.commands.mongo_storage_benchmark import (Command, parse_size, percentile,
+                                                                         mongomock)
+
+
+class MongoStorageBenchmarkTest(SimpleTestCase):
+
+    def _run(self, *args, db_alias='--db-alias=Test'):
+        stdout, stderr = io.StringIO(), io.StringIO()
+        call_command(Command(), db_alias, '--sizes=1k,300k', '--concurrency=1,2', '--files=2',
+                     '--requests=4', '--delete-counts=5', *args, stdout=stdout, stderr=stderr)
+        return stdout.getvalue(), stderr.getvalue()
+
+    def test_results(self):
+        stdout, _ = self._run()
+        report = json.loads(stdout)
+
+        results = report['results']
+        self.assertEqual([result['benchmark'] for result in results[:3]], ['upload', 'download', 'view_file'])
+        # upload, download and view_file per size and concurrency, metadata and delete
+        self.assertEqual(len(results), 2 * 2 * 3 + 2)
+        self.assertEqual(results[0]['size'], 1024)
+        self.assertGreater(results[0]['mb_per_s'], 0)
+        self.assertEqual(results[-1]['files'], 5)
+        self.assertIn('pymongo', report['environment'])
+
+    @skipIf(mongomock is None, 'mongomock is not installed')
+    def test_mongomock(self):
+        stdout, _ = self._run(db_alias='--mongomock')
+        report = json.loads(stdout)
+        self.assertTrue(report['environment']['client'].startswith('mongomock.'))
+        self.assertGreater(report['results'][0]['mb_per_s'], 0)
+
+    def test_compare(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'results.json')
+            self._run('--output', path)
+            _, stderr = self._run('--compare', path)
+        self.assertIn('benchmark=upload size=1024 concurrency=1 files=2 mb_per_s:', stderr)
+
+    def test_helpers(self):
+        self.assertEqual(parse_size('64k'), 64 * 1024)
+        self.assertEqual(parse_size('1m'), 1024 ** 2)
+        self.assertEqual(parse_size('100'), 100)
+        self.assertEqual(percentile([3, 1, 2, 4], 50), 2)
+        self.assertEqual(percentile(list(range(1, 101)), 99), 99)
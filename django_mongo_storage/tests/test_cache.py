@@ -0,0 +1,44 @@
+import time
+from unittest import mock
+
+from django.test import SimpleTestCase
+from django_mongo_storage.utils.cache import LRUCache
+
+
+class LRUCacheTest(SimpleTestCase):
+
+    def test_get_and_set(self):
+        cache = LRUCache(maxsize=2)
+        cache.set('a', 1)
+        self.assertEqual(cache.get('a'), 1)
+        self.assertIsNone(cache.get('b'))
+        self.assertIn('a', cache)
+
+    def test_least_recently_used_is_evicted(self):
+        cache = LRUCache(maxsize=2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+
+        self.assertNotIn('b', cache)
+        self.assertIn('a', cache)
+        self.assertIn('c', cache)
+
+    def test_expired_entries(self):
+        cache = LRUCache(maxsize=2, ttl=10)
+        cache.set('a', 1)
+        with mock.patch.object(time, 'monotonic', return_value=time.monotonic() + 11):
+            self.assertIsNone(cache.get('a'))
+
+    def test_disabled(self):
+        cache = LRUCache(maxsize=0)
+        cache.set('a', 1)
+        self.assertNotIn('a', cache)
+
+    def test_delete(self):
+        cache = LRUCache()
+        cache.set('a', 1)
+        cache.delete('a')
+        cache.delete('missing')
+        self.assertNotIn('a', cache)
@@ -0,0 +1,47 @@
+import tempfile
+from unittest import mock
+
+from django.test import SimpleTestCase, override_settings
+from pymongo import ReadPreference
+
+from django_mongo_storage.utils import disk_cache as disk_cache_module, executor as executor_module
+from django_mongo_storage.utils.connection import ConnectionRegistry, get_connection_settings
+from django_mongo_storage.utils.disk_cache import get_disk_cache
+from django_mongo_storage.utils.executor import get_executor
+
+
+class ConnectionRegistryTest(SimpleTestCase):
+
+    def setUp(self):
+        self.connections = ConnectionRegistry()
+
+    def test_shared(self):
+        db = self.connections.get_database('Test')
+        self.assertIs(self.connections.get_database('Test'), db)
+        self.assertIs(self.connections.get_gridfs('Test', 'test'), self.connections.get_gridfs('Test', 'test'))
+
+        primary_db = self.connections.get_database('Test', read_preference=ReadPreference.PRIMARY)
+        self.assertIs(primary_db.client, db.client)
+
+    def test_fork(self):
+        client = self.connections.get_client('Test')
+        # clients of the parent are not used in the child process
+        with mock.patch('os.getpid', return_value=-1):
+            self.assertIsNot(self.connections.get_client('Test'), client)
+
+    def test_fork_thread_pools(self):
+        executor, cache = get_executor(), get_disk_cache(tempfile.gettempdir(), 1024)
+        lock = cache._lock
+        # run by os.fork in the child process
+        executor_module._after_fork()
+        disk_cache_module._after_fork()
+        self.assertIsNot(get_executor(), executor)
+        self.assertIsNot(cache._lock, lock)
+        executor.shutdown()
+
+    @override_settings(STORAGE_MAX_POOL_SIZE=20, STORAGE_WAIT_QUEUE_TIMEOUT_MS=1000)
+    def test_pool_settings(self):
+        name, kwargs = get_connection_settings('Test')
+        self.assertEqual(kwargs['maxPoolSize'], 20)
+        self.assertEqual(kwargs['waitQueueTimeoutMS'], 1000)
+        self.assertNotIn('minPoolSize', kwargs)
@@ -0,0 +1,59 @@
+from unittest import mock
+
+from django.db import transaction
+from django.test import TransactionTestCase
+from django_mongo_storage.utils.deletion import delete_on_commit
+
+
+class DeleteOnCommitTest(TransactionTestCase):
+
+    def setUp(self):
+        self.storage = mock.Mock(db_alias='Test', collection='test')
+
+    def test_deleted_in_batch_after_commit(self):
+        with transaction.atomic():
+            delete_on_commit(self.storage, 'a')
+            delete_on_commit(self.storage, 'b')
+            self.storage.delete_many.assert_not_called()
+
+        self.storage.delete_many.assert_called_once_with(['a', 'b'])
+
+    def test_rolled_back_savepoint(self):
+        with transaction.atomic():
+            delete_on_commit(self.storage, 'a')
+            try:
+                with transaction.atomic():
+                    delete_on_commit(self.storage, 'b')
+                    raise ValueError
+            except ValueError:
+                pass
+            delete_on_commit(self.storage, 'c')
+
+        self.storage.delete_many.assert_called_once_with(['a', 'c'])
+
+    def test_rolled_back_transaction(self):
+        with transaction.atomic():
+            delete_on_commit(self.storage, 'a')
+            transaction.set_rollback(True)
+        self.storage.delete_many.assert_not_called()
+
+        with transaction.atomic():
+            delete_on_commit(self.storage, 'b')
+        self.storage.delete_many.assert_called_once_with(['b'])
+
+    def test_no_transaction(self):
+        delete_on_commit(self.storage, 'a')
+        self.storage.delete.assert_called_once_with('a')
+
+    def test_failed_callback(self):
+        # callbacks after the failed one are not run, files added before are deleted with the next batch
+        with self.assertRaises(ValueError):
+            with transaction.atomic():
+                delete_on_commit(self.storage, 'a')
+                transaction.on_commit(mock.Mock(side_effect=ValueError))
+                delete_on_commit(self.storage, 'b')
+        self.storage.delete_many.assert_not_called()
+
+        with transaction.atomic():
+            delete_on_commit(self.storage, 'c')
+        self.storage.delete_many.assert_called_once_with(['a', 'c'])
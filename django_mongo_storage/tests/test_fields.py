@@ -1,10 +1,15 @@
 import os
+from unittest import mock
+
+from bson import ObjectId
+from gridfs.errors import NoFile
 
 from django.core.files import File
 from django.core.files.base import ContentFile
 from django.core.exceptions import ObjectDoesNotExist
-from django.test import TestCase, mock
+from django.test import TestCase
 
+from django_mongo_storage.managers import prefetch_mongo_files, save_mongo_files, generate_derivatives
 from django_mongo_storage.utils.storage import MongoStorage
 from .models import Document
 
@@ -55,6 +60,18 @@ class MongoFileFieldTest(TestCase):
 
         self.assertEqual(d.myfile.__html__(), mongo_storage.get_file_name())
 
+    def test_html_missing_file(self):
+        """
+            MongoFieldFile.__html__() should return empty string at once if file doesn't exist.
+        """
+        mongo_storage = _get_storage_mock()
+        mongo_storage.get_file_name.side_effect = NoFile
+        d = Document(myfile='something.txt')
+        d.myfile.storage = mongo_storage
+
+        self.assertEqual(d.myfile.__html__(), '')
+        mongo_storage.get_file_name.assert_called_once_with('something.txt')
+
     def test_save_with_no_file_before(self):
         """
             Check if first save (no file before) actually saves file.
@@ -72,23 +89,92 @@ class MongoFileFieldTest(TestCase):
 
     def test_save_with_file_exist(self):
         """
-            If file exists before in that field it should be removed.
+            If file exists before in that field it should be removed (after commit), without extra query.
         """
         mongo_storage = _get_storage_mock()
 
-        # make mock that imitates initial file stored in storage
-        initial = Document(myfile='initial.txt')
-        initial.myfile.storage = mongo_storage
+        # instance loaded from the database with initial file
+        d = Document.from_db('default', ['id', 'myfile'], [1, 'initial.txt'])
+        d.myfile.storage = mongo_storage
 
-        Document.objects.get = mock.Mock()
-        Document.objects.get.return_value = initial
+        with mock.patch('django_mongo_storage.fields.delete_on_commit') as delete_on_commit, \
+                self.assertNumQueries(0):
+            d.myfile.save(mongo_storage.get_file_name(), ContentFile('content'), save=False)
 
-        d = Document(myfile='something.txt')
+        delete_on_commit.assert_called_once_with(mongo_storage, 'initial.txt', using='default')
+
+    def test_save_with_deferred_field(self):
+        """
+            Name of the file in deferred field is fetched with the query.
+        """
+        mongo_storage = _get_storage_mock()
+        Document._base_manager.create(pk=1, myfile='initial.txt')
+
+        d = Document._base_manager.defer('myfile').get(pk=1)
         d.myfile.storage = mongo_storage
 
-        d.myfile.save(mongo_storage.get_file_name(), ContentFile('content'), save=False)
+        with mock.patch('django_mongo_storage.fields.delete_on_commit') as delete_on_commit:
+            d.myfile.save(mongo_storage.get_file_name(), ContentFile('content'), save=False)
+
+        delete_on_commit.assert_called_once_with(mongo_storage, 'initial.txt', using='default')
+
+    def test_save_the_same_deduplicated_content(self):
+        """
+            Reference added by saving the same content again is removed, the file is kept.
+        """
+        mongo_storage = MongoStorage('Test', 'test', deduplicate=True)
+        oid = mongo_storage.save('test.txt', ContentFile(b'content'))
+        self.addCleanup(mongo_storage.delete, oid)
+
+        d = Document.from_db('default', ['id', 'myfile'], [1, oid])
+        d.myfile.storage = mongo_storage
+        # transaction of the test is not committed
+        with mock.patch('django_mongo_storage.fields.delete_on_commit',
+                        side_effect=lambda storage, oid, using: storage.delete(oid)):
+            d.myfile.save('test.txt', ContentFile(b'content'), save=False)
+
+        self.assertEqual(d.myfile.name, oid)
+        self.assertEqual(mongo_storage.primary_files_collection.find_one({'_id': ObjectId(oid)})['refcount'], 1)
+
+    def test_replace_in_form_shared_deduplicated_file(self):
+        """
+            File replaced in admin form loses one reference after commit, other rows keep it.
+        """
+        mongo_storage = MongoStorage('Test', 'test', deduplicate=True)
+        field = Document._meta.get_field('myfile')
+        oid = mongo_storage.save('shared.txt', ContentFile(b'shared'))
+        mongo_storage.save('shared.txt', ContentFile(b'shared'))
+        self.addCleanup(mongo_storage.delete_many, [oid, oid])
+
+        with mock.patch.object(field, 'storage', mongo_storage), \
+                mock.patch('django_mongo_storage.fields.delete_on_commit',
+                           side_effect=lambda storage, oid, using: storage.delete(oid)) as delete_on_commit:
+            d = Document._base_manager.create(myfile=oid)
+            Document._base_manager.create(myfile=oid)
+            field.save_form_data(d, ContentFile(b'new', name='new.txt'))
+            d.save()
+            self.addCleanup(mongo_storage.delete, d.myfile.name)
+
+        delete_on_commit.assert_called_once_with(mongo_storage, oid, using='default')
+        self.assertEqual(mongo_storage.primary_files_collection.find_one({'_id': ObjectId(oid)})['refcount'], 1)
+        self.assertEqual(mongo_storage.open(d.myfile.name).read(), b'new')
+
+    def test_clear_in_form(self):
+        """
+            File cleared in admin form is deleted after commit, once.
+        """
+        mongo_storage = _get_storage_mock()
+        field = Document._meta.get_field('myfile')
+        d = Document.from_db('default', ['id', 'myfile'], [1, 'initial.txt'])
+        d.myfile.storage = mongo_storage
+
+        with mock.patch('django_mongo_storage.fields.delete_on_commit') as delete_on_commit:
+            field.save_form_data(d, False)
+            self.assertEqual(d.myfile, '')
+            field.save_form_data(d, False)
 
-        mongo_storage.delete.assert_called_once_with(initial.myfile.name)
+        delete_on_commit.assert_called_once_with(mongo_storage, 'initial.txt', using='default')
+        mongo_storage.delete.assert_not_called()
 
     def test_save1_to_media_with_no_file_before(self):
         """
@@ -132,4 +218,70 @@ class MongoFileFieldTest(TestCase):
         os.remove(location)
 
 
+class PrefetchMongoFilesTest(TestCase):
+
+    def test_prefetch(self):
+        """
+            Metadata of all files should be fetched with one query and used by __html__().
+        """
+        oids = ['012345678901234567890123', '012345678901234567890124']
+        mongo_storage = _get_storage_mock()
+        mongo_storage.db_alias = 'Test'
+        mongo_storage.prefetch_metadata.return_value = {
+            oid: {'_id': oid, 'filename': '{}.txt'.format(i)} for i, oid in enumerate(oids)
+        }
+
+        documents = [Document(myfile=oid) for oid in oids] + [Document()]
+        for document in documents:
+            document.myfile.storage = mongo_storage
+
+        prefetch_mongo_files(documents)
+
+        mongo_storage.prefetch_metadata.assert_called_once_with(mock.ANY)
+        self.assertEqual(set(mongo_storage.prefetch_metadata.call_args[0][0]), set(oids))
+        self.assertEqual(documents[0].myfile.__html__(), '0.txt')
+        self.assertEqual(documents[1].myfile.__html__(), '1.txt')
+        mongo_storage.get_file_name.assert_not_called()
+
+
+class GenerateDerivativesTest(TestCase):
+
+    def test_generate(self):
+        """
+            Derivatives of files of all instances are generated with one call per collection and derivative.
+        """
+        oids = ['012345678901234567890123', '012345678901234567890124']
+        spec = {'size': (200, 200)}
+        mongo_storage = _get_storage_mock()
+        mongo_storage.db_alias = 'Test'
+        field = Document._meta.get_field('myfile')
+
+        documents = [Document(myfile=oid) for oid in oids] + [Document()]
+        for document in documents:
+            document.myfile.storage = mongo_storage
+
+        with mock.patch.object(field, 'derivatives', {'thumbnail': spec}, create=True):
+            self.assertEqual(generate_derivatives(documents, 'myfile'), documents)
+        mongo_storage.generate_derivatives.assert_called_once_with(oids, 'thumbnail', spec)
+        self.assertEqual(generate_derivatives([], 'myfile'), [])
+
+
+class SaveMongoFilesTest(TestCase):
+
+    def test_save_with_bulk_create(self):
+        mongo_storage = MongoStorage('Test', 'test')
+        field = Document._meta.get_field('myfile')
+        documents = [Document(), Document()]
+
+        with mock.patch.object(field, 'storage', mongo_storage):
+            save_mongo_files(documents, 'myfile', [('a.txt', ContentFile(b'a')), ('b.txt', ContentFile(b'b'))])
+            Document._base_manager.bulk_create(documents)
+
+            created = Document._base_manager.order_by('pk')
+            self.assertEqual([document.myfile.name for document in created],
+                             [document.myfile.name for document in documents])
+            self.assertEqual(mongo_storage.open(documents[1].myfile.name).read(), b'b')
+            mongo_storage.delete_many(document.myfile.name for document in documents)
 
+        with self.assertRaises(ValueError):
+            save_mongo_files(documents, 'myfile', [('a.txt', ContentFile(b'a'))])
@@ -0,0 +1,83 @@
+import io
+from collections import Counter
+from datetime import datetime, timedelta
+from unittest import mock
+
+from bson import ObjectId
+from django.core.files.base import ContentFile
+from django.core.management import call_command
+from django.test import TestCase
+
+from django_mongo_storage.management.commands.mongo_storage_gc import Command
+from django_mongo_storage.utils.storage import MongoStorage
+from .models import Document
+
+
+class MongoStorageGCTest(TestCase):
+
+    def setUp(self):
+        self.storage = MongoStorage('Test', 'gc')
+        self.referenced = self.storage._save('referenced.txt', ContentFile(b'referenced'))
+        self.orphan = self.storage._save('orphan.txt', ContentFile(b'orphan'))
+        Document._base_manager.create(myfile=self.referenced)
+
+        # chunk left by failed upload
+        self.orphaned_chunk_id = ObjectId.from_datetime(datetime.now() - timedelta(days=7))
+        self.storage.db['gc.chunks'].insert_one({'files_id': self.orphaned_chunk_id, 'n': 0, 'data': b'x'})
+
+        field = Document._meta.get_field('myfile')
+        patcher = mock.patch('django_mongo_storage.registry.registry.get_collections',
+                             return_value={('Test', 'gc'): (self.storage, [(Document, field)])})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(self.storage.db.drop_collection, 'gc.files')
+        self.addCleanup(self.storage.db.drop_collection, 'gc.chunks')
+
+    def _run(self, *args):
+        call_command(Command(), *args, stdout=io.StringIO())
+
+    def test_dry_run(self):
+        self._run('--dry-run', '--grace-hours=0')
+        self.assertTrue(self.storage.exists(self.orphan))
+        self.assertEqual(self.storage.db['gc.chunks'].count_documents({'files_id': self.orphaned_chunk_id}), 1)
+
+    def test_grace_period(self):
+        self._run()
+        self.assertTrue(self.storage.exists(self.orphan))
+        # chunk is older than grace period
+        self.assertEqual(self.storage.db['gc.chunks'].count_documents({'files_id': self.orphaned_chunk_id}), 0)
+
+    def test_delete_orphans(self):
+        self._run('--grace-hours=0', '--batch-size=1')
+        self.assertFalse(self.storage.exists(self.orphan))
+        self.assertTrue(self.storage.exists(self.referenced))
+        self.assertEqual(self.storage.db['gc.chunks'].count_documents({'files_id': self.orphaned_chunk_id}), 0)
+
+    def test_resume(self):
+        self._run('--grace-hours=0', '--resume-after=Test/gc/files/{}'.format(self.orphan))
+        self.assertTrue(self.storage.exists(self.orphan))
+
+    def test_referenced_during_collection(self):
+        # deduplicated file referenced by an upload after it was read by the cursor
+        self.storage.primary_files_collection.update_one({'_id': ObjectId(self.orphan)}, {'$set': {'refcount': 1}})
+
+        def count_references(fields, oids):
+            self.storage.primary_files_collection.update_one({'_id': ObjectId(self.orphan)}, {'$inc': {'refcount': 1}})
+            return Counter()
+
+        with mock.patch.object(Command, '_count_references', side_effect=count_references):
+            self._run('--grace-hours=0')
+        self.assertTrue(self.storage.exists(self.orphan))
+        self.assertEqual(self.storage.db['gc.chunks'].count_documents({'files_id': ObjectId(self.orphan)}), 1)
+
+        # unchanged reference count, leaked references are collected
+        self._run('--grace-hours=0')
+        self.assertFalse(self.storage.exists(self.orphan))
+
+    def test_unfinished_upload(self):
+        upload_id = self.storage.uploads.create('upload.bin', 2 * self.storage.chunk_size)
+        self.addCleanup(self.storage.db.drop_collection, 'gc.uploads')
+        self.storage.uploads.append(upload_id, 0, b'x' * self.storage.chunk_size)
+
+        self._run('--grace-hours=0')
+        self.assertEqual(self.storage.db['gc.chunks'].count_documents({'files_id': ObjectId(upload_id)}), 1)
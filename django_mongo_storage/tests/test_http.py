@@ -0,0 +1,91 @@
+import io
+
+from django.test import SimpleTestCase, RequestFactory
+from django.utils.http import http_date
+from django_mongo_storage.utils.compression import accepts_encoding
+from django_mongo_storage.utils.http import parse_range_header, iter_range, is_not_modified, if_range_matches
+
+
+class ParseRangeHeaderTest(SimpleTestCase):
+
+    def test_no_header(self):
+        self.assertIsNone(parse_range_header(None, 100))
+        self.assertIsNone(parse_range_header('', 100))
+
+    def test_malformed_header(self):
+        self.assertIsNone(parse_range_header('items=0-10', 100))
+        self.assertIsNone(parse_range_header('bytes=abc', 100))
+        self.assertIsNone(parse_range_header('bytes=10-5', 100))
+
+    def test_single_range(self):
+        self.assertEqual(parse_range_header('bytes=0-9', 100), [(0, 9)])
+        self.assertEqual(parse_range_header('bytes=90-', 100), [(90, 99)])
+        self.assertEqual(parse_range_header('bytes=-10', 100), [(90, 99)])
+        self.assertEqual(parse_range_header('bytes=50-1000', 100), [(50, 99)])
+
+    def test_multiple_ranges_are_coalesced(self):
+        self.assertEqual(parse_range_header('bytes=0-9,20-29', 100), [(0, 9), (20, 29)])
+        self.assertEqual(parse_range_header('bytes=0-9,5-19,20-29', 100), [(0, 29)])
+
+    def test_unsatisfiable(self):
+        self.assertEqual(parse_range_header('bytes=100-', 100), [])
+        self.assertEqual(parse_range_header('bytes=-0', 100), [])
+
+
+class IterRangeTest(SimpleTestCase):
+
+    def test_iter_range(self):
+        file = io.BytesIO(bytes(range(100)))
+        data = b''.join(iter_range(file, 10, 29, block_size=7))
+        self.assertEqual(data, bytes(range(10, 30)))
+
+
+class ConditionalRequestTest(SimpleTestCase):
+
+    etag = '"5799ee3ca68ce8463a392bc1"'
+    last_modified = 1469705788
+
+    def setUp(self):
+        self.factory = RequestFactory()
+
+    def test_if_none_match(self):
+        request = self.factory.get('/', HTTP_IF_NONE_MATCH=self.etag)
+        self.assertTrue(is_not_modified(request, self.etag, self.last_modified))
+
+        request = self.factory.get('/', HTTP_IF_NONE_MATCH='"other", W/{}'.format(self.etag))
+        self.assertTrue(is_not_modified(request, self.etag, self.last_modified))
+
+        request = self.factory.get('/', HTTP_IF_NONE_MATCH='"other"')
+        self.assertFalse(is_not_modified(request, self.etag, self.last_modified))
+
+    def test_if_modified_since(self):
+        request = self.factory.get('/', HTTP_IF_MODIFIED_SINCE=http_date(self.last_modified))
+        self.assertTrue(is_not_modified(request, self.etag, self.last_modified))
+
+        request = self.factory.get('/', HTTP_IF_MODIFIED_SINCE=http_date(self.last_modified - 60))
+        self.assertFalse(is_not_modified(request, self.etag, self.last_modified))
+
+    def test_if_range(self):
+        request = self.factory.get('/', HTTP_IF_RANGE=self.etag)
+        self.assertTrue(if_range_matches(request, self.etag, self.last_modified))
+
+        request = self.factory.get('/', HTTP_IF_RANGE='W/{}'.format(self.etag))
+        self.assertFalse(if_range_matches(request, self.etag, self.last_modified))
+
+        request = self.factory.get('/', HTTP_IF_RANGE=http_date(self.last_modified))
+        self.assertTrue(if_range_matches(request, self.etag, self.last_modified))
+
+
+class AcceptsEncodingTest(SimpleTestCase):
+
+    def test_accepts_encoding(self):
+        factory = RequestFactory()
+
+        self.assertTrue(accepts_encoding(factory.get('/', HTTP_ACCEPT_ENCODING='gzip, deflate, br'), 'gzip'))
+        self.assertTrue(accepts_encoding(factory.get('/', HTTP_ACCEPT_ENCODING='*'), 'zstd'))
+        self.assertFalse(accepts_encoding(factory.get('/', HTTP_ACCEPT_ENCODING='gzip;q=0'), 'gzip'))
+        self.assertFalse(accepts_encoding(factory.get('/', HTTP_ACCEPT_ENCODING='gzip; q=0.0'), 'gzip'))
+        self.assertFalse(accepts_encoding(factory.get('/', HTTP_ACCEPT_ENCODING='gzip;q=0, *'), 'gzip'))
+        self.assertTrue(accepts_encoding(factory.get('/', HTTP_ACCEPT_ENCODING='gzip;q=0.5'), 'gzip'))
+        self.assertFalse(accepts_encoding(factory.get('/', HTTP_ACCEPT_ENCODING='br'), 'gzip'))
+        self.assertFalse(accepts_encoding(factory.get('/'), 'gzip'))
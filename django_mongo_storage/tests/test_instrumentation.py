@@ -0,0 +1,106 @@
+import asyncio
+from unittest import mock
+
+from django.core.files.base import ContentFile
+from django.http import HttpResponse
+from django.test import SimpleTestCase, RequestFactory, override_settings
+
+from django_mongo_storage.middleware import StorageMetricsMiddleware
+from django_mongo_storage.utils.instrumentation import (storage_operation, instrument, current_operation,
+                                                        round_trip_listener, StatsdReceiver)
+from django_mongo_storage.utils.storage import MongoStorage
+
+
+class InstrumentationTest(SimpleTestCase):
+
+    def setUp(self):
+        self.storage = MongoStorage('Test', 'test')
+        self.operations = []
+        storage_operation.connect(self.receiver)
+
+    def tearDown(self):
+        storage_operation.disconnect(self.receiver)
+
+    def receiver(self, sender, storage, operation, **kwargs):
+        self.operations.append(operation)
+
+    def test_operations(self):
+        oid = self.storage.save('test.txt', ContentFile(b'content'))
+        self.assertEqual(self.storage.open(oid).read(), b'content')
+        self.storage.exists(oid)
+        self.storage.delete(oid)
+
+        self.assertEqual([(operation.name, operation.nested) for operation in self.operations], [
+            ('save', False), ('open', False), ('metadata', True), ('exists', False), ('delete', False),
+        ])
+        save, open_, metadata, exists, delete = self.operations
+        self.assertEqual(save.bytes, len(b'content'))
+        self.assertEqual(open_.bytes, len(b'content'))
+        # metadata is cached by open
+        self.assertTrue(metadata.cache_hit)
+        self.assertTrue(exists.cache_hit)
+        self.assertEqual(delete.files, 1)
+        self.assertTrue(all(operation.duration > 0 for operation in self.operations))
+
+    def test_error(self):
+        with self.assertRaises(Exception):
+            self.storage.open('000000000000000000000000')
+        self.assertEqual(self.operations[-1].name, 'open')
+        self.assertEqual(self.operations[-1].error, 'NoFile')
+
+    def test_round_trips(self):
+        # commands are counted in the running operation and operations calling it
+        with instrument(self.storage, 'open') as operation:
+            with instrument(self.storage, 'metadata') as nested:
+                round_trip_listener.started(None)
+            round_trip_listener.started(None)
+        self.assertEqual(nested.round_trips, 1)
+        self.assertEqual(operation.round_trips, 2)
+
+        # outside of operations
+        round_trip_listener.started(None)
+
+    def test_concurrent_tasks(self):
+        # operations of tasks interleaved in one thread are not nested in each other
+        async def run(name, started, other_started):
+            with instrument(self.storage, name) as operation:
+                started.set()
+                await other_started.wait()
+                self.assertIs(current_operation(), operation)
+                round_trip_listener.started(None)
+            self.assertIsNone(current_operation())
+            return operation
+
+        async def main():
+            first, second = asyncio.Event(), asyncio.Event()
+            return await asyncio.gather(run('open', first, second), run('exists', second, first))
+
+        for operation in asyncio.run(main()):
+            self.assertFalse(operation.nested)
+            self.assertEqual(operation.round_trips, 1)
+
+    def test_statsd(self):
+        client = mock.Mock()
+        with instrument(self.storage, 'save') as operation:
+            operation.bytes = 10
+            operation.cache_hit = False
+        StatsdReceiver(client)(None, operation=operation)
+
+        client.timing.assert_called_once_with('mongo_storage.Test.test.save.time', operation.duration * 1000)
+        client.incr.assert_any_call('mongo_storage.Test.test.save.bytes', 10)
+        client.incr.assert_any_call('mongo_storage.Test.test.save.cache_miss')
+
+    @override_settings(STORAGE_SERVER_TIMING=True)
+    def test_middleware(self):
+        request = RequestFactory().get('/')
+
+        def view(request):
+            self.storage.exists('000000000000000000000000')
+            return HttpResponse()
+
+        response = StorageMetricsMiddleware(view)(request)
+        summary = request.storage_metrics.as_dict()
+        # nested operations are not summed up
+        self.assertEqual(list(summary), ['exists'])
+        self.assertEqual(summary['exists']['count'], 1)
+        self.assertTrue(response['Server-Timing'].startswith('mongo-storage-exists;dur='))
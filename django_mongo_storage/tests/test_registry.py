@@ -0,0 +1,53 @@
+from unittest import mock
+
+from django.contrib.auth.models import Group
+from django.db.models.signals import post_delete
+from django.test import TestCase
+
+from django_mongo_storage.registry import MongoFieldRegistry
+from django_mongo_storage.signals import connect_signals, post_delete_receiver
+from django_mongo_storage.utils.storage import MongoStorage
+from .models import Document
+
+
+class MongoFieldRegistryTest(TestCase):
+
+    def setUp(self):
+        self.oid = '012345678901234567890123'
+        self.storage = MongoStorage('Test', 'test')
+        self.field = Document._meta.get_field('myfile')
+
+        patcher = mock.patch.object(self.field, 'storage', self.storage)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.registry = MongoFieldRegistry()
+        self.document = Document._base_manager.create(myfile=self.oid)
+
+    def test_models(self):
+        self.assertEqual(self.registry.get_model_fields('tests', 'Document'), (Document, [self.field]))
+        self.assertEqual(self.registry.get_collections(), {('Test', 'test'): (self.storage, [(Document, self.field)])})
+        with self.assertRaises(LookupError):
+            self.registry.get_model_fields('tests', 'missing')
+
+    def test_get_field(self):
+        with self.assertNumQueries(1):
+            self.assertEqual(self.registry.get_field('tests', 'document', self.document.pk, self.oid), self.field)
+
+        # file of other instance, missing instance
+        self.assertIsNone(self.registry.get_field('tests', 'document', self.document.pk, '0' * 24))
+        self.assertIsNone(self.registry.get_field('tests', 'document', self.document.pk + 1, self.oid))
+
+    def test_post_delete_receiver(self):
+        with mock.patch('django_mongo_storage.signals.registry', self.registry):
+            connect_signals()
+            self.addCleanup(post_delete.disconnect, post_delete_receiver, sender=Document,
+                            dispatch_uid='post_delete_file_removal_tests.document')
+
+            # connected only to models with mongo fields
+            self.assertTrue(post_delete.has_listeners(Document))
+            self.assertFalse(post_delete.has_listeners(Group))
+
+            with mock.patch('django_mongo_storage.signals.delete_on_commit') as delete_on_commit:
+                self.document.delete()
+            delete_on_commit.assert_called_once_with(self.storage, self.oid, using='default')
@@ -1,9 +1,18 @@
+import asyncio
 import io
-import time
+import os
+import shutil
+import tempfile
 from datetime import datetime, timedelta
+from unittest import mock
 
+from bson import ObjectId
+from gridfs.errors import NoFile
+from django.core.files.base import ContentFile
 from django.core.files.uploadedfile import InMemoryUploadedFile
-from django.test import TestCase, mock
+from django.test import TestCase
+from pymongo import ReadPreference
+from pymongo.errors import BulkWriteError
 from django_mongo_storage.utils.storage import MongoStorage
 
 
@@ -46,9 +55,8 @@ class MongoStorageTest(TestCase):
             dj_file = InMemoryUploadedFile(file.buffer, None, file.name, 'text/plain', None, None)
             result = self.mongo_storage.save(file.name, dj_file)
 
-            # sleep for replication lag
-            time.sleep(0.5)
-
+            # just written file is read from primary, no need to wait for replication lag
+            self.assertTrue(self.mongo_storage._is_recently_written(result))
             self.assertEqual(self.mongo_storage.get_file_name(result), filename)
 
             self.mongo_storage.delete(result)
@@ -62,14 +70,331 @@ class MongoStorageTest(TestCase):
             dj_file = InMemoryUploadedFile(file.buffer, None, file.name, 'text/plain', None, None)
             result = self.mongo_storage._stream(filename, dj_file)
 
-            #sleep for replication lag
-            time.sleep(0.5)
-
             self.assertEqual(self.mongo_storage.get_file_name(result), filename)
 
             self.mongo_storage.delete(result)
             self.assertFalse(self.mongo_storage.exists(result))
 
+    def test_stream_in_batches(self):
+        mongo_storage = MongoStorage('Test', 'test', chunk_size=1024, write_batch_size=3, overlap_writes=True)
+        data = os.urandom(10 * 1024 + 5)
+
+        result = mongo_storage._save('random.bin', ContentFile(data))
+
+        self.assertEqual(mongo_storage.get_file(result).read(), data)
+        self.assertEqual(mongo_storage.db['test.chunks'].count_documents({'files_id': ObjectId(result)}), 11)
+
+        mongo_storage.delete(result)
+        self.assertEqual(mongo_storage.db['test.chunks'].count_documents({'files_id': ObjectId(result)}), 0)
+
+    def test_read_ahead(self):
+        mongo_storage = MongoStorage('Test', 'test', chunk_size=1024, read_ahead=3)
+        data = os.urandom(10 * 1024 + 5)
+        result = mongo_storage._save('random.bin', ContentFile(data))
+
+        self.assertEqual(b''.join(mongo_storage.get_file(result)), data)
+
+        mongo_file = mongo_storage.open(result)
+        mongo_file.seek(2000)
+        self.assertEqual(mongo_file.read(5000), data[2000:7000])
+        self.assertEqual(mongo_file.read(), data[7000:])
+        self.assertEqual(mongo_file.filename, 'random.bin')
+
+        mongo_storage.delete(result)
+
+    def test_deduplication(self):
+        mongo_storage = MongoStorage('Test', 'test', deduplicate=True)
+        data = os.urandom(1024)
+
+        first = mongo_storage._save('first.bin', ContentFile(data))
+        second = mongo_storage._save('second.bin', ContentFile(data))
+        other = mongo_storage._save('other.bin', ContentFile(b'other content'))
+
+        self.assertEqual(first, second)
+        self.assertNotEqual(first, other)
+
+        # file is removed with the last reference
+        mongo_storage.delete(first)
+        self.assertEqual(mongo_storage.get_file(second).read(), data)
+        mongo_storage.delete(second)
+        self.assertFalse(mongo_storage.exists(second))
+
+        mongo_storage.delete(other)
+
+    def test_deduplication_unreferenced_file(self):
+        mongo_storage = MongoStorage('Test', 'test', deduplicate=True)
+        data = os.urandom(1024)
+        first = mongo_storage._save('first.bin', ContentFile(data))
+        # the last reference is removed, file isn't deleted yet
+        mongo_storage.primary_files_collection.update_one({'_id': ObjectId(first)}, {'$set': {'refcount': 0}})
+
+        # content hashed while streaming, the same content is found on insert of the file document
+        content = ContentFile(data)
+        content.seekable = lambda: False
+        second = mongo_storage._save('second.bin', content)
+
+        self.assertEqual(second, first)
+        self.assertEqual(mongo_storage.primary_files_collection.find_one({'_id': ObjectId(first)})['refcount'], 1)
+        self.assertEqual(mongo_storage.get_file(second).read(), data)
+        mongo_storage.delete(second)
+        self.assertFalse(mongo_storage.exists(second))
+        self.assertEqual(mongo_storage.primary_db['test.chunks'].count_documents({'files_id': ObjectId(first)}), 0)
+
+    def test_compression(self):
+        mongo_storage = MongoStorage('Test', 'test', compress='gzip', chunk_size=1024)
+        data = b''.join(b'line %d\n' % i for i in range(1000))
+        content = ContentFile(data)
+        content.content_type = 'text/csv'
+
+        result = mongo_storage._save('lines.csv', content)
+
+        self.assertEqual(mongo_storage.get_metadata(result)['compression'], 'gzip')
+        self.assertLess(mongo_storage.get_metadata(result)['length'], len(data))
+        self.assertEqual(mongo_storage.size(result), len(data))
+        self.assertEqual(mongo_storage.get_file(result).read(), data)
+
+        mongo_file = mongo_storage.open(result)
+        mongo_file.seek(5000)
+        self.assertEqual(mongo_file.read(100), data[5000:5100])
+
+        # size is known without decompressing (ex. FileResponse seeks to the end and back)
+        mongo_file = mongo_storage.get_file(result)
+        with mock.patch.object(mongo_file.raw, 'read', wraps=mongo_file.raw.read) as read:
+            self.assertEqual(mongo_file.seek(0, io.SEEK_END), len(data))
+            self.assertEqual(mongo_file.tell(), len(data))
+            mongo_file.seek(0)
+            read.assert_not_called()
+            self.assertEqual(mongo_file.read(), data)
+
+        mongo_storage.delete(result)
+
+    def test_compression_skipped(self):
+        mongo_storage = MongoStorage('Test', 'test', compress='gzip')
+
+        self.assertIsNone(mongo_storage.get_metadata(self.image_oid).get('compression'))
+
+        with open('django_mongo_storage/tests/files/test.jpg', 'rb') as image_file:
+            dj_image_file = InMemoryUploadedFile(image_file, None, 'test.jpg', 'image/jpg', None, None)
+            result = mongo_storage._save('test.jpg', dj_image_file)
+
+        self.assertIsNone(mongo_storage.get_metadata(result).get('compression'))
+        mongo_storage.delete(result)
+
+    def test_local_cache(self):
+        location = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, location)
+        mongo_storage = MongoStorage('Test', 'test', local_cache_dir=location, local_cache_max_bytes=3000)
+        results = [mongo_storage._save('{}.bin'.format(i), ContentFile(os.urandom(1000))) for i in range(4)]
+
+        for result in results:
+            mongo_file = mongo_storage.get_file(result)
+            self.assertEqual(mongo_file.read(), mongo_storage.fs.get(ObjectId(result)).read())
+            self.assertTrue(os.path.exists(mongo_storage.local_cache.path(result)))
+
+        # least recently used file was evicted
+        self.assertFalse(os.path.exists(mongo_storage.local_cache.path(results[0])))
+
+        for result in results:
+            mongo_storage.delete(result)
+        self.assertFalse(os.path.exists(mongo_storage.local_cache.path(results[-1])))
+
+    def test_local_cache_evicted(self):
+        location = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, location)
+        mongo_storage = MongoStorage('Test', 'test', local_cache_dir=location)
+        data = os.urandom(1000)
+        result = mongo_storage._save('test.bin', ContentFile(data))
+        self.addCleanup(mongo_storage.delete, result)
+
+        # file removed from the cache between lookup and open
+        with mock.patch.object(mongo_storage.local_cache, 'get', return_value=os.path.join(location, 'evicted')):
+            mongo_file = mongo_storage.get_file(result)
+        self.assertIsNone(getattr(mongo_file, 'path', None))
+        self.assertEqual(mongo_file.read(), data)
+
+    def test_delete_many(self):
+        results = [self.mongo_storage._save('{}.txt'.format(i), ContentFile(b'x' * 1000)) for i in range(3)]
+
+        self.mongo_storage.delete_many(results)
+        for result in results:
+            self.assertFalse(self.mongo_storage.exists(result))
+        self.assertEqual(self.mongo_storage.db['test.chunks'].count_documents(
+            {'files_id': {'$in': [ObjectId(result) for result in results]}}), 0)
+
+    def test_save_many(self):
+        mongo_storage = MongoStorage('Test', 'test', chunk_size=1024, write_batch_size=4)
+        contents = [('{}.bin'.format(i), ContentFile(os.urandom(i * 700))) for i in range(10)]
+
+        with mock.patch.object(MongoStorage, 'primary_db', mongo_storage.primary_db):
+            with mock.patch.object(mongo_storage.primary_db['test.files'], 'insert_many',
+                                   wraps=mongo_storage.primary_db['test.files'].insert_many) as insert_many:
+                results = mongo_storage.save_many(contents)
+
+        # file documents of all files inserted at once
+        insert_many.assert_called_once_with(mock.ANY, ordered=False)
+        self.assertEqual(len(results), 10)
+        for (name, content), result in zip(contents, results):
+            content.seek(0)
+            self.assertEqual(mongo_storage.get_file_name(result), name)
+            self.assertEqual(mongo_storage.open(result).read(), content.read())
+        mongo_storage.delete_many(results)
+
+    def test_save_many_deduplication(self):
+        mongo_storage = MongoStorage('Test', 'test', deduplicate=True)
+        data = os.urandom(1024)
+        stored = mongo_storage._save('stored.bin', ContentFile(data))
+
+        other = os.urandom(1024)
+        results = mongo_storage.save_many([('1.bin', ContentFile(other)), ('2.bin', ContentFile(other)),
+                                           ('3.bin', ContentFile(data))])
+        self.assertEqual(results[0], results[1])
+        # content stored before is referenced
+        self.assertEqual(results[2], stored)
+        self.assertEqual(mongo_storage.primary_files_collection.count_documents({'sha256': {'$exists': True}}), 2)
+
+        mongo_storage.delete_many(results)
+        self.assertTrue(mongo_storage.exists(stored))
+        self.assertFalse(mongo_storage.exists(results[0]))
+        mongo_storage.delete(stored)
+
+    def test_save_many_conflict_deleted(self):
+        mongo_storage = MongoStorage('Test', 'test', deduplicate=True)
+        data = os.urandom(1024)
+        stored = mongo_storage._save('stored.bin', ContentFile(data))
+
+        # file with the same content is deleted before it's referenced
+        with mock.patch.object(mongo_storage, '_reference_existing', return_value=None):
+            with self.assertRaises(IOError):
+                mongo_storage.save_many([('new.bin', ContentFile(os.urandom(1024))), ('3.bin', ContentFile(data))])
+        # files saved by the call are deleted
+        self.assertEqual(mongo_storage.primary_files_collection.count_documents({'filename': 'new.bin'}), 0)
+        self.assertEqual(mongo_storage.primary_files_collection.find_one({'_id': ObjectId(stored)})['refcount'], 1)
+        mongo_storage.delete(stored)
+
+    def test_save_many_insert_error(self):
+        files = self.mongo_storage.primary_files_collection
+        chunks = self.mongo_storage.db['test.chunks']
+        insert_many = files.insert_many
+
+        # unordered insert stores all documents but the first one
+        def failing_insert_many(documents, **kwargs):
+            insert_many(documents[1:], **kwargs)
+            raise BulkWriteError({'writeErrors': [{'index': 0, 'code': 121, 'errmsg': 'Document failed validation'}]})
+
+        contents = [('{}.bin'.format(i), ContentFile(os.urandom(1024))) for i in range(3)]
+        chunks_before = chunks.count_documents({})
+        with mock.patch.object(files, 'insert_many', side_effect=failing_insert_many):
+            with self.assertRaises(BulkWriteError):
+                self.mongo_storage.save_many(contents)
+        # files of the failed batch are removed
+        self.assertEqual(files.count_documents({'filename': {'$in': ['0.bin', '1.bin', '2.bin']}}), 0)
+        self.assertEqual(chunks.count_documents({}), chunks_before)
+
+    def test_save_many_error(self):
+        def contents():
+            yield 'first.txt', ContentFile(b'first')
+            raise IOError('Connection reset')
+
+        with mock.patch('django_mongo_storage.utils.storage.SAVE_BATCH_SIZE', 1):
+            with self.assertRaises(IOError):
+                self.mongo_storage.save_many(contents())
+        # file saved before the error is deleted
+        self.assertEqual(self.mongo_storage.primary_files_collection.count_documents({'filename': 'first.txt'}), 0)
+
+    def test_inline(self):
+        mongo_storage = MongoStorage('Test', 'test', inline_threshold=1024, chunk_size=1024)
+        small = mongo_storage._save('small.txt', ContentFile(b'small content'))
+        large = mongo_storage._save('large.txt', ContentFile(b'x' * 2048))
+
+        chunks = mongo_storage.db['test.chunks']
+        self.assertEqual(chunks.count_documents({'files_id': ObjectId(small)}), 0)
+        self.assertEqual(chunks.count_documents({'files_id': ObjectId(large)}), 2)
+
+        # content is fetched with the document, GridFS isn't used
+        mongo_storage._metadata_cache.clear()
+        with mock.patch.object(MongoStorage, '_get_gridfs_file') as get_gridfs_file:
+            mongo_file = mongo_storage.open(small)
+            get_gridfs_file.assert_not_called()
+        self.assertEqual(mongo_file.read(), b'small content')
+        self.assertEqual(mongo_file.filename, 'small.txt')
+        self.assertEqual(mongo_storage.size(small), len(b'small content'))
+        self.assertTrue(mongo_storage.exists(small))
+        # content isn't cached with metadata
+        self.assertNotIn('data', mongo_storage.get_metadata(small))
+
+        # served by view_file
+        from django.test import RequestFactory
+        from django_mongo_storage.views import _file_response
+        request = RequestFactory().get('/', HTTP_RANGE='bytes=0-4')
+        response = _file_response(request, mongo_storage, mongo_storage.get_file(small))
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(b''.join(response), b'small')
+
+        self.assertEqual(mongo_storage.open(large).read(), b'x' * 2048)
+        mongo_storage.delete_many([small, large])
+        self.assertFalse(mongo_storage.exists(small))
+
+    def test_inline_compressed(self):
+        mongo_storage = MongoStorage('Test', 'test', inline_threshold=1024, compress='gzip')
+        data = b'line\n' * 1000
+        oid = mongo_storage._save('lines.txt', ContentFile(data))
+
+        self.assertTrue(mongo_storage.get_metadata(oid)['inline'])
+        self.assertEqual(mongo_storage.open(oid).read(), data)
+        self.assertEqual(mongo_storage.size(oid), len(data))
+        mongo_storage.delete(oid)
+
+    def test_read_preference(self):
+        mongo_storage = MongoStorage('Test', 'test', read_preference='secondaryPreferred', read_tags=[{'dc': 'eu'}, {}])
+        self.assertEqual(mongo_storage._read_preference.mode, ReadPreference.SECONDARY_PREFERRED.mode)
+        self.assertEqual(mongo_storage._read_preference.tag_sets, [{'dc': 'eu'}, {}])
+
+        result = mongo_storage._save('test.txt', ContentFile(b'test'))
+        mongo_storage._recent_writes.clear()
+        mongo_storage._metadata_cache.clear()
+
+        # file not replicated to secondaries yet is read from primary
+        with mock.patch.object(MongoStorage, 'files_collection') as files_collection:
+            files_collection.find_one.return_value = None
+            self.assertEqual(mongo_storage.get_file_name(result), 'test.txt')
+        self.assertTrue(mongo_storage._is_recently_written(result))
+        mongo_storage.delete(result)
+
+    def test_derivatives(self):
+        spec = {'size': (8, 8), 'format': 'PNG'}
+        with open('django_mongo_storage/tests/files/test.jpg', 'rb') as file:
+            image_oid = self.mongo_storage._save('test.jpg', ContentFile(file.read()))
+
+        derivative_oid = self.mongo_storage.get_derivative(image_oid, 'thumbnail', spec)
+        thumbnail = self.mongo_storage.get_file(derivative_oid)
+        self.assertEqual(thumbnail.filename, 'test_thumbnail.png')
+        self.assertEqual(thumbnail.content_type, 'image/png')
+        self.assertLessEqual(max(thumbnail.width, thumbnail.height), 8)
+
+        # the next request gets stored derivative
+        with mock.patch('django_mongo_storage.utils.storage.render_derivative') as render:
+            self.assertEqual(self.mongo_storage.get_derivative(image_oid, 'thumbnail', spec), derivative_oid)
+            self.mongo_storage._derivative_cache.clear()
+            self.assertEqual(self.mongo_storage.generate_derivatives([image_oid], 'thumbnail', spec),
+                             {image_oid: derivative_oid})
+            render.assert_not_called()
+
+        # deleted with the source
+        self.mongo_storage.delete(image_oid)
+        self.assertFalse(self.mongo_storage.exists(derivative_oid))
+
+    def test_derivatives_not_image(self):
+        spec = {'size': (8, 8), 'format': 'PNG'}
+        with open('django_mongo_storage/tests/files/test.jpg', 'rb') as file:
+            image_oid = self.mongo_storage._save('test.jpg', ContentFile(file.read()))
+        self.addCleanup(self.mongo_storage.delete, image_oid)
+
+        # other images get their derivatives
+        derivatives = self.mongo_storage.generate_derivatives([self.text_oid, image_oid], 'thumbnail', spec)
+        self.assertEqual(list(derivatives), [image_oid])
+        with self.assertRaises(NoFile):
+            self.mongo_storage.get_derivative(self.text_oid, 'thumbnail', spec)
+
     def test_file_properties(self):
 
         mongo_image_file = self.mongo_storage.get_file(self.image_oid)
@@ -81,6 +406,48 @@ class MongoStorageTest(TestCase):
         self.assertEqual(mongo_image_file.content_type, 'image/jpg')
         self.assertLess(datetime.now() - mongo_image_file.upload_date, timedelta(days=1))
 
+    def test_metadata(self):
+        mongo_text_file = self.mongo_storage.get_file(self.text_oid)
+
+        self.assertEqual(self.mongo_storage.size(self.text_oid), mongo_text_file.length)
+        self.assertEqual(self.mongo_storage.get_file_name(self.text_oid), 'test.txt')
+        self.assertEqual(self.mongo_storage.created_time(self.text_oid), mongo_text_file.upload_date)
+        self.assertTrue(self.mongo_storage.exists(self.text_oid))
+
+        # served from cache the next time
+        with mock.patch.object(MongoStorage, 'files_collection') as files_collection:
+            self.assertEqual(self.mongo_storage.get_file_name(self.text_oid), 'test.txt')
+            files_collection.find_one.assert_not_called()
+
+    def test_async_storage(self):
+        async_storage = self.mongo_storage.async_storage
+
+        async def read():
+            return b''.join([chunk async for chunk in async_storage.iter_chunks(self.text_oid)])
+
+        self.assertEqual(asyncio.run(read()), self.mongo_storage.get_file(self.text_oid).read())
+        self.assertEqual(asyncio.run(async_storage.get_file_name(self.text_oid)), 'test.txt')
+
+    def test_async_save_as_sync(self):
+        # files saved async are stored the same way as by save() (deduplicated, compressed)
+        mongo_storage = MongoStorage('Test', 'test', deduplicate=True, compress='gzip', chunk_size=1024)
+        data = b''.join(b'line %d\n' % i for i in range(1000))
+
+        def content():
+            content = ContentFile(data)
+            content.content_type = 'text/csv'
+            return content
+
+        result = asyncio.run(mongo_storage.async_storage.save('lines.csv', content()))
+        self.assertEqual(mongo_storage.save('lines.csv', content()), result)
+
+        document = mongo_storage.primary_files_collection.find_one({'_id': ObjectId(result)})
+        self.assertEqual(document['refcount'], 2)
+        self.assertEqual(document['compression'], 'gzip')
+        self.assertEqual(document['chunkSize'], 1024)
+        self.assertEqual(mongo_storage.get_file(result).read(), data)
+        mongo_storage.delete_many([result, result])
+
     def test_listdir(self):
         self.assertIn('test.jpg', self.mongo_storage.listdir())
         self.assertIn('test.txt', self.mongo_storage.listdir())
@@ -0,0 +1,150 @@
+import base64
+import os
+from unittest import mock
+
+from django.contrib.auth.models import User
+from django.conf import settings
+from django.test import TestCase, Client, RequestFactory, override_settings
+from django.urls import reverse
+
+from django_mongo_storage import views
+from django_mongo_storage.utils.storage import MongoStorage
+from django_mongo_storage.utils.uploads import UploadError, UploadOffsetMismatch
+from .models import Document
+
+
+class ResumableUploadsTest(TestCase):
+
+    def setUp(self):
+        self.storage = MongoStorage('Test', 'test', chunk_size=1000)
+        self.content = os.urandom(2500)
+
+    def test_upload(self):
+        uploads = self.storage.uploads
+        upload_id = uploads.create('test.bin', len(self.content), content_type='application/octet-stream')
+
+        offset = uploads.append(upload_id, 0, self.content[:1500])
+        self.assertEqual(offset, 1500)
+        # complete chunks are written at once, the rest is kept with the upload
+        self.assertEqual(self.storage.db['test.chunks'].count_documents({'files_id': uploads.get(upload_id)['_id']}), 1)
+
+        with self.assertRaises(UploadOffsetMismatch) as error:
+            uploads.append(upload_id, 1000, self.content[1000:])
+        self.assertEqual(error.exception.offset, 1500)
+        with self.assertRaises(UploadError):
+            uploads.finish(upload_id)
+
+        uploads.append(upload_id, offset, self.content[1500:])
+        oid = uploads.finish(upload_id)
+        self.assertEqual(oid, upload_id)
+        self.assertIsNone(uploads.get(upload_id))
+
+        mongo_file = self.storage.get_file(oid)
+        self.assertEqual(mongo_file.read(), self.content)
+        self.assertEqual(mongo_file.filename, 'test.bin')
+        self.storage.delete(oid)
+
+    def test_finish_missing_chunks(self):
+        uploads = self.storage.uploads
+        upload_id = uploads.create('test.bin', len(self.content))
+        uploads.append(upload_id, 0, self.content)
+        oid = uploads._get_upload_id(upload_id)
+        self.storage.db['test.chunks'].delete_one({'files_id': oid, 'n': 1})
+
+        with self.assertRaises(UploadError):
+            uploads.finish(upload_id)
+        self.assertFalse(self.storage.exists(upload_id))
+        uploads.abort(upload_id)
+
+    def test_abort(self):
+        uploads = self.storage.uploads
+        upload_id = uploads.create('test.bin', len(self.content))
+        uploads.append(upload_id, 0, self.content[:1500])
+
+        uploads.abort(upload_id)
+        self.assertIsNone(uploads.get(upload_id))
+        oid = uploads._get_upload_id(upload_id)
+        self.assertEqual(self.storage.db['test.chunks'].count_documents({'files_id': oid}), 0)
+
+
+@override_settings(ROOT_URLCONF='django_mongo_storage.urls_api')
+class UploadViewTest(TestCase):
+
+    def setUp(self):
+        self.storage = MongoStorage('Test', 'test', chunk_size=1000)
+        self.field = Document._meta.get_field('myfile')
+        self.document = Document._base_manager.create()
+        self.user = User.objects.create_superuser('admin', 'admin@example.com', 'password')
+        self.factory = RequestFactory()
+
+        patcher = mock.patch('django_mongo_storage.views.registry.get_model_fields',
+                             return_value=(Document, [self.field]))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = mock.patch.object(self.field, 'storage', self.storage)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        # objects.get is replaced by tests of fields
+        patcher = mock.patch.object(Document.objects, 'get', Document._base_manager.get)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _request(self, method, view, *args, **kwargs):
+        request = getattr(self.factory, method)('/', **kwargs)
+        request.user = self.user
+        return view(request, 'tests', 'document', self.document.pk, 'myfile', *args)
+
+    def test_upload(self):
+        content = os.urandom(2500)
+        response = self._request('post', views.create_upload, HTTP_UPLOAD_LENGTH=str(len(content)),
+                                 HTTP_UPLOAD_METADATA='filename {}'.format(base64.b64encode(b'test.bin').decode()))
+        self.assertEqual(response.status_code, 201)
+        upload_id = response['Location'].rstrip('/').rsplit('/', 1)[-1]
+
+        response = self._request('patch', views.upload, upload_id, data=content[:1200], HTTP_UPLOAD_OFFSET='0',
+                                 content_type='application/offset+octet-stream')
+        self.assertEqual(response.status_code, 204)
+        self.assertEqual(response['Upload-Offset'], '1200')
+
+        # resumed from wrong offset
+        response = self._request('patch', views.upload, upload_id, data=content, HTTP_UPLOAD_OFFSET='0',
+                                 content_type='application/offset+octet-stream')
+        self.assertEqual(response.status_code, 409)
+
+        response = self._request('head', views.upload, upload_id)
+        self.assertEqual(response['Upload-Offset'], '1200')
+
+        response = self._request('patch', views.upload, upload_id, data=content[1200:], HTTP_UPLOAD_OFFSET='1200',
+                                 content_type='application/offset+octet-stream')
+        self.assertEqual(response.status_code, 204)
+
+        # finished upload is the file of the field
+        self.document.refresh_from_db()
+        self.assertEqual(self.document.myfile.name, upload_id)
+        self.assertEqual(self.storage.get_file(upload_id).read(), content)
+        self.storage.delete(upload_id)
+
+    @override_settings(MIDDLEWARE=['django.contrib.sessions.middleware.SessionMiddleware',
+                                   'django.middleware.csrf.CsrfViewMiddleware',
+                                   'django.contrib.auth.middleware.AuthenticationMiddleware'],
+                       SESSION_ENGINE='django.contrib.sessions.backends.signed_cookies')
+    def test_csrf(self):
+        upload_id = self.storage.uploads.create('test.bin', 10, user=self.user.pk)
+        url = reverse('upload', kwargs={'app_label': 'tests', 'model_name': 'document', 'pk': self.document.pk,
+                                        'field_name': 'myfile', 'upload_id': upload_id})
+        client = Client(enforce_csrf_checks=True)
+        client.force_login(self.user)
+        token = 'a' * 32
+        client.cookies[settings.CSRF_COOKIE_NAME] = token
+
+        # requests of session authenticated user without the token are rejected
+        response = client.patch(url, b'0123456789', content_type='application/offset+octet-stream',
+                                HTTP_UPLOAD_OFFSET='0')
+        self.assertEqual(response.status_code, 403)
+        response = client.delete(url)
+        self.assertEqual(response.status_code, 403)
+        self.assertEqual(self.storage.uploads.get(upload_id)['offset'], 0)
+
+        response = client.delete(url, HTTP_X_CSRFTOKEN=token)
+        self.assertEqual(response.status_code, 204)
+        self.assertIsNone(self.storage.uploads.get(upload_id))
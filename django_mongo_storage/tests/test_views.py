@@ -0,0 +1,229 @@
+import gzip
+import os
+import shutil
+import tempfile
+from unittest import mock
+
+from django.contrib.auth.models import User
+from django.core.files.base import ContentFile
+from django.test import TestCase, RequestFactory
+
+from django_mongo_storage import views
+from django_mongo_storage.utils.storage import MongoStorage
+from .models import Document
+
+
+class ViewFileTest(TestCase):
+
+    def setUp(self):
+        self.storage = MongoStorage('Test', 'test', chunk_size=1000)
+        self.content = os.urandom(2500)
+        self.oid = self.storage.save('test.bin', ContentFile(self.content))
+        self.addCleanup(self.storage.delete, self.oid)
+        self.user = User.objects.create_superuser('admin', 'admin@example.com', 'password')
+        self.factory = RequestFactory()
+
+        field = Document._meta.get_field('myfile')
+        patcher = mock.patch.object(field, 'storage', self.storage)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = mock.patch('django_mongo_storage.views.registry.get_field', return_value=field)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _request(self, **kwargs):
+        request = self.factory.get('/', **kwargs)
+        request.user = self.user
+        return views.view_file(request, 'tests', 'document', 1, self.oid)
+
+    def test_whole_file(self):
+        response = self._request()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(b''.join(response.streaming_content), self.content)
+        self.assertEqual(response['Accept-Ranges'], 'bytes')
+
+    def test_single_range(self):
+        response = self._request(HTTP_RANGE='bytes=900-1099')
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response['Content-Range'], 'bytes 900-1099/2500')
+        self.assertEqual(response['Content-Length'], '200')
+        self.assertEqual(b''.join(response.streaming_content), self.content[900:1100])
+
+    def test_suffix_range(self):
+        response = self._request(HTTP_RANGE='bytes=-100')
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response['Content-Range'], 'bytes 2400-2499/2500')
+        self.assertEqual(b''.join(response.streaming_content), self.content[-100:])
+
+    def test_unsatisfiable_range(self):
+        response = self._request(HTTP_RANGE='bytes=3000-')
+        self.assertEqual(response.status_code, 416)
+        self.assertEqual(response['Content-Range'], 'bytes */2500')
+        self.assertFalse(response.has_header('Content-Disposition'))
+
+    def test_multiple_ranges(self):
+        response = self._request(HTTP_RANGE='bytes=0-9,2000-2009')
+        self.assertEqual(response.status_code, 206)
+        content_type, _, boundary = response['Content-Type'].partition('; boundary=')
+        self.assertEqual(content_type, 'multipart/byteranges')
+
+        body = b''.join(response.streaming_content)
+        parts = body.split('--{}'.format(boundary).encode('ascii'))
+        self.assertEqual(parts[0], b'')
+        self.assertEqual(parts[-1], b'--\r\n')
+        self.assertEqual(len(parts), 4)
+        for part, (start, end) in zip(parts[1:3], [(0, 9), (2000, 2009)]):
+            headers, _, data = part.partition(b'\r\n\r\n')
+            self.assertIn('Content-Range: bytes {}-{}/2500'.format(start, end).encode('ascii'), headers)
+            self.assertEqual(data, self.content[start:end + 1] + b'\r\n')
+
+    def test_if_range_mismatch(self):
+        # stale validator, whole file is sent
+        response = self._request(HTTP_RANGE='bytes=0-9', HTTP_IF_RANGE='"stale"')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(b''.join(response.streaming_content), self.content)
+
+
+class ServeModeTest(TestCase):
+
+    def setUp(self):
+        self.location = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.location)
+        self.storage = MongoStorage('Test', 'test', local_cache_dir=self.location, local_cache_max_bytes=3000)
+        self.content = os.urandom(2500)
+        self.oid = self.storage.save('test.bin', ContentFile(self.content))
+        self.addCleanup(self.storage.delete, self.oid)
+        self.path = self.storage.local_cache.path(self.oid)
+        self.user = User.objects.create_superuser('admin', 'admin@example.com', 'password')
+        self.factory = RequestFactory()
+
+        field = Document._meta.get_field('myfile')
+        patcher = mock.patch.object(field, 'storage', self.storage)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = mock.patch('django_mongo_storage.views.registry.get_field', return_value=field)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _request(self, serve_mode, **kwargs):
+        # file is cached by a response streaming it whole
+        with self.storage.get_file(self.oid) as mongo_file:
+            mongo_file.read()
+        self.storage.serve_mode = serve_mode
+        request = self.factory.get('/', **kwargs)
+        request.user = self.user
+        response = views.view_file(request, 'tests', 'document', 1, self.oid)
+        self.addCleanup(response.close)
+        return response
+
+    def test_python(self):
+        response = self._request('python')
+        self.assertEqual(b''.join(response.streaming_content), self.content)
+        self.assertFalse(response.has_header('X-Sendfile'))
+
+    def test_sendfile(self):
+        response = self._request('sendfile')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.file_to_stream.name, self.path)
+        self.assertEqual(b''.join(response.streaming_content), self.content)
+
+        # ranges are sent by python
+        response = self._request('sendfile', HTTP_RANGE='bytes=0-9')
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(b''.join(response.streaming_content), self.content[:10])
+
+    def test_x_accel_redirect(self):
+        response = self._request('x-accel-redirect')
+        self.assertEqual(response['X-Accel-Redirect'], '/protected-storage/{}/{}'.format(self.oid[-2:], self.oid))
+        self.assertEqual(response.content, b'')
+        self.assertEqual(response['Content-Disposition'], 'attachment; filename=test.bin')
+
+    def test_x_accel_redirect_encoded(self):
+        # compressed file sent as stored (with Content-Encoding) isn't handed to nginx
+        data = b''.join(b'line %d\n' % i for i in range(200))
+        self.storage.compress = 'gzip'
+        content = ContentFile(data)
+        content.content_type = 'text/csv'
+        self.oid = self.storage.save('lines.csv', content)
+        self.addCleanup(self.storage.delete, self.oid)
+
+        response = self._request('x-accel-redirect', HTTP_ACCEPT_ENCODING='gzip')
+        self.assertFalse(response.has_header('X-Accel-Redirect'))
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertEqual(gzip.decompress(response.content), data)
+
+        response = self._request('sendfile', HTTP_ACCEPT_ENCODING='gzip')
+        self.assertEqual(response.file_to_stream.name, self.storage.local_cache.path(self.oid))
+        self.assertEqual(gzip.decompress(b''.join(response.streaming_content)), data)
+
+    def test_x_sendfile(self):
+        response = self._request('x-sendfile')
+        self.assertEqual(response['X-Sendfile'], self.path)
+        self.assertEqual(response.content, b'')
+
+    def test_not_cached(self):
+        # too big for the cache, sent by python
+        content = os.urandom(4000)
+        self.oid = self.storage.save('big.bin', ContentFile(content))
+        self.addCleanup(self.storage.delete, self.oid)
+
+        response = self._request('x-sendfile')
+        self.assertFalse(response.has_header('X-Sendfile'))
+        self.assertEqual(b''.join(response.streaming_content), content)
+
+    def test_evicted(self):
+        # file removed from the cache after it was opened
+        with mock.patch('django_mongo_storage.views.open', side_effect=FileNotFoundError, create=True):
+            response = self._request('sendfile')
+        self.assertEqual(b''.join(response.streaming_content), self.content)
+
+
+class LocalCacheFillTest(TestCase):
+
+    def setUp(self):
+        self.location = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.location)
+        self.storage = MongoStorage('Test', 'test', chunk_size=1000, local_cache_dir=self.location)
+        self.content = os.urandom(2500)
+        self.oid = self.storage.save('test.bin', ContentFile(self.content))
+        self.addCleanup(self.storage.delete, self.oid)
+        self.path = self.storage.local_cache.path(self.oid)
+        self.user = User.objects.create_superuser('admin', 'admin@example.com', 'password')
+        self.factory = RequestFactory()
+
+        field = Document._meta.get_field('myfile')
+        patcher = mock.patch.object(field, 'storage', self.storage)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = mock.patch('django_mongo_storage.views.registry.get_field', return_value=field)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _request(self, **kwargs):
+        request = self.factory.get('/', **kwargs)
+        request.user = self.user
+        response = views.view_file(request, 'tests', 'document', 1, self.oid)
+        self.addCleanup(response.close)
+        return response
+
+    def test_filled_while_streamed(self):
+        response = self._request()
+        # response doesn't wait for the file to be cached
+        self.assertFalse(os.path.exists(self.path))
+        self.assertEqual(b''.join(response.streaming_content), self.content)
+        self.assertTrue(os.path.exists(self.path))
+
+    def test_not_modified(self):
+        etag = self._request()['ETag']
+
+        with mock.patch.object(self.storage, 'get_file') as get_file:
+            response = self._request(HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        get_file.assert_not_called()
+        self.assertFalse(os.path.exists(self.path))
+
+    def test_range(self):
+        response = self._request(HTTP_RANGE='bytes=0-0')
+        self.assertEqual(b''.join(response.streaming_content), self.content[:1])
+        # nothing is left in the cache directory
+        self.assertEqual([files for _, _, files in os.walk(self.location) if files], [])
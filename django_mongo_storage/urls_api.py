@@ -1,6 +1,12 @@
-from django.conf.urls import url
+from django.urls import re_path
+from . import views
 
 
 urlpatterns = [
-
-]
\ No newline at end of file
+    # resumable uploads (tus protocol)
+    re_path(r'^uploads/(?P<app_label>\w+)/(?P<model_name>\w+)/(?P<pk>[^/]+)/(?P<field_name>\w+)/$',
+            views.create_upload, name='create_upload'),
+    re_path(r'^uploads/(?P<app_label>\w+)/(?P<model_name>\w+)/(?P<pk>[^/]+)/(?P<field_name>\w+)/'
+            r'(?P<upload_id>[0-9a-f]{24})/$',
+            views.upload, name='upload'),
+]
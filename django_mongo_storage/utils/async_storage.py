@@ -0,0 +1,299 @@
+import asyncio
+import logging
+import os
+import weakref
+
+from bson import ObjectId
+
+from django.core.exceptions import ImproperlyConfigured
+
+from gridfs.errors import NoFile
+from pymongo import ReadPreference, ReturnDocument
+from pymongo.errors import DuplicateKeyError
+
+from django_mongo_storage.utils.compression import get_decompressor, should_compress, DecompressingFile
+from django_mongo_storage.utils.http import iter_range
+from django_mongo_storage.utils.inline import InlineFile
+from django_mongo_storage.utils.connection import get_connection_settings
+from django_mongo_storage.utils.storage import METADATA_FIELDS
+from django_mongo_storage.utils.writer import GridFSBatchWriter
+
+try:
+    from pymongo import AsyncMongoClient
+    from gridfs import AsyncGridOut
+except ImportError:
+    # pymongo < 4.10, no native asyncio API
+    AsyncMongoClient = None
+
+logger = logging.getLogger(__name__)
+
+# async clients per event loop and db alias, clients can't be shared between loops,
+# clients of closed (garbage collected) loops are dropped with them
+_clients = weakref.WeakKeyDictionary()
+
+# clients of the parent process are not used after fork
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_clients.clear)
+
+
+def get_async_db(alias, read_preference=None):
+    if AsyncMongoClient is None:
+        raise ImproperlyConfigured('AsyncMongoStorage requires pymongo with asyncio API (pymongo>=4.10).')
+
+    clients = _clients.setdefault(asyncio.get_running_loop(), {})
+    if alias not in clients:
+        name, kwargs = get_connection_settings(alias)
+        clients[alias] = (name, AsyncMongoClient(**kwargs))
+    name, client = clients[alias]
+    return client.get_database(name, read_preference=read_preference)
+
+
+class _AsyncBatchWriter(GridFSBatchWriter):
+    """
+    GridFSBatchWriter writing with async collections, chunks and file document are built the same way
+    (compression, sha256, inline content), complete batches are inserted by insert_ready().
+    """
+    def __init__(self, db, collection, **kwargs):
+        super(_AsyncBatchWriter, self).__init__(db, collection, **kwargs)
+        self._ready = []
+
+    def _flush(self):
+        batch, self._batch = self._batch, []
+        if batch:
+            self._ready.append(batch)
+
+    def _wait(self):
+        pass
+
+    async def insert_ready(self):
+        ready, self._ready = self._ready, []
+        for batch in ready:
+            await self.chunks.insert_many(batch)
+
+    async def close(self):
+        if self._closed:
+            return self._id
+
+        document = self._finish()
+        self._flush()
+        await self.insert_ready()
+        await self.files.insert_one(document)
+        self._closed = True
+        return self._id
+
+    async def abort(self):
+        self._batch, self._ready = [], []
+        await self.chunks.delete_many({'files_id': self._id})
+        self._closed = True
+
+
+class AsyncMongoStorage(object):
+    """
+    Asyncio counterpart of MongoStorage, for ASGI views.
+    Shares configuration and metadata cache with MongoStorage it is created for.
+    Use case:
+        storage = TestModel._meta.get_field('file').storage
+        async_storage = storage.async_storage
+
+        oid = await async_storage.save('test.txt', content)
+        async for chunk in async_storage.iter_chunks(oid):
+            ...
+    """
+    def __init__(self, storage):
+        self.storage = storage
+
+    @property
+    def db(self):
+        return get_async_db(self.storage.db_alias, read_preference=self.storage._read_preference)
+
+    @property
+    def primary_db(self):
+        return get_async_db(self.storage.db_alias, read_preference=ReadPreference.PRIMARY)
+
+    def _root_collection(self, oid=None):
+        # just written files are read from primary (read-your-writes)
+        if oid is None or self.storage._is_recently_written(oid):
+            return self.primary_db[self.storage.collection]
+        return self.db[self.storage.collection]
+
+    async def get_metadata(self, oid):
+        """
+            Get fs.files document of the file, served from cache of the storage if possible.
+        :param oid: ObjectID in string
+        :return: dict or None if file doesn't exist
+        """
+        oid = str(oid)
+        document = self.storage._metadata_cache.get(oid)
+        if document is None:
+            document = await self._root_collection(oid).files.find_one({'_id': ObjectId(oid)}, METADATA_FIELDS)
+            if document is None and self.storage._reads_secondaries and not self.storage._is_recently_written(oid):
+                # written by another process, not replicated to secondaries yet
+                document = await self._root_collection().files.find_one({'_id': ObjectId(oid)}, METADATA_FIELDS)
+                if document is not None:
+                    self.storage._mark_written(oid)
+            if document is not None:
+                self.storage._metadata_cache.set(oid, document)
+        return document
+
+    async def _get_existing_metadata(self, oid):
+        document = await self.get_metadata(oid)
+        if document is None:
+            raise NoFile("no file in gridfs collection {} with _id {}".format(self.storage.collection, oid))
+        return document
+
+    async def exists(self, oid):
+        return await self.get_metadata(oid) is not None
+
+    async def size(self, oid):
+        document = await self._get_existing_metadata(oid)
+        return document.get('uncompressedLength', document['length'])
+
+    async def get_file_name(self, oid):
+        return (await self._get_existing_metadata(oid))['filename']
+
+    async def open(self, oid):
+        """
+            Get file from GridFS, metadata comes from cache if possible so only chunks are queried on read.
+        :param oid: ObjectID in string
+        :return: AsyncGridOut (has async read(), readchunk(), seek() and async iteration over chunks)
+            or InlineFile (sync methods) for inline files
+        """
+        document = await self._get_existing_metadata(oid)
+        if document.get('inline'):
+            # content isn't cached with metadata
+            document = await self._root_collection(oid).files.find_one({'_id': ObjectId(oid)})
+            if document is None:
+                raise NoFile("no file in gridfs collection {} with _id {}".format(self.storage.collection, oid))
+            return InlineFile(document)
+        grid_out = AsyncGridOut(self._root_collection(oid), file_document=document)
+        await grid_out.open()
+        return grid_out
+
+    async def iter_chunks(self, oid, start=0, end=None, decompress=True):
+        """
+            Iterate over content of the file (or bytes [start, end], end inclusive).
+        :param oid: ObjectID in string
+        :param decompress: if False compressed files are returned as stored (compressed),
+            otherwise positions refer to decompressed content
+        """
+        grid_out = await self.open(oid)
+        compression = getattr(grid_out, 'compression', None)
+        if isinstance(grid_out, InlineFile):
+            # content was fetched with the document
+            if compression and decompress:
+                grid_out = DecompressingFile(grid_out, compression, grid_out.uncompressedLength)
+            for data in iter_range(grid_out, start, grid_out.length - 1 if end is None else end):
+                yield data
+            return
+        if compression and decompress:
+            async for data in self._iter_decompressed(grid_out, compression, start, end):
+                yield data
+            return
+
+        end = grid_out.length - 1 if end is None else end
+        grid_out.seek(start)
+        remaining = end - start + 1
+        while remaining > 0:
+            data = await grid_out.readchunk()
+            if not data:
+                break
+            data = data[:remaining]
+            remaining -= len(data)
+            yield data
+
+    async def _iter_decompressed(self, grid_out, compression, start, end):
+        decompressor = get_decompressor(compression)
+        position = 0
+        while end is None or position <= end:
+            raw = await grid_out.readchunk()
+            if not raw:
+                break
+            data = decompressor.decompress(raw)
+            first, position = position, position + len(data)
+            # cut decompressed data to the requested range
+            data = data[max(start - first, 0):(end + 1 - first if end is not None else None)]
+            if data:
+                yield data
+
+    async def _reference_existing(self, digest):
+        # see MongoStorage._reference_existing
+        document = await self.primary_db['{}.files'.format(self.storage.collection)].find_one_and_update(
+            {'sha256': digest, 'refcount': {'$gte': 0}}, {'$inc': {'refcount': 1}}, projection={'_id': 1}
+        )
+        return document['_id'] if document else None
+
+    async def save(self, name, content):
+        """
+            Stream content of django File to GridFS, stored the same way as by MongoStorage.save
+            (chunk size, batches of chunks, compression, deduplication, inline content).
+        :param name: String, filename (can be path, only basename is stored)
+        :param content: django File (with chunks() method)
+        :return: ObjectID in string of the file created in GridFS
+        """
+        storage = self.storage
+        if not storage._indexes_ensured:
+            # once per storage, unique sha256 index is required by deduplication
+            await asyncio.get_running_loop().run_in_executor(None, storage._ensure_indexes)
+
+        kwargs = storage._get_file_kwargs(content)
+        if storage.deduplicate:
+            # content hashed before upload, so known content is not written at all
+            digest = storage._hash_content(content)
+            oid = await self._reference_existing(digest) if digest else None
+            if oid is not None:
+                storage._mark_written(oid)
+                return str(oid)
+            kwargs.update(refcount=1)
+
+        compression = None
+        if storage.compress and should_compress(kwargs.get('content_type'), storage.compress_skip_types):
+            compression = storage.compress
+
+        writer = _AsyncBatchWriter(self.primary_db, storage.collection, chunk_size=storage.chunk_size,
+                                   batch_size=storage.write_batch_size, sha256=storage.deduplicate,
+                                   compression=compression, inline_threshold=storage.inline_threshold,
+                                   filename=os.path.basename(name), **kwargs)
+        try:
+            for chunk in storage._iter_content(content):
+                writer.write(chunk)
+                await writer.insert_ready()
+            oid = await writer.close()
+        except DuplicateKeyError:
+            # the same content was stored concurrently, use it
+            await writer.abort()
+            oid = await self._reference_existing(writer.sha256) if storage.deduplicate else None
+            if oid is None:
+                raise
+        except Exception:
+            await writer.abort()
+            raise
+        storage._mark_written(oid)
+        return str(oid)
+
+    async def delete(self, oid):
+        oid = ObjectId(oid)
+        db = self.primary_db
+        files = db['{}.files'.format(self.storage.collection)]
+        query = {'_id': oid}
+        if self.storage.deduplicate:
+            # deduplicated file, remove only the last reference (see MongoStorage.delete)
+            document = await files.find_one_and_update(
+                {'_id': oid, 'refcount': {'$exists': True}}, {'$inc': {'refcount': -1}},
+                projection={'refcount': 1}, return_document=ReturnDocument.AFTER
+            )
+            if document is not None:
+                if document['refcount'] > 0:
+                    return
+                # file referenced again in the meantime is kept (see MongoStorage._reference_existing)
+                query['refcount'] = {'$lte': 0}
+
+        result = await files.delete_one(query)
+        if 'refcount' in query and not result.deleted_count:
+            return
+        await db['{}.chunks'.format(self.storage.collection)].delete_many({'files_id': oid})
+        self.storage._metadata_cache.delete(str(oid))
+
+        # derivatives (thumbnails) of the file
+        async for document in files.find({'source_id': oid}, {'derivative': 1}):
+            await self.delete(document['_id'])
+            self.storage._derivative_cache.delete('{}:{}'.format(oid, document['derivative']))
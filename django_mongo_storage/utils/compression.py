@@ -0,0 +1,190 @@
+import io
+import zlib
+
+from django.core.exceptions import ImproperlyConfigured
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+CODECS = ('gzip', 'zstd')
+
+# content types not worth compressing (already compressed formats)
+DEFAULT_SKIP_TYPES = (
+    'image/', 'video/', 'audio/', 'font/woff',
+    'application/zip', 'application/gzip', 'application/x-gzip', 'application/x-bzip2', 'application/x-xz',
+    'application/x-7z-compressed', 'application/x-rar-compressed', 'application/zstd', 'application/pdf',
+    'application/vnd.openxmlformats-officedocument', 'application/vnd.oasis.opendocument',
+)
+
+
+def should_compress(content_type, skip_types=DEFAULT_SKIP_TYPES):
+    """
+        Check if content of given type should be compressed.
+    :param content_type: String or None
+    :param skip_types: prefixes of content types which are not compressed
+    """
+    content_type = (content_type or '').lower()
+    return not any(content_type.startswith(skip_type) for skip_type in skip_types)
+
+
+def _check_codec(codec):
+    if codec not in CODECS:
+        raise ImproperlyConfigured('Unknown compression codec {}, use one of: {}.'.format(codec, ', '.join(CODECS)))
+    if codec == 'zstd' and zstandard is None:
+        raise ImproperlyConfigured('zstd compression requires zstandard package.')
+
+
+def get_compressor(codec):
+    """
+        Get streaming compressor (with compress(data) and flush() methods).
+    """
+    _check_codec(codec)
+    if codec == 'gzip':
+        # wbits=31 - gzip container, so stored bytes can be served with Content-Encoding: gzip
+        return zlib.compressobj(6, zlib.DEFLATED, 31)
+    return zstandard.ZstdCompressor().compressobj()
+
+
+def get_decompressor(codec):
+    """
+        Get streaming decompressor (with decompress(data) method).
+    """
+    _check_codec(codec)
+    if codec == 'gzip':
+        return zlib.decompressobj(31)
+    return zstandard.ZstdDecompressor().decompressobj()
+
+
+def accepts_encoding(request, codec):
+    """
+        Check if client accepts content encoded with given codec (Accept-Encoding header).
+    """
+    qualities = {}
+    for encoding in request.META.get('HTTP_ACCEPT_ENCODING', '').split(','):
+        name, _, params = encoding.strip().partition(';')
+        qualities[name.strip().lower()] = _quality(params)
+    # codec named explicitly (ex. gzip;q=0) takes precedence over *
+    return qualities.get(codec, qualities.get('*', 0)) > 0
+
+
+def _quality(params):
+    for param in params.split(';'):
+        key, _, value = param.partition('=')
+        if key.strip().lower() == 'q':
+            try:
+                return float(value)
+            except ValueError:
+                return 0
+    return 1
+
+
+class DecompressingFile(io.RawIOBase):
+    """
+    Wrapper of compressed GridFS file (GridOut or ReadAheadGridOut) returning decompressed content.
+    Attributes of the file are available as usual, length is the length of decompressed content,
+    raw is the wrapped file (compressed content).
+
+        NOTE: seek() backwards decompresses content from the beginning. Content is skipped on the next
+        read, so seeking to the end and back (ex. to get the size) doesn't read anything.
+    """
+    def __init__(self, raw, codec, length):
+        self.raw = raw
+        self.codec = codec
+        self._length = length
+
+        self._position = 0
+        self._seek_position = None
+        self._raw_chunks = None
+        self._decompressor = None
+        self._buffer = b''
+
+    def __getattr__(self, name):
+        if name == 'raw':
+            raise AttributeError(name)
+        return getattr(self.raw, name)
+
+    @property
+    def length(self):
+        return self._length
+
+    def _restart(self):
+        self.raw.seek(0)
+        self._raw_chunks = iter(lambda: self.raw.read(256 * 1024), b'')
+        self._decompressor = get_decompressor(self.codec)
+        self._buffer = b''
+        self._position = 0
+
+    def _next_data(self):
+        for data in self._raw_chunks:
+            data = self._decompressor.decompress(data)
+            if data:
+                return data
+        return b''
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._position if self._seek_position is None else self._seek_position
+
+    def seek(self, pos, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            pos += self.tell()
+        elif whence == io.SEEK_END:
+            pos += self._length
+        if pos < 0:
+            raise IOError('Invalid position')
+        self._seek_position = pos
+        return pos
+
+    def _skip_to(self, pos):
+        if self._raw_chunks is None or pos < self._position:
+            self._restart()
+        # skip decompressed content up to the position
+        while self._position < pos:
+            if not self._read(min(pos - self._position, 256 * 1024)):
+                break
+
+    def read(self, size=-1):
+        if self._seek_position is not None:
+            pos, self._seek_position = self._seek_position, None
+            self._skip_to(pos)
+        return self._read(size)
+
+    def _read(self, size=-1):
+        if self._raw_chunks is None:
+            self._restart()
+
+        parts = [self._buffer]
+        available = len(self._buffer)
+        while size is None or size < 0 or available < size:
+            data = self._next_data()
+            if not data:
+                break
+            parts.append(data)
+            available += len(data)
+
+        data = b''.join(parts)
+        if size is not None and size >= 0:
+            data, self._buffer = data[:size], data[size:]
+        else:
+            self._buffer = b''
+        self._position += len(data)
+        return data
+
+    def __iter__(self):
+        while True:
+            data = self.read(256 * 1024)
+            if not data:
+                break
+            yield data
+
+    def close(self):
+        self.raw.close()
+        super(DecompressingFile, self).close()
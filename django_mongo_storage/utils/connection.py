@@ -0,0 +1,179 @@
+import os
+import threading
+
+from django.conf import settings as django_settings
+from django.core.exceptions import ImproperlyConfigured
+
+from gridfs import GridFS
+from mongoengine import connection as mongoengine_connection
+from pymongo import MongoClient
+from pymongo.read_preferences import Primary, PrimaryPreferred, Secondary, SecondaryPreferred, Nearest
+
+from django_mongo_storage.utils.instrumentation import round_trip_listener
+
+
+# mongoengine specific connection settings, not accepted by MongoClient
+IGNORED_SETTINGS = ('name', 'username', 'password', 'authentication_source', 'authentication_mechanism',
+                    'authmechanismproperties', 'mongo_client_class')
+RENAMED_SETTINGS = {
+    'authentication_source': 'authSource',
+    'authentication_mechanism': 'authMechanism',
+    'authmechanismproperties': 'authMechanismProperties',
+}
+
+# django settings of connection pools of storage clients -> MongoClient kwargs
+POOL_SETTINGS = {
+    'STORAGE_MAX_POOL_SIZE': 'maxPoolSize',
+    'STORAGE_MIN_POOL_SIZE': 'minPoolSize',
+    'STORAGE_MAX_IDLE_TIME_MS': 'maxIdleTimeMS',
+    'STORAGE_WAIT_QUEUE_TIMEOUT_MS': 'waitQueueTimeoutMS',
+    'STORAGE_CONNECT_TIMEOUT_MS': 'connectTimeoutMS',
+    'STORAGE_SOCKET_TIMEOUT_MS': 'socketTimeoutMS',
+    'STORAGE_SERVER_SELECTION_TIMEOUT_MS': 'serverSelectionTimeoutMS',
+}
+
+
+READ_PREFERENCES = {
+    'primary': Primary,
+    'primaryPreferred': PrimaryPreferred,
+    'secondary': Secondary,
+    'secondaryPreferred': SecondaryPreferred,
+    'nearest': Nearest,
+}
+
+
+def get_read_preference(mode, tag_sets=None, max_staleness=-1):
+    """
+        Get read preference of given mode.
+    :param mode: name of the mode (ex. 'secondaryPreferred'), read preference object or None
+    :param tag_sets: list of dicts, tags of members to read from (not for primary)
+    :param max_staleness: max replication lag of secondaries in seconds, -1 no limit (not for primary)
+    :return: read preference or None if mode is None (read preference of the connection is used)
+    """
+    if mode is None or not isinstance(mode, str):
+        return mode
+    try:
+        read_preference_class = READ_PREFERENCES[mode]
+    except KeyError:
+        raise ImproperlyConfigured('Unknown read preference {}, use one of: {}.'.format(
+            mode, ', '.join(READ_PREFERENCES)))
+    if read_preference_class is Primary:
+        return Primary()
+    return read_preference_class(tag_sets=tag_sets, max_staleness=max_staleness)
+
+
+def _get_alias_settings(alias):
+    try:
+        return mongoengine_connection._connection_settings[alias]
+    except KeyError:
+        raise mongoengine_connection.ConnectionFailure('Connection with alias "{}" has not been defined'.format(alias))
+
+
+def get_connection_settings(alias):
+    """
+        Get settings of connection registered in mongoengine (mongoengine.connect/register_connection)
+        to create another client (ex. async) connected to the same database.
+        Pool settings (settings.STORAGE_MAX_POOL_SIZE, etc., see POOL_SETTINGS) are added if set.
+    :param alias: String, mongoengine db alias
+    :return: tuple (database name, dict of MongoClient kwargs)
+    """
+    settings = _get_alias_settings(alias)
+
+    kwargs = {}
+    for key, value in settings.items():
+        if value is None:
+            continue
+        if key in RENAMED_SETTINGS:
+            kwargs[RENAMED_SETTINGS[key]] = value
+        elif key not in IGNORED_SETTINGS:
+            kwargs[key] = value
+
+    if settings.get('username'):
+        kwargs.update(username=settings['username'], password=settings.get('password'))
+
+    for setting, option in POOL_SETTINGS.items():
+        value = getattr(django_settings, setting, None)
+        if value is not None:
+            kwargs[option] = value
+
+    return settings['name'], kwargs
+
+
+class ConnectionRegistry(object):
+    """
+    Process-wide clients of the storages, one client per db alias and one Database/GridFS object
+    per (alias, collection, read preference), shared by all MongoStorage instances.
+    Clients are not fork-safe, so everything is dropped in a child process after os.fork
+    (ex. gunicorn --preload) and created again on first use.
+    Commands sent by the clients are counted in storage operations (see instrumentation.RoundTripListener).
+    """
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._reset()
+
+    def _reset(self):
+        self._pid = os.getpid()
+        self._clients = {}
+        self._handles = {}
+
+    def _check_fork(self):
+        # fallback for forks not going through os.fork (register_at_fork hook)
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._reset()
+
+    def _get(self, key, factory):
+        self._check_fork()
+        handle = self._handles.get(key)
+        if handle is None:
+            with self._lock:
+                handle = self._handles.get(key)
+                if handle is None:
+                    handle = self._handles[key] = factory()
+        return handle
+
+    def get_client(self, alias):
+        self._check_fork()
+        client = self._clients.get(alias)
+        if client is None:
+            with self._lock:
+                client = self._clients.get(alias)
+                if client is None:
+                    name, kwargs = get_connection_settings(alias)
+                    client_class = _get_alias_settings(alias).get('mongo_client_class') or MongoClient
+                    kwargs['event_listeners'] = list(kwargs.get('event_listeners', ())) + [round_trip_listener]
+                    client = self._clients[alias] = client_class(**kwargs)
+        return client
+
+    def get_database(self, alias, read_preference=None):
+        def factory():
+            name, _ = get_connection_settings(alias)
+            return self.get_client(alias).get_database(name, read_preference=read_preference)
+        return self._get(('db', alias, _read_preference_key(read_preference)), factory)
+
+    def get_gridfs(self, alias, collection, read_preference=None):
+        def factory():
+            return GridFS(self.get_database(alias, read_preference), collection)
+        return self._get(('fs', alias, collection, _read_preference_key(read_preference)), factory)
+
+    def _after_fork(self):
+        # lock could be held by another thread of the parent at the time of fork
+        self._lock = threading.RLock()
+        self._reset()
+
+    def clear(self):
+        with self._lock:
+            for client in self._clients.values():
+                client.close()
+            self._reset()
+
+
+def _read_preference_key(read_preference):
+    return None if read_preference is None else repr(read_preference.document)
+
+
+connections = ConnectionRegistry()
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=connections._after_fork)
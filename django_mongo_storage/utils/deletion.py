@@ -0,0 +1,87 @@
+import logging
+import threading
+import weakref
+
+from django.db import connections, transaction, DEFAULT_DB_ALIAS
+
+logger = logging.getLogger(__name__)
+
+# deletion batches of current thread per database alias
+_local = threading.local()
+
+
+class DeletionBatch(object):
+    """
+    Files to be deleted after commit of the transaction, flushed with MongoStorage.delete_many
+    (a few queries per collection instead of a few queries per file).
+    Every file is added to the batch by its own on_commit callback, so files deleted in a rolled back
+    transaction or savepoint are not deleted (Django drops their callbacks). The last callback run
+    on commit flushes the batch.
+    """
+    def __init__(self, using):
+        self.using = using
+        self.files = {}
+        # registered callbacks, callbacks dropped by rollback are released and disappear from the set
+        self._callbacks = weakref.WeakSet()
+
+    def register(self, storage, oid):
+        callback = _DeleteCallback(self, storage, oid)
+        self._callbacks.add(callback)
+        transaction.on_commit(callback, using=self.using)
+
+    def is_pending(self):
+        return any(not callback.done for callback in self._callbacks)
+
+    def add(self, storage, oid):
+        key = (storage.db_alias, storage.collection)
+        storage, oids = self.files.setdefault(key, (storage, []))
+        oids.append(oid)
+
+    def flush(self):
+        files, self.files = self.files, {}
+        for storage, oids in files.values():
+            try:
+                storage.delete_many(oids)
+                logger.debug("Deleted {} files from {} collection.".format(len(oids), storage.collection))
+            except Exception:
+                # transaction is already committed, orphaned files are left for garbage collection
+                logger.exception("Can't delete mongo files from {} collection".format(storage.collection))
+
+
+class _DeleteCallback(object):
+
+    def __init__(self, batch, storage, oid):
+        self.batch = batch
+        self.storage = storage
+        self.oid = oid
+        self.done = False
+
+    def __call__(self):
+        self.done = True
+        self.batch.add(self.storage, self.oid)
+        if not self.batch.is_pending():
+            self.batch.flush()
+
+
+def _get_batch(using):
+    batches = _local.__dict__.setdefault('batches', {})
+    batch = batches.get(using)
+    if batch is None:
+        batch = batches[using] = DeletionBatch(using)
+    return batch
+
+
+def delete_on_commit(storage, oid, using=None):
+    """
+        Delete file after commit of current transaction, files deleted in one transaction
+        are deleted together (see DeletionBatch). Outside of transaction the file is deleted immediately.
+    :param storage: MongoStorage
+    :param oid: ObjectID in string
+    :param using: database alias of the transaction
+    """
+    using = using or DEFAULT_DB_ALIAS
+    if not connections[using].in_atomic_block:
+        storage.delete(oid)
+        return
+
+    _get_batch(using).register(storage, oid)
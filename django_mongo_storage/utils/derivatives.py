@@ -0,0 +1,57 @@
+import io
+import os
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    Image = None
+
+from django.core.exceptions import ImproperlyConfigured
+
+# errors of rendering derivative of not readable image (UnidentifiedImageError is OSError)
+RENDER_ERRORS = (OSError, Image.DecompressionBombError) if Image else (OSError,)
+
+
+def render_derivative(source, spec):
+    """
+        Render derivative (thumbnail) of the image.
+        Spec is a dict with keys:
+            size - (width, height) the image is fitted into
+            crop - if True the image is cropped to exactly size, otherwise aspect ratio is kept (default False)
+            format - Pillow format name, ex. 'JPEG', 'WEBP' (default format of the source)
+            quality - quality of lossy formats (default 85)
+    :param source: file with the image (read() and seek())
+    :param spec: dict
+    :return: tuple (bytes, content type, width, height)
+    """
+    if Image is None:
+        raise ImproperlyConfigured('Derivatives of images require Pillow package.')
+
+    image = Image.open(source)
+    image_format = (spec.get('format') or image.format or 'PNG').upper()
+    # rotate photos according to EXIF, derivatives lose EXIF
+    image = ImageOps.exif_transpose(image)
+
+    size = tuple(spec['size'])
+    if spec.get('crop'):
+        image = ImageOps.fit(image, size, Image.LANCZOS)
+    else:
+        image.thumbnail(size, Image.LANCZOS)
+
+    if image_format == 'JPEG' and image.mode not in ('RGB', 'L'):
+        image = image.convert('RGB')
+
+    buffer = io.BytesIO()
+    image.save(buffer, image_format, quality=spec.get('quality', 85))
+    content_type = Image.MIME.get(image_format, 'application/octet-stream')
+    return buffer.getvalue(), content_type, image.width, image.height
+
+
+def derivative_filename(filename, name, content_type):
+    """
+        Name of derivative file, ex. photo.png -> photo_thumbnail.jpg for thumbnail in JPEG.
+    """
+    base, extension = os.path.splitext(filename)
+    if content_type and '/' in content_type:
+        extension = '.' + content_type.split('/')[-1].replace('jpeg', 'jpg')
+    return '{}_{}{}'.format(base, name, extension)
@@ -0,0 +1,334 @@
+import io
+import logging
+import mmap
+import os
+import tempfile
+import threading
+
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+# GridOut attribute names of fs.files document fields
+GRID_OUT_ATTRIBUTES = {
+    'content_type': 'contentType',
+    'upload_date': 'uploadDate',
+    'chunk_size': 'chunkSize',
+}
+# attributes of GridOut which are None if the document doesn't have them
+GRID_OUT_OPTIONAL = ('filename', 'content_type', 'md5', 'upload_date', 'metadata', 'aliases')
+
+
+class DiskCache(object):
+    """
+    Local (per node) cache of GridFS files content, keyed by ObjectID.
+    Files are kept in location directory, least recently used ones are removed
+    when total size of cached files exceeds max_bytes.
+    Use case:
+        cache = get_disk_cache('/var/cache/mongo-storage', 10 * 1024 ** 3)
+        path = cache.get(oid)
+        if path is None:
+            path = cache.fill(oid, grid_out)  # or read FillingFile(cache, grid_out) to the end
+
+        NOTE: every process keeps its own LRU index, built from the directory on first use,
+        file removed by another process is just a cache miss.
+    """
+    def __init__(self, location, max_bytes):
+        self.location = location
+        self.max_bytes = max_bytes
+
+        self._index = None
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def path(self, oid):
+        oid = str(oid)
+        return os.path.join(self.location, oid[-2:], oid)
+
+    def _load_index(self):
+        entries = []
+        for root, dirs, files in os.walk(self.location):
+            for name in files:
+                if name.startswith('.'):
+                    continue
+                try:
+                    stat = os.stat(os.path.join(root, name))
+                except OSError:
+                    continue
+                entries.append((stat.st_atime, name, stat.st_size))
+
+        self._index = OrderedDict((name, size) for _, name, size in sorted(entries))
+        self._size = sum(self._index.values())
+
+    def _ensure_index(self):
+        if self._index is None:
+            self._load_index()
+
+    def get(self, oid):
+        """
+            Get path of cached file.
+        :return: String or None if file is not cached
+        """
+        oid = str(oid)
+        path = self.path(oid)
+        with self._lock:
+            self._ensure_index()
+            if not os.path.exists(path):
+                if oid in self._index:
+                    self._size -= self._index.pop(oid)
+                return None
+            if oid in self._index:
+                self._index.move_to_end(oid)
+            else:
+                # cached by another process
+                size = os.path.getsize(path)
+                self._index[oid] = size
+                self._size += size
+        return path
+
+    def fill(self, oid, chunks):
+        """
+            Write content to the cache, streaming it chunk by chunk.
+        :param oid: ObjectID in string
+        :param chunks: iterable of bytes (ex. GridOut)
+        :return: path of cached file
+        """
+        oid = str(oid)
+        path = self.path(oid)
+        directory = os.path.dirname(path)
+        os.makedirs(directory, exist_ok=True)
+
+        # write to temporary file and move it, so partially written file is never visible
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.')
+        size = 0
+        try:
+            with os.fdopen(fd, 'wb') as file:
+                for chunk in chunks:
+                    file.write(chunk)
+                    size += len(chunk)
+        except Exception:
+            os.remove(tmp_path)
+            raise
+        return self._publish(oid, tmp_path, size)
+
+    def _publish(self, oid, tmp_path, size):
+        path = self.path(oid)
+        os.replace(tmp_path, path)
+        with self._lock:
+            self._ensure_index()
+            self._size += size - self._index.pop(oid, 0)
+            self._index[oid] = size
+            self._evict()
+        return path
+
+    def _evict(self):
+        while self._size > self.max_bytes and self._index:
+            oid, size = self._index.popitem(last=False)
+            self._size -= size
+            try:
+                os.remove(self.path(oid))
+            except OSError:
+                pass
+
+    def discard(self, oid):
+        oid = str(oid)
+        with self._lock:
+            self._ensure_index()
+            self._size -= self._index.pop(oid, 0)
+        try:
+            os.remove(self.path(oid))
+        except OSError:
+            pass
+
+
+# one cache per directory in the process, shared by storages
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+def get_disk_cache(location, max_bytes):
+    with _caches_lock:
+        cache = _caches.get(location)
+        if cache is None:
+            cache = _caches[location] = DiskCache(location, max_bytes)
+        cache.max_bytes = max(cache.max_bytes, max_bytes)
+    return cache
+
+
+def _after_fork():
+    # locks could be held by other threads of the parent at the time of fork
+    global _caches_lock
+    _caches_lock = threading.Lock()
+    for cache in _caches.values():
+        cache._lock = threading.Lock()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_after_fork)
+
+
+class FillingFile(io.RawIOBase):
+    """
+    Wrapper of GridFS file (GridOut or ReadAheadGridOut) not cached yet, writing its content to the cache
+    while it's read, so the file is cached by the response streaming it, without reading it twice.
+    The file is cached when it's read from the beginning to the end, filling is abandoned when content
+    is read from other position (ex. range requests) or the file is closed before the end.
+    """
+    def __init__(self, cache, mongo_file):
+        self.cache = cache
+        self.mongo_file = mongo_file
+
+        self._tmp_file = None
+        self._tmp_path = None
+        self._written = 0
+        self._filling = True
+
+    def __getattr__(self, name):
+        # GridOut attributes (filename, length, content_type...)
+        if name == 'mongo_file':
+            raise AttributeError(name)
+        return getattr(self.mongo_file, name)
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.mongo_file.tell()
+
+    def seek(self, pos, whence=io.SEEK_SET):
+        return self.mongo_file.seek(pos, whence)
+
+    def read(self, size=-1):
+        position = self.mongo_file.tell()
+        data = self.mongo_file.read(size)
+        if self._filling:
+            if position == self._written:
+                self._write(data)
+            else:
+                self._abandon()
+        return data
+
+    def _write(self, data):
+        try:
+            if self._tmp_file is None:
+                directory = os.path.dirname(self.cache.path(self._id))
+                os.makedirs(directory, exist_ok=True)
+                fd, self._tmp_path = tempfile.mkstemp(dir=directory, prefix='.')
+                self._tmp_file = os.fdopen(fd, 'wb')
+            self._tmp_file.write(data)
+            self._written += len(data)
+            if self._written >= self.mongo_file.length:
+                self._tmp_file.close()
+                self._tmp_file = None
+                self.cache._publish(str(self._id), self._tmp_path, self._written)
+                self._tmp_path = None
+                self._filling = False
+        except OSError:
+            # the file is still read from GridFS, it's just not cached
+            logger.exception("Can't write file {} to local cache".format(self._id))
+            self._abandon()
+
+    def _abandon(self):
+        self._filling = False
+        if self._tmp_file is not None:
+            self._tmp_file.close()
+            self._tmp_file = None
+        if self._tmp_path is not None:
+            try:
+                os.remove(self._tmp_path)
+            except OSError:
+                pass
+            self._tmp_path = None
+
+    def readchunk(self):
+        return self.read(self.mongo_file.chunk_size)
+
+    def __iter__(self):
+        while True:
+            data = self.readchunk()
+            if not data:
+                break
+            yield data
+
+    def close(self):
+        if not self.closed:
+            self._abandon()
+            self.mongo_file.close()
+        super(FillingFile, self).close()
+
+
+class CachedFile(io.RawIOBase):
+    """
+    File from local disk cache, memory-mapped, with the same attributes as GridOut
+    (taken from fs.files document of the file).
+    """
+    def __init__(self, path, document):
+        self.path = path
+        self.document = document
+
+        with open(path, 'rb') as file:
+            size = os.fstat(file.fileno()).st_size
+            # empty file can't be mapped
+            self._data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) if size else b''
+        self._position = 0
+
+    def __getattr__(self, name):
+        if name == 'document':
+            raise AttributeError(name)
+        try:
+            return self.document[GRID_OUT_ATTRIBUTES.get(name, name)]
+        except KeyError:
+            if name in GRID_OUT_OPTIONAL:
+                return None
+            raise AttributeError(name)
+
+    @property
+    def _id(self):
+        return self.document['_id']
+
+    @property
+    def length(self):
+        return len(self._data)
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._position
+
+    def seek(self, pos, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            pos += self._position
+        elif whence == io.SEEK_END:
+            pos += self.length
+        if pos < 0:
+            raise IOError('Invalid position')
+        self._position = pos
+        return pos
+
+    def read(self, size=-1):
+        end = self.length if size is None or size < 0 else min(self._position + size, self.length)
+        data = self._data[self._position:end]
+        self._position = max(end, self._position)
+        return bytes(data)
+
+    def readchunk(self):
+        return self.read(self.document.get('chunkSize', 255 * 1024))
+
+    def __iter__(self):
+        while True:
+            data = self.readchunk()
+            if not data:
+                break
+            yield data
+
+    def close(self):
+        if isinstance(self._data, mmap.mmap):
+            self._data.close()
+        super(CachedFile, self).close()
@@ -0,0 +1,52 @@
+import os
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+
+
+# threads doing background I/O of the storage (batched writes, read-ahead)
+_executor = None
+# threads generating derivatives (thumbnails), separate so they can wait for I/O threads
+_derivative_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_executor():
+    """
+        Get process-wide thread pool of the storage, size is settings.STORAGE_IO_THREADS (default 4).
+    """
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=getattr(settings, 'STORAGE_IO_THREADS', 4),
+                                           thread_name_prefix='mongo-storage-io')
+    return _executor
+
+
+def get_derivative_executor():
+    """
+        Get process-wide thread pool generating derivatives of images,
+        size is settings.STORAGE_DERIVATIVE_THREADS (default 4).
+    """
+    global _derivative_executor
+    with _executor_lock:
+        if _derivative_executor is None:
+            _derivative_executor = ThreadPoolExecutor(
+                max_workers=getattr(settings, 'STORAGE_DERIVATIVE_THREADS', 4),
+                thread_name_prefix='mongo-storage-derivative'
+            )
+    return _derivative_executor
+
+
+def _after_fork():
+    # threads of the pools don't exist in the child process, the lock could be held by one of them
+    global _executor, _derivative_executor, _executor_lock
+    _executor = None
+    _derivative_executor = None
+    _executor_lock = threading.Lock()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_after_fork)
@@ -0,0 +1,173 @@
+import calendar
+import re
+
+from django.utils.http import parse_http_date_safe
+
+
+RANGE_RE = re.compile(r'^\s*(\d*)\s*-\s*(\d*)\s*$')
+
+
+def parse_range_header(header, length):
+    """
+        Parse HTTP Range header value (RFC 7233) against resource of given length.
+    :param header: String, ex. 'bytes=0-499,1000-'
+    :param length: Int, length of the whole resource in bytes
+    :return: None if header is missing/malformed (whole content should be sent),
+             empty list if no range is satisfiable (416 should be sent),
+             otherwise list of (start, end) tuples, end inclusive.
+    """
+    if not header:
+        return None
+
+    units, _, ranges_spec = header.partition('=')
+    if units.strip().lower() != 'bytes' or not ranges_spec:
+        return None
+
+    ranges = []
+    for spec in ranges_spec.split(','):
+        if not spec.strip():
+            continue
+        match = RANGE_RE.match(spec)
+        if not match:
+            return None
+        first, last = match.groups()
+
+        if first:
+            start = int(first)
+            end = int(last) if last else length - 1
+            if last and end < start:
+                return None
+            if start >= length:
+                # not satisfiable, skip it
+                continue
+            end = min(end, length - 1)
+        elif last:
+            # suffix range ex. bytes=-500 (last 500 bytes)
+            suffix = int(last)
+            if suffix == 0:
+                continue
+            start = max(length - suffix, 0)
+            end = length - 1
+        else:
+            return None
+
+        ranges.append((start, end))
+
+    return _coalesce(ranges)
+
+
+def _coalesce(ranges):
+    """
+        Merge overlapping or adjacent ranges, so the client can't ask for the same bytes many times.
+    """
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+
+def iter_range(file, start, end, block_size=255 * 1024):
+    """
+        Stream bytes [start, end] (inclusive) from seekable file-like object.
+        For GridOut seek() is cheap, only chunks covering the range are fetched.
+    """
+    file.seek(start)
+    remaining = end - start + 1
+    while remaining > 0:
+        data = file.read(min(block_size, remaining))
+        if not data:
+            break
+        remaining -= len(data)
+        yield data
+
+
+def file_etag(mongo_file, encoding=None):
+    """
+        Strong ETag of the GridFS file. Files are immutable per ObjectID,
+        so md5 (if computed by the driver) or ObjectID itself is a perfect validator.
+        Content sent with Content-Encoding gets different ETag than decoded one.
+    """
+    return _etag(getattr(mongo_file, 'md5', None) or mongo_file._id, encoding)
+
+
+def file_last_modified(mongo_file):
+    """
+        Upload date of the GridFS file as a timestamp (seconds since epoch, UTC).
+    """
+    return _timestamp(mongo_file.upload_date)
+
+
+def document_etag(document, encoding=None):
+    """
+        The same as file_etag, from fs.files document (metadata) of the file, so the file isn't opened.
+    """
+    return _etag(document.get('md5') or document['_id'], encoding)
+
+
+def document_last_modified(document):
+    """
+        The same as file_last_modified, from fs.files document (metadata) of the file.
+    """
+    return _timestamp(document.get('uploadDate'))
+
+
+def _etag(validator, encoding):
+    if encoding:
+        return '"{}-{}"'.format(validator, encoding)
+    return '"{}"'.format(validator)
+
+
+def _timestamp(upload_date):
+    if upload_date is None:
+        return None
+    return calendar.timegm(upload_date.utctimetuple())
+
+
+def _etag_matches(header, etag, weak=True):
+    if header.strip() == '*':
+        return True
+    for candidate in header.split(','):
+        candidate = candidate.strip()
+        if candidate.startswith('W/'):
+            if not weak:
+                continue
+            candidate = candidate[2:]
+        if candidate == etag:
+            return True
+    return False
+
+
+def is_not_modified(request, etag, last_modified):
+    """
+        Check conditional GET headers (If-None-Match, If-Modified-Since).
+    :return: bool, True if 304 Not Modified can be sent
+    """
+    if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+    if if_none_match:
+        # If-None-Match takes precedence over If-Modified-Since
+        return _etag_matches(if_none_match, etag)
+
+    if_modified_since = parse_http_date_safe(request.META.get('HTTP_IF_MODIFIED_SINCE', ''))
+    if if_modified_since is not None and last_modified is not None:
+        return last_modified <= if_modified_since
+
+    return False
+
+
+def if_range_matches(request, etag, last_modified):
+    """
+        Check If-Range header. If it doesn't match, ranges should be ignored and whole content sent.
+    :return: bool
+    """
+    if_range = request.META.get('HTTP_IF_RANGE')
+    if not if_range:
+        return True
+    if_range = if_range.strip()
+    if if_range.startswith('"') or if_range.startswith('W/'):
+        # If-Range requires strong comparison
+        return _etag_matches(if_range, etag, weak=False)
+    date = parse_http_date_safe(if_range)
+    return date is not None and last_modified is not None and last_modified == date
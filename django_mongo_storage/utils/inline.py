@@ -0,0 +1,13 @@
+from django_mongo_storage.utils.disk_cache import CachedFile
+
+
+class InlineFile(CachedFile):
+    """
+    Small file with content embedded in fs.files document (data field, see MongoStorage inline_threshold),
+    read with one query, with the same attributes as GridOut (taken from the document).
+    """
+    def __init__(self, document):
+        self.path = None
+        self.document = {key: value for key, value in document.items() if key != 'data'}
+        self._data = bytes(document['data'])
+        self._position = 0
@@ -0,0 +1,246 @@
+import time
+
+from collections import defaultdict
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from django.core.exceptions import ImproperlyConfigured
+from django.dispatch import Signal
+
+from pymongo import monitoring
+
+try:
+    import prometheus_client
+except ImportError:
+    prometheus_client = None
+
+
+# sent after every instrumented operation of MongoStorage, with arguments:
+#   sender - class of the storage, storage - MongoStorage instance, operation - Operation
+storage_operation = Signal()
+
+# operation running and summary collected in the current context (thread or asyncio task)
+_operation = ContextVar('mongo_storage_operation', default=None)
+_summary = ContextVar('mongo_storage_summary', default=None)
+
+
+class Operation(object):
+    """
+    Measurements of one operation of MongoStorage ('save', 'open', 'delete', 'exists', 'metadata',
+    'prefetch_metadata').
+    duration - seconds (content of opened files is read later, outside of 'open')
+    bytes - bytes written ('save') or size of the file ('open')
+    files - number of files the operation was called for
+    round_trips - number of commands sent to MongoDB in the context running the operation,
+        including nested operations (ex. 'metadata' called by 'open')
+    cache_hit - True/False if the result could come from a cache (metadata or local disk cache), else None
+    error - name of exception class raised by the operation or None
+    nested - True if the operation was called by another operation
+    """
+    def __init__(self, storage, name, parent=None):
+        self.storage = storage
+        self.name = name
+        self.parent = parent
+        self.duration = 0.0
+        self.bytes = 0
+        self.files = 1
+        self.round_trips = 0
+        self.cache_hit = None
+        self.error = None
+
+    @property
+    def db_alias(self):
+        return self.storage.db_alias
+
+    @property
+    def collection(self):
+        return self.storage.collection
+
+    @property
+    def nested(self):
+        return self.parent is not None
+
+    def __repr__(self):
+        return '<Operation {} {}/{} {:.6f}s>'.format(self.name, self.db_alias, self.collection, self.duration)
+
+
+def current_operation():
+    """
+        Operation of MongoStorage running in the current context (thread or asyncio task) or None.
+    """
+    return _operation.get()
+
+
+@contextmanager
+def instrument(storage, name):
+    """
+        Measure operation of the storage, storage_operation signal is sent when it's done.
+    Use case:
+        with instrument(self, 'open') as operation:
+            ...
+            operation.bytes = length
+    """
+    parent = current_operation()
+    operation = Operation(storage, name, parent)
+    token = _operation.set(operation)
+    start = time.perf_counter()
+    try:
+        yield operation
+    except Exception as e:
+        operation.error = e.__class__.__name__
+        raise
+    finally:
+        operation.duration = time.perf_counter() - start
+        _operation.reset(token)
+        summary = _summary.get()
+        if summary is not None and parent is None:
+            summary.add(operation)
+        if storage_operation.has_listeners():
+            storage_operation.send(sender=storage.__class__, storage=storage, operation=operation)
+
+
+class RoundTripListener(monitoring.CommandListener):
+    """
+    Counts commands sent to MongoDB in operations of the storages, registered on clients
+    created by ConnectionRegistry. Commands sent by background threads (overlapped writes, read ahead)
+    are not counted.
+    """
+    def started(self, event):
+        operation = current_operation()
+        while operation is not None:
+            operation.round_trips += 1
+            operation = operation.parent
+
+    def succeeded(self, event):
+        pass
+
+    def failed(self, event):
+        pass
+
+
+round_trip_listener = RoundTripListener()
+
+
+class RequestSummary(object):
+    """
+    Totals of storage operations (not nested ones) run in the context while it's collecting,
+    per operation name, see StorageMetricsMiddleware.
+    """
+    def __init__(self):
+        self.operations = defaultdict(lambda: {'count': 0, 'duration': 0.0, 'bytes': 0, 'round_trips': 0,
+                                               'cache_hits': 0, 'cache_misses': 0, 'errors': 0})
+
+    def add(self, operation):
+        totals = self.operations[operation.name]
+        totals['count'] += 1
+        totals['duration'] += operation.duration
+        totals['bytes'] += operation.bytes
+        totals['round_trips'] += operation.round_trips
+        if operation.cache_hit is not None:
+            totals['cache_hits' if operation.cache_hit else 'cache_misses'] += 1
+        if operation.error:
+            totals['errors'] += 1
+
+    def total(self, key):
+        return sum(totals[key] for totals in self.operations.values())
+
+    def as_dict(self):
+        return {name: dict(totals) for name, totals in self.operations.items()}
+
+    def __bool__(self):
+        return bool(self.operations)
+
+
+def start_summary():
+    """
+        Start collecting RequestSummary of operations run in the current context.
+    """
+    summary = RequestSummary()
+    _summary.set(summary)
+    return summary
+
+
+def finish_summary():
+    """
+        Stop collecting.
+    :return: RequestSummary or None if collecting wasn't started
+    """
+    summary = _summary.get()
+    _summary.set(None)
+    return summary
+
+
+class StatsdReceiver(object):
+    """
+    Receiver of storage_operation sending metrics to statsd.
+    Use case:
+        from statsd import StatsClient
+        storage_operation.connect(StatsdReceiver(StatsClient()), weak=False)
+
+    Metrics: <prefix>.<db alias>.<collection>.<operation>.{time,bytes,round_trips,cache_hit,cache_miss,error}
+    :param client: statsd client with timing(stat, ms) and incr(stat, count) methods
+    :param nested: if True nested operations are sent too
+    """
+    def __init__(self, client, prefix='mongo_storage', nested=False):
+        self.client = client
+        self.prefix = prefix
+        self.nested = nested
+
+    def __call__(self, sender, operation, **kwargs):
+        if operation.nested and not self.nested:
+            return
+        key = '{}.{}.{}.{}'.format(self.prefix, operation.db_alias, operation.collection.replace('.', '_'),
+                                   operation.name)
+        self.client.timing(key + '.time', operation.duration * 1000)
+        if operation.bytes:
+            self.client.incr(key + '.bytes', operation.bytes)
+        if operation.round_trips:
+            self.client.incr(key + '.round_trips', operation.round_trips)
+        if operation.cache_hit is not None:
+            self.client.incr(key + ('.cache_hit' if operation.cache_hit else '.cache_miss'))
+        if operation.error:
+            self.client.incr(key + '.error')
+
+
+class PrometheusReceiver(object):
+    """
+    Receiver of storage_operation updating prometheus_client metrics (requires prometheus_client package),
+    labeled with db_alias, collection and operation. Create it once per process.
+    Use case:
+        storage_operation.connect(PrometheusReceiver(), weak=False)
+
+    Metrics: <namespace>_operation_seconds (histogram), <namespace>_bytes_total, <namespace>_round_trips_total,
+    <namespace>_cache_total (with result label: hit/miss), <namespace>_errors_total
+    :param nested: if True nested operations are measured too
+    """
+    LABELS = ('db_alias', 'collection', 'operation')
+
+    def __init__(self, namespace='mongo_storage', registry=None, nested=False):
+        if prometheus_client is None:
+            raise ImproperlyConfigured('PrometheusReceiver requires prometheus_client package.')
+        kwargs = {'registry': registry} if registry is not None else {}
+        self.nested = nested
+        self.duration = prometheus_client.Histogram('{}_operation_seconds'.format(namespace),
+                                                    'Duration of storage operations.', self.LABELS, **kwargs)
+        self.bytes = prometheus_client.Counter('{}_bytes'.format(namespace),
+                                               'Bytes written or opened.', self.LABELS, **kwargs)
+        self.round_trips = prometheus_client.Counter('{}_round_trips'.format(namespace),
+                                                     'Commands sent to MongoDB.', self.LABELS, **kwargs)
+        self.cache = prometheus_client.Counter('{}_cache'.format(namespace),
+                                               'Cache lookups.', self.LABELS + ('result',), **kwargs)
+        self.errors = prometheus_client.Counter('{}_errors'.format(namespace),
+                                                'Failed storage operations.', self.LABELS, **kwargs)
+
+    def __call__(self, sender, operation, **kwargs):
+        if operation.nested and not self.nested:
+            return
+        labels = (operation.db_alias, operation.collection, operation.name)
+        self.duration.labels(*labels).observe(operation.duration)
+        if operation.bytes:
+            self.bytes.labels(*labels).inc(operation.bytes)
+        if operation.round_trips:
+            self.round_trips.labels(*labels).inc(operation.round_trips)
+        if operation.cache_hit is not None:
+            self.cache.labels(*(labels + ('hit' if operation.cache_hit else 'miss',))).inc()
+        if operation.error:
+            self.errors.labels(*labels).inc()
@@ -0,0 +1,125 @@
+import io
+
+from gridfs.errors import CorruptGridFile
+
+from django_mongo_storage.utils.executor import get_executor
+
+
+class ReadAheadGridOut(io.RawIOBase):
+    """
+    Wrapper of GridOut fetching chunks in batches of read_ahead chunks with one range query
+    ({files_id: id, n: {$gte: a, $lt: b}}), the next batch is fetched in background
+    while the current one is consumed. At most 2 * read_ahead chunks are kept in memory.
+    Attributes of GridOut (filename, length, content_type, upload_date, etc.) are available as usual.
+    Use case:
+        mongo_file = ReadAheadGridOut(storage.fs.get(oid), storage.db['fs.chunks'], read_ahead=8)
+        for chunk in mongo_file:
+            ...
+    """
+    def __init__(self, grid_out, chunks_collection, read_ahead=8):
+        self.grid_out = grid_out
+        self.chunks_collection = chunks_collection
+        self.read_ahead = max(read_ahead, 1)
+
+        self._position = 0
+        self._chunks = None
+        self._buffer = b''
+
+    def __getattr__(self, name):
+        # GridOut attributes (filename, length, content_type...)
+        if name == 'grid_out':
+            raise AttributeError(name)
+        return getattr(self.grid_out, name)
+
+    @property
+    def num_chunks(self):
+        if not self.grid_out.length:
+            return 0
+        return (self.grid_out.length - 1) // self.grid_out.chunk_size + 1
+
+    def _fetch(self, first, last):
+        cursor = self.chunks_collection.find(
+            {'files_id': self.grid_out._id, 'n': {'$gte': first, '$lt': last}}, {'data': 1, 'n': 1}
+        ).sort('n', 1)
+        chunks = [chunk['data'] for chunk in cursor]
+        if len(chunks) != last - first:
+            raise CorruptGridFile('missing chunks {}-{} of file {}'.format(first, last - 1, self.grid_out._id))
+        return chunks
+
+    def iter_chunks(self, start=0):
+        """
+            Iterate over content from given position, chunk by chunk.
+        """
+        chunk_size = self.grid_out.chunk_size
+        num_chunks = self.num_chunks
+        n = start // chunk_size
+        skip = start - n * chunk_size
+
+        executor = get_executor()
+        future = executor.submit(self._fetch, n, min(n + self.read_ahead, num_chunks)) if n < num_chunks else None
+        while future is not None:
+            chunks = future.result()
+            n = min(n + self.read_ahead, num_chunks)
+            future = executor.submit(self._fetch, n, min(n + self.read_ahead, num_chunks)) if n < num_chunks else None
+            for data in chunks:
+                if skip:
+                    data, skip = data[skip:], 0
+                yield bytes(data)
+
+    def __iter__(self):
+        self._buffer = b''
+        self._chunks = self.iter_chunks(self._position)
+        for data in self._chunks:
+            self._position += len(data)
+            yield data
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._position
+
+    def seek(self, pos, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            pos += self._position
+        elif whence == io.SEEK_END:
+            pos += self.grid_out.length
+        if pos < 0:
+            raise IOError('Invalid position')
+        if pos != self._position:
+            self._position = pos
+            self._chunks = None
+            self._buffer = b''
+        return pos
+
+    def read(self, size=-1):
+        if self._chunks is None:
+            self._chunks = self.iter_chunks(self._position)
+
+        parts = [self._buffer]
+        available = len(self._buffer)
+        while size is None or size < 0 or available < size:
+            data = next(self._chunks, b'')
+            if not data:
+                break
+            parts.append(data)
+            available += len(data)
+
+        data = b''.join(parts)
+        if size is not None and size >= 0:
+            data, self._buffer = data[:size], data[size:]
+        else:
+            self._buffer = b''
+        self._position += len(data)
+        return data
+
+    def readchunk(self):
+        return self.read(self.grid_out.chunk_size - self._position % self.grid_out.chunk_size)
+
+    def close(self):
+        self._chunks = None
+        self.grid_out.close()
+        super(ReadAheadGridOut, self).close()
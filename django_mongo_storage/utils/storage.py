@@ -1,18 +1,45 @@
+import hashlib
 import logging
 import os
+import threading
 
+from collections import Counter
 from urllib.parse import urljoin
 from bson import ObjectId
 
 from django.conf import settings
+from django.core.files import File
 from django.core.files.storage import Storage
 from django.utils.deconstruct import deconstructible
 
-from mongoengine.connection import get_db
-from mongoengine.fields import GridFSProxy
+from gridfs import GridOut
+from gridfs.errors import NoFile
+from pymongo import ReadPreference
+from pymongo.errors import DuplicateKeyError
+
+from django_mongo_storage.utils.cache import LRUCache
+from django_mongo_storage.utils.connection import connections, get_read_preference
+from django_mongo_storage.utils.compression import DecompressingFile, should_compress, DEFAULT_SKIP_TYPES
+from django_mongo_storage.utils.derivatives import render_derivative, derivative_filename, RENDER_ERRORS
+from django_mongo_storage.utils.disk_cache import get_disk_cache, CachedFile, FillingFile
+from django_mongo_storage.utils.executor import get_derivative_executor
+from django_mongo_storage.utils.inline import InlineFile
+from django_mongo_storage.utils.instrumentation import instrument, current_operation
+from django_mongo_storage.utils.reader import ReadAheadGridOut
+from django_mongo_storage.utils.writer import GridFSBatchWriter, GridFSBulkWriter, DEFAULT_CHUNK_SIZE
 
 logger = logging.getLogger(__name__)
 
+# fields of fs.files document fetched for metadata lookups (size, name, etc.)
+METADATA_FIELDS = ('filename', 'length', 'chunkSize', 'uploadDate', 'contentType', 'md5', 'width', 'height',
+                   'compression', 'uncompressedLength', 'inline')
+
+# max number of files deleted with one query
+DELETE_BATCH_SIZE = 1000
+
+# max number of file documents inserted with one query by save_many
+SAVE_BATCH_SIZE = 1000
+
 
 @deconstructible
 class MongoStorage(Storage):
@@ -23,6 +50,75 @@ class MongoStorage(Storage):
             ...
             file = models.FileField(storage=MongoStorage(db_alias='db_alias', collection='collection'))
 
+    cache_control is a value of Cache-Control header sent with served files,
+    ex. 'private, max-age=31536000, immutable' (GridFS files never change for given ObjectID).
+    Defaults to settings.STORAGE_CACHE_CONTROL, header is not sent if None.
+
+    Metadata of files (fs.files documents) is cached, GridFS files are immutable per ObjectID.
+    metadata_cache_size - max number of cached documents (0 disables the cache),
+        defaults to settings.STORAGE_METADATA_CACHE_SIZE or 1024
+    metadata_cache_ttl - seconds after which cached document expires (None - never),
+        defaults to settings.STORAGE_METADATA_CACHE_TTL or 300
+
+    Files written by this process are read from primary for recent_write_window seconds
+    (read-your-writes, no waiting for replication lag of secondaries),
+    defaults to settings.STORAGE_RECENT_WRITE_WINDOW or 60
+
+    Files are written in chunks of chunk_size bytes (settings.STORAGE_CHUNK_SIZE, default 255 kB),
+    write_batch_size chunks are inserted in one round trip (settings.STORAGE_WRITE_BATCH_SIZE, default 16).
+    If overlap_writes is True (settings.STORAGE_OVERLAP_WRITES) batches are inserted in background
+    while the next one is read from content.
+
+    If read_ahead > 0 (settings.STORAGE_READ_AHEAD) files returned by open() and get_file() fetch
+    read_ahead chunks per query, the next batch in background (at most 2 * read_ahead chunks in memory).
+
+    If deduplicate is True (settings.STORAGE_DEDUPLICATE) content is identified by sha256 digest,
+    uploading content already stored in the collection only increments reference count of existing file
+    (filename and content type of the first upload are kept), delete() removes the file when
+    the last reference is deleted.
+
+    If compress is set to 'gzip' or 'zstd' (settings.STORAGE_COMPRESS, zstd requires zstandard package)
+    content is compressed, except content types starting with one of compress_skip_types
+    (settings.STORAGE_COMPRESS_SKIP_TYPES, default: images, video, audio, archives, etc.).
+    Files are decompressed transparently by open() and get_file(), view_file sends compressed content
+    with Content-Encoding if client accepts it.
+
+    If local_cache_dir is set (settings.STORAGE_LOCAL_CACHE_DIR) content of files read by open()
+    and get_file() is cached on local disk while it's read (to the end) and served from memory-mapped files,
+    least recently used files are removed when the cache exceeds local_cache_max_bytes
+    (settings.STORAGE_LOCAL_CACHE_MAX_BYTES, default 1 GB).
+
+    serve_mode (settings.STORAGE_SERVE_MODE) tells how view_file sends files from local disk cache:
+        'python' or None - content is read by python (default)
+        'sendfile' - FileResponse with file on disk, sent by wsgi.file_wrapper (os.sendfile)
+        'x-accel-redirect' - nginx sends the file, serve_prefix (settings.STORAGE_SERVE_PREFIX)
+            is internal location aliased to local_cache_dir, ex.:
+                location /protected-storage/ { internal; alias /var/cache/mongo-storage/; }
+        'x-sendfile' - web server sends the file (Apache mod_xsendfile, lighttpd)
+
+    Files of at most inline_threshold stored bytes (settings.STORAGE_INLINE_THRESHOLD, default 0 - disabled,
+    at most chunk_size) are stored inline, content is embedded in fs.files document instead of fs.chunks,
+    so reading the file takes one query. Inline files are read transparently by the storage,
+    but they are not readable by other GridFS clients.
+
+    Derivatives of images (thumbnails) are generated on first request by get_derivative(),
+    in thread pool of settings.STORAGE_DERIVATIVE_THREADS (default 4), and stored as GridFS files
+    linked to the source file (source_id and derivative fields), they are deleted with the source file.
+
+    Reads go to members chosen by read_preference (settings.STORAGE_READ_PREFERENCE), name of the mode,
+    ex. 'secondaryPreferred' or 'nearest' (default: read preference of the connection), read_tags
+    (settings.STORAGE_READ_TAGS) are tag sets of members, ex. [{'dc': 'eu'}, {}], max_staleness
+    (settings.STORAGE_MAX_STALENESS) is max replication lag of secondaries in seconds (-1 no limit).
+    Writes always go to primary, files not found on secondaries are looked up on primary
+    (written by another process, not replicated yet).
+
+    Storages share one client per db alias (settings of mongoengine connection with the alias),
+    pools are configured with settings.STORAGE_MAX_POOL_SIZE, STORAGE_WAIT_QUEUE_TIMEOUT_MS, etc.
+    (see django_mongo_storage.utils.connection.POOL_SETTINGS), clients are created again after fork.
+
+    Operations (save, open, delete, exists, metadata) are measured, storage_operation signal is sent
+    with time, bytes, round trips and cache hit of each one (see django_mongo_storage.utils.instrumentation).
+
     To get mongo file (GridOut) use:
     file = TestModel.objects.all()[0].file
     mongo_file = file.storage.get_file(file.name)
@@ -30,32 +126,188 @@ class MongoStorage(Storage):
         NOTE: param path in methods is made of:
             upload_to + filename (upload_to is Field class param)
     """
-    def __init__(self, db_alias, collection, base_url=settings.STORAGE_URL):
+    def __init__(self, db_alias, collection, base_url=settings.STORAGE_URL,
+                 cache_control=getattr(settings, 'STORAGE_CACHE_CONTROL', None),
+                 metadata_cache_size=getattr(settings, 'STORAGE_METADATA_CACHE_SIZE', 1024),
+                 metadata_cache_ttl=getattr(settings, 'STORAGE_METADATA_CACHE_TTL', 300),
+                 recent_write_window=getattr(settings, 'STORAGE_RECENT_WRITE_WINDOW', 60),
+                 chunk_size=getattr(settings, 'STORAGE_CHUNK_SIZE', DEFAULT_CHUNK_SIZE),
+                 write_batch_size=getattr(settings, 'STORAGE_WRITE_BATCH_SIZE', 16),
+                 overlap_writes=getattr(settings, 'STORAGE_OVERLAP_WRITES', False),
+                 read_ahead=getattr(settings, 'STORAGE_READ_AHEAD', 0),
+                 deduplicate=getattr(settings, 'STORAGE_DEDUPLICATE', False),
+                 compress=getattr(settings, 'STORAGE_COMPRESS', None),
+                 compress_skip_types=getattr(settings, 'STORAGE_COMPRESS_SKIP_TYPES', DEFAULT_SKIP_TYPES),
+                 local_cache_dir=getattr(settings, 'STORAGE_LOCAL_CACHE_DIR', None),
+                 local_cache_max_bytes=getattr(settings, 'STORAGE_LOCAL_CACHE_MAX_BYTES', 1024 ** 3),
+                 serve_mode=getattr(settings, 'STORAGE_SERVE_MODE', None),
+                 serve_prefix=getattr(settings, 'STORAGE_SERVE_PREFIX', '/protected-storage/'),
+                 read_preference=getattr(settings, 'STORAGE_READ_PREFERENCE', None),
+                 read_tags=getattr(settings, 'STORAGE_READ_TAGS', None),
+                 max_staleness=getattr(settings, 'STORAGE_MAX_STALENESS', -1),
+                 inline_threshold=getattr(settings, 'STORAGE_INLINE_THRESHOLD', 0)):
         self.db_alias = db_alias
         self.collection = collection
         self.base_url = base_url
+        self.cache_control = cache_control
+        self.metadata_cache_size = metadata_cache_size
+        self.metadata_cache_ttl = metadata_cache_ttl
+        self.recent_write_window = recent_write_window
+        self.chunk_size = chunk_size
+        self.write_batch_size = write_batch_size
+        self.overlap_writes = overlap_writes
+        self.read_ahead = read_ahead
+        self.deduplicate = deduplicate
+        self.compress = compress
+        self.compress_skip_types = tuple(compress_skip_types)
+        self.local_cache_dir = local_cache_dir
+        self.local_cache_max_bytes = local_cache_max_bytes
+        self.serve_mode = serve_mode
+        self.serve_prefix = serve_prefix
+        self.read_preference = read_preference
+        self.read_tags = read_tags
+        self.max_staleness = max_staleness
+        self._read_preference = get_read_preference(read_preference, read_tags, max_staleness)
+        self.inline_threshold = inline_threshold
 
-        self._db = None
-        self._grid_proxy = None
-        self._fs = None
+        self._metadata_cache = LRUCache(maxsize=metadata_cache_size, ttl=metadata_cache_ttl)
+        self._recent_writes = LRUCache(maxsize=10000, ttl=recent_write_window)
+        # 'source oid:derivative name' -> ObjectID of derivative in string
+        self._derivative_cache = LRUCache(maxsize=metadata_cache_size, ttl=metadata_cache_ttl)
+        # derivatives being generated, so concurrent requests wait for the same generation
+        self._reset_derivative_futures()
 
+        self._uploads = None
+        self._indexes_ensured = False
+
+    # clients and GridFS objects are shared by storages in the process (see ConnectionRegistry)
     @property
     def db(self):
-        if not self._db:
-            self._db = get_db(alias=self.db_alias)
-        return self._db
+        return connections.get_database(self.db_alias, read_preference=self._read_preference)
+
+    @property
+    def fs(self):
+        return connections.get_gridfs(self.db_alias, self.collection, read_preference=self._read_preference)
 
     @property
-    def grid_proxy(self):
-        if not self._grid_proxy:
-            self._grid_proxy = GridFSProxy(db_alias=self.db_alias, collection_name=self.collection)
-        return self._grid_proxy
+    def primary_db(self):
+        return connections.get_database(self.db_alias, read_preference=ReadPreference.PRIMARY)
 
     @property
-    def fs(self):
-        if not self._fs:
-            self._fs = self.grid_proxy.fs
-        return self._fs
+    def primary_fs(self):
+        return connections.get_gridfs(self.db_alias, self.collection, read_preference=ReadPreference.PRIMARY)
+
+    @property
+    def local_cache(self):
+        if not self.local_cache_dir:
+            return None
+        return get_disk_cache(self.local_cache_dir, self.local_cache_max_bytes)
+
+    @property
+    def files_collection(self):
+        return self.db['{}.files'.format(self.collection)]
+
+    @property
+    def async_storage(self):
+        """
+            AsyncMongoStorage sharing configuration and caches with this storage (for ASGI).
+        """
+        from django_mongo_storage.utils.async_storage import AsyncMongoStorage
+        return AsyncMongoStorage(self)
+
+    @property
+    def uploads(self):
+        """
+            ResumableUploads of this storage (files uploaded in many requests).
+        """
+        if self._uploads is None:
+            from django_mongo_storage.utils.uploads import ResumableUploads
+            self._uploads = ResumableUploads(self)
+        return self._uploads
+
+    @property
+    def primary_files_collection(self):
+        return self.primary_db['{}.files'.format(self.collection)]
+
+    @property
+    def _reads_secondaries(self):
+        return self._read_preference is not None and self._read_preference.mode != ReadPreference.PRIMARY.mode
+
+    def _mark_written(self, oid):
+        self._recent_writes.set(str(oid), True)
+
+    def _is_recently_written(self, oid):
+        return str(oid) in self._recent_writes
+
+    # GridFS to read given file from, primary if the file was just written
+    def _read_fs(self, oid):
+        return self.primary_fs if self._is_recently_written(oid) else self.fs
+
+    def _read_db(self, oid):
+        return self.primary_db if self._is_recently_written(oid) else self.db
+
+    def _get_gridfs_file(self, oid, read_ahead=None, document=None):
+        if document is not None:
+            # already fetched, GridOut doesn't query it again
+            grid_out = GridOut(self._read_db(oid)[self.collection], file_document=document)
+        else:
+            try:
+                grid_out = self._read_fs(oid).get(ObjectId(oid))
+            except NoFile:
+                if not self._reads_secondaries or self._is_recently_written(oid):
+                    raise
+                # written by another process, not replicated to secondaries yet
+                grid_out = self.primary_fs.get(ObjectId(oid))
+                self._mark_written(oid)
+        read_ahead = self.read_ahead if read_ahead is None else read_ahead
+        if read_ahead > 0:
+            chunks = self._read_db(oid)['{}.chunks'.format(self.collection)]
+            return ReadAheadGridOut(grid_out, chunks, read_ahead=read_ahead)
+        return grid_out
+
+    def _get_cached_file(self, oid, read_ahead=None, fill=True):
+        """
+            Get file from local disk cache, on miss the file is streamed from GridFS and cached while
+            it's read (see FillingFile), so the caller doesn't wait for the whole file.
+        :param fill: if False file missing in the cache isn't cached (ex. range requests)
+        :return: CachedFile, FillingFile or None if file is too big to be cached, isn't cached
+            and fill is False or was evicted before it was opened
+        """
+        document = self._get_existing_metadata(oid)
+        # inline files are read with one query anyway
+        if document['length'] > self.local_cache.max_bytes or document.get('inline'):
+            return None
+
+        path = self.local_cache.get(oid)
+        current_operation().cache_hit = path is not None
+        if path is None:
+            # stored (possibly compressed) content is cached
+            return FillingFile(self.local_cache, self._get_gridfs_file(oid, read_ahead)) if fill else None
+        try:
+            return CachedFile(path, document)
+        except FileNotFoundError:
+            # evicted by another thread or process in the meantime, the file is streamed from GridFS
+            current_operation().cache_hit = False
+            return None
+
+    def _get_grid_out(self, oid, read_ahead=None, decompress=True, cache=True):
+        with instrument(self, 'open') as operation:
+            mongo_file = self._get_cached_file(oid, read_ahead, cache) if self.local_cache else None
+            if mongo_file is None:
+                document = self._fetch_file_document(oid)
+                if document is not None and document.get('inline'):
+                    mongo_file = InlineFile(document)
+                else:
+                    mongo_file = self._get_gridfs_file(oid, read_ahead, document)
+
+            compression = getattr(mongo_file, 'compression', None)
+            if compression and decompress:
+                mongo_file = DecompressingFile(mongo_file, compression, mongo_file.uncompressedLength)
+            operation.bytes = mongo_file.length
+            return mongo_file
+
+    def _read_files_collection(self, oid):
+        return self.primary_files_collection if self._is_recently_written(oid) else self.files_collection
 
     # just override not to allow django to change a name of the file
     def get_available_name(self, name, max_length=None):
@@ -69,18 +321,26 @@ class MongoStorage(Storage):
         :param mode: (doesn't matter in this case)
         :return: GridOUT (has a read() method)
         """
-        return self.fs.get(ObjectId(oid))
+        return self._get_grid_out(oid)
 
     def _save(self, path, content):
         """
             Put content of the file given in path to GridFS (MongoDB)
-            Content can be streamed or saved depending on if content has attribute chunks or not.
+            Content is streamed using chunks() method or read() if content has no chunks.
         :param path: String, can be filename
         :param content: Content of the file to save.
         :return: ObjectID in string of the file created in GridFS (is saved to FileField.name)
         """
         path, filename = os.path.split(path)
 
+        kwargs = self._get_file_kwargs(content)
+
+        return self._stream(filename, content, **kwargs)
+
+    def _get_file_kwargs(self, content):
+        """
+            Get attributes of the file to be saved in fs.files document (content type, image dimensions).
+        """
         kwargs = {}
 
         if hasattr(content.file, 'content_type'):
@@ -91,11 +351,7 @@ class MongoStorage(Storage):
         if hasattr(content, 'height') and hasattr(content, 'width'):
             kwargs.update(width=content.width, height=content.height)
 
-        if hasattr(content, 'chunks'):
-            return self._stream(filename, content, **kwargs)
-
-        oid = self.fs.put(content, filename=filename, **kwargs)
-        return str(oid)
+        return kwargs
 
     def exists(self, oid):
         """
@@ -103,43 +359,483 @@ class MongoStorage(Storage):
         :param oid: ObjectID in string
         :return: bool
         """
-        return self.fs.exists({'_id': ObjectId(oid)})
+        with instrument(self, 'exists') as operation:
+            operation.cache_hit = str(oid) in self._metadata_cache
+            return self.get_metadata(oid) is not None
 
-    def get_file(self, oid):
+    def get_file(self, oid, read_ahead=None, decompress=True, cache=True):
         """
             Get file from GridFS (MongoDB)
         :param oid: ObjectID in string
+        :param read_ahead: number of chunks to prefetch, defaults to read_ahead of the storage
+        :param decompress: if False compressed files are returned as stored (compressed)
+        :param cache: if False file isn't added to local disk cache (ex. only a part of it will be read)
         :return: file from GridFS
         """
-        return self.fs.get(ObjectId(oid))
+        return self._get_grid_out(oid, read_ahead, decompress, cache)
 
     def delete(self, oid):
-        self.fs.delete(ObjectId(oid))
+        self.delete_many([oid])
+
+    def delete_many(self, oids, ignore_references=False):
+        """
+            Delete many files with a few queries per DELETE_BATCH_SIZE files
+            (fs.files and fs.chunks are removed with $in queries), derivatives of the files are deleted too.
+            If deduplicate is True one reference is removed per occurrence of oid,
+            files are deleted when the last reference is deleted.
+        :param oids: iterable of ObjectIDs in string
+        :param ignore_references: if True files are deleted regardless of reference counts (garbage collection)
+        """
+        oids = [ObjectId(oid) for oid in oids if oid]
+        with instrument(self, 'delete') as operation:
+            operation.files = len(oids)
+            for start in range(0, len(oids), DELETE_BATCH_SIZE):
+                self._delete_batch(oids[start:start + DELETE_BATCH_SIZE], ignore_references)
+
+    def _delete_batch(self, oids, ignore_references=False):
+        files = self.primary_files_collection
+        oids_to_delete = set(oids)
+
+        if self.deduplicate and not ignore_references:
+            # deduplicated files, remove references, files referenced more than once in oids are decremented once
+            # per occurrence, so group them by number of occurrences
+            counts = Counter(oids)
+            for count in set(counts.values()):
+                files.update_many(
+                    {'_id': {'$in': [oid for oid in counts if counts[oid] == count]}, 'refcount': {'$exists': True}},
+                    {'$inc': {'refcount': -count}}
+                )
+            # files still referenced are kept
+            referenced = files.find({'_id': {'$in': list(oids_to_delete)}, 'refcount': {'$gt': 0}}, {'_id': 1})
+            oids_to_delete -= set(document['_id'] for document in referenced)
+            if not oids_to_delete:
+                return
+
+        # derivatives (thumbnails) of the files
+        derivatives = list(files.find({'source_id': {'$in': list(oids_to_delete)}}, {'source_id': 1, 'derivative': 1}))
+        oids_to_delete.update(document['_id'] for document in derivatives)
+
+        # files document first, so partially deleted file is not visible (as GridFS does)
+        oids_to_delete = list(oids_to_delete)
+        if self.deduplicate and not ignore_references:
+            # files referenced again in the meantime (see _reference_existing) are kept with their chunks
+            files.delete_many({'_id': {'$in': oids_to_delete}, 'refcount': {'$not': {'$gt': 0}}})
+            revived = set(document['_id'] for document in files.find({'_id': {'$in': oids_to_delete}}, {'_id': 1}))
+            oids_to_delete = [oid for oid in oids_to_delete if oid not in revived]
+        else:
+            files.delete_many({'_id': {'$in': oids_to_delete}})
+        self.primary_db['{}.chunks'.format(self.collection)].delete_many({'files_id': {'$in': oids_to_delete}})
+
+        for oid in oids_to_delete:
+            self._metadata_cache.delete(str(oid))
+            if self.local_cache:
+                self.local_cache.discard(oid)
+        for document in derivatives:
+            self._derivative_cache.delete('{}:{}'.format(document['source_id'], document['derivative']))
+
+    def get_metadata(self, oid):
+        """
+            Get fs.files document of the file (without content), served from cache if possible.
+        :param oid: ObjectID in string
+        :return: dict or None if file doesn't exist
+        """
+        oid = str(oid)
+        with instrument(self, 'metadata') as operation:
+            document = self._metadata_cache.get(oid)
+            operation.cache_hit = document is not None
+            if document is None:
+                document = self._find_file_document(oid, METADATA_FIELDS)
+            return document
+
+    def _find_file_document(self, oid, projection=None):
+        """
+            Query fs.files document of the file (cached without content of inline file).
+        :return: dict or None if file doesn't exist
+        """
+        document = self._read_files_collection(oid).find_one({'_id': ObjectId(oid)}, projection)
+        if document is None and self._reads_secondaries and not self._is_recently_written(oid):
+            # written by another process, not replicated to secondaries yet
+            document = self.primary_files_collection.find_one({'_id': ObjectId(oid)}, projection)
+            if document is not None:
+                self._mark_written(oid)
+        # missing files are not cached, they can show up after replication lag
+        if document is not None:
+            self._metadata_cache.set(str(oid), {key: value for key, value in document.items()
+                                                if key == '_id' or key in METADATA_FIELDS})
+        return document
+
+    def _fetch_file_document(self, oid):
+        """
+            Get whole fs.files document of the file (with content of inline file), if metadata isn't cached
+            or the file is inline, so the file is read with one query.
+        :return: dict or None if metadata is cached and the file isn't inline (GridFS queries the document)
+        """
+        document = self._metadata_cache.get(str(oid))
+        if document is not None and not document.get('inline'):
+            return None
+        document = self._find_file_document(oid)
+        if document is None:
+            raise NoFile("no file in gridfs collection {} with _id {}".format(self.collection, oid))
+        return document
+
+    def prefetch_metadata(self, oids):
+        """
+            Get fs.files documents of many files with one query, documents are cached.
+        :param oids: iterable of ObjectIDs in string
+        :return: dict {oid: document}, missing files are not included
+        """
+        documents = {}
+        missing = []
+        oids = set(str(oid) for oid in oids if oid)
+        with instrument(self, 'prefetch_metadata') as operation:
+            operation.files = len(oids)
+            for oid in oids:
+                document = self._metadata_cache.get(oid)
+                if document is None:
+                    missing.append(ObjectId(oid))
+                else:
+                    documents[oid] = document
+            # hit only if no query was needed
+            operation.cache_hit = not missing
+
+            # just written files are looked up on primary
+            recent = [oid for oid in missing if self._is_recently_written(oid)]
+            others = [oid for oid in missing if not self._is_recently_written(oid)]
+            self._find_metadata(self.files_collection, others, documents)
+            if self._reads_secondaries:
+                # written by other processes, not replicated to secondaries yet
+                lagging = [oid for oid in others if str(oid) not in documents]
+                for oid in self._find_metadata(self.primary_files_collection, lagging, documents):
+                    self._mark_written(oid)
+            self._find_metadata(self.primary_files_collection, recent, documents)
+            return documents
+
+    def _find_metadata(self, collection, oids, documents):
+        found = []
+        if oids:
+            for document in collection.find({'_id': {'$in': oids}}, METADATA_FIELDS):
+                oid = str(document['_id'])
+                self._metadata_cache.set(oid, document)
+                documents[oid] = document
+                found.append(oid)
+        return found
+
+    def _get_existing_metadata(self, oid):
+        document = self.get_metadata(oid)
+        if document is None:
+            raise NoFile("no file in gridfs collection {} with _id {}".format(self.collection, oid))
+        return document
+
+    def _iter_content(self, content):
+        if hasattr(content, 'chunks'):
+            return content.chunks(self.chunk_size)
+        return iter(lambda: content.read(self.chunk_size), b'')
+
+    def _ensure_indexes(self):
+        # the same indexes as created by GridFS driver on first write
+        if not self._indexes_ensured:
+            self.primary_db['{}.chunks'.format(self.collection)].create_index([('files_id', 1), ('n', 1)], unique=True)
+            self.primary_files_collection.create_index([('filename', 1), ('uploadDate', 1)])
+            # one derivative of given name per source file, sparse - only derivatives are indexed
+            self.primary_files_collection.create_index([('source_id', 1), ('derivative', 1)], unique=True, sparse=True)
+            if self.deduplicate:
+                self.primary_files_collection.create_index('sha256', unique=True, sparse=True)
+            self._indexes_ensured = True
+
+    def _reference_existing(self, digest, count=1):
+        """
+            Add reference(s) to already stored file with given content digest.
+            File which lost its last reference but isn't deleted yet is referenced again,
+            delete keeps files referenced in the meantime (see _delete_batch).
+        :return: ObjectID of the file or None if there is no such file
+        """
+        document = self.primary_files_collection.find_one_and_update(
+            {'sha256': digest, 'refcount': {'$gte': 0}}, {'$inc': {'refcount': count}}, projection={'_id': 1}
+        )
+        return document['_id'] if document else None
+
+    def _hash_content(self, content):
+        """
+            sha256 of content if it can be read twice (seekable), None otherwise.
+        """
+        seekable = getattr(content, 'seekable', None)
+        if not hasattr(content, 'seek') or (seekable and not seekable()):
+            return None
+        digest = hashlib.sha256()
+        for chunk in self._iter_content(content):
+            digest.update(chunk.encode('utf-8') if isinstance(chunk, str) else chunk)
+        content.seek(0)
+        return digest.hexdigest()
 
     def _stream(self, filename, content, **kwargs):
         """
-            Raises FileExists if field already has a file.
+            Write content to GridFS, inserting write_batch_size chunks per round trip.
+            Chunks written before an error are removed.
         :param filename: String
-        :param content: content of file with available content.chunks() method
+        :param content: content of file with available content.chunks() or read() method
         :return: ObjectID in string
         """
-        grid_in = None
+        with instrument(self, 'save') as operation:
+            self._ensure_indexes()
+
+            if self.deduplicate:
+                # content hashed before upload, so known content is not written at all
+                digest = self._hash_content(content)
+                oid = self._reference_existing(digest) if digest else None
+                if oid is not None:
+                    self._mark_written(oid)
+                    return str(oid)
+                kwargs.update(refcount=1)
+
+            compression = None
+            if self.compress and should_compress(kwargs.get('content_type'), self.compress_skip_types):
+                compression = self.compress
+
+            writer = GridFSBatchWriter(self.primary_db, self.collection, chunk_size=self.chunk_size,
+                                       batch_size=self.write_batch_size, overlap=self.overlap_writes,
+                                       sha256=self.deduplicate, compression=compression,
+                                       inline_threshold=self.inline_threshold, filename=filename, **kwargs)
+            try:
+                for chunk in self._iter_content(content):
+                    writer.write(chunk)
+                oid = writer.close()
+            except DuplicateKeyError as e:
+                # the same content was stored concurrently, use it
+                writer.abort()
+                oid = self._reference_existing(writer.sha256)
+                if oid is None:
+                    logger.exception("Can't write mongo file using storage")
+                    operation.error = e.__class__.__name__
+                    return None
+            except Exception as e:
+                logger.exception("Can't write mongo file using storage")
+                writer.abort()
+                operation.error = e.__class__.__name__
+                return None
+
+            operation.bytes = writer.length
+            self._mark_written(oid)
+            return str(oid)
+
+    def save_many(self, contents):
+        """
+            Save many files with a few round trips: chunks and documents of consecutive files are inserted
+            together (see GridFSBulkWriter), up to SAVE_BATCH_SIZE file documents per query.
+            Deduplicated content repeated in contents is stored once, content stored before is detected
+            when file documents are inserted (its chunks are written and removed then).
+            Unlike save() errors are raised, files saved by the call are deleted then.
+            Use case (with bulk_create, see django_mongo_storage.managers.save_mongo_files):
+                oids = storage.save_many((upload.name, upload) for upload in request.FILES.getlist('files'))
+
+        :param contents: iterable of (name, content) pairs, content as in save() (django File or file-like object)
+        :return: list of ObjectIDs in string, in order of contents
+        """
+        with instrument(self, 'save_many') as operation:
+            self._ensure_indexes()
+            writer = GridFSBulkWriter(self.primary_db, self.collection, chunk_size=self.chunk_size,
+                                      batch_size=self.write_batch_size, overlap=self.overlap_writes,
+                                      inline_threshold=self.inline_threshold)
+            oids = []
+            # deduplication, sha256 -> ObjectID of file stored by this call,
+            # references to files inserted by previous batches (added on flush)
+            digests = {}
+            references = Counter()
+            saved = 0
+            try:
+                for name, content in contents:
+                    if not hasattr(content, 'chunks'):
+                        content = File(content, name)
+                    filename = os.path.basename(name or content.name)
+                    oids.append(self._add_to_bulk(writer, filename, content, digests, references))
+                    if len(writer.pending) >= SAVE_BATCH_SIZE:
+                        failed = self._flush_bulk(writer, oids, saved, digests, references)
+                        saved = len(oids)
+                        if failed:
+                            break
+                else:
+                    failed = self._flush_bulk(writer, oids, saved, digests, references)
+                    saved = len(oids)
+                if failed:
+                    raise IOError("Can't write mongo files {} using storage".format(', '.join(failed)))
+            except Exception:
+                writer.abort()
+                # references of deduplicated files are removed, files written by the call are deleted
+                self.delete_many(oid for oid in oids[:saved] if oid)
+                raise
+
+            operation.files = len(oids)
+            operation.bytes = writer.length
+            for oid in set(oids):
+                if oid:
+                    self._mark_written(oid)
+            return [str(oid) if oid else None for oid in oids]
+
+    def _add_to_bulk(self, writer, filename, content, digests, references):
+        kwargs = self._get_file_kwargs(content)
+        if self.deduplicate:
+            digest = self._hash_content(content)
+            oid = digests.get(digest) if digest else None
+            if oid is not None:
+                if oid in writer.pending:
+                    writer.pending[oid]['refcount'] += 1
+                else:
+                    references[oid] += 1
+                return oid
+            kwargs.update(refcount=1)
+
+        compression = None
+        if self.compress and should_compress(kwargs.get('content_type'), self.compress_skip_types):
+            compression = self.compress
+
+        document = writer.add(self._iter_content(content), sha256=self.deduplicate, compression=compression,
+                              filename=filename, **kwargs)
+        if self.deduplicate:
+            digests.setdefault(document['sha256'], document['_id'])
+        return document['_id']
+
+    def _flush_bulk(self, writer, oids, start, digests, references):
+        """
+            Insert pending files, oids from start on are replaced by files referenced instead of conflicting
+            ones (None if the conflicting file was deleted meanwhile), references are added.
+        :return: list of filenames of files which couldn't be written
+        """
+        replaced = {}
+        failed = []
+        for document in writer.flush():
+            # the same content stored before or concurrently, it's referenced instead
+            oid = self._reference_existing(document['sha256'], document['refcount'])
+            if oid is None:
+                failed.append(document['filename'])
+            replaced[document['_id']] = oid
+
+        if replaced:
+            for index in range(start, len(oids)):
+                oids[index] = replaced.get(oids[index], oids[index])
+            for digest, oid in list(digests.items()):
+                if oid in replaced:
+                    digests[digest] = replaced[oid]
+
+        # files referenced more than once are incremented once per count (see _delete_batch)
+        for count in set(references.values()):
+            self.primary_files_collection.update_many(
+                {'_id': {'$in': [oid for oid in references if references[oid] == count]}},
+                {'$inc': {'refcount': count}}
+            )
+        references.clear()
+        return failed
+
+    def get_derivative(self, oid, name, spec):
+        """
+            Get derivative of the image (ex. thumbnail), generated and stored in GridFS on first request.
+        :param oid: ObjectID in string of the source image
+        :param name: String, name of the derivative
+        :param spec: dict, see django_mongo_storage.utils.derivatives.render_derivative
+        :return: ObjectID in string of the derivative
+        """
+        derivatives = self.generate_derivatives([oid], name, spec)
+        if str(oid) not in derivatives:
+            raise NoFile("no file in gridfs collection {} with _id {}".format(self.collection, oid))
+        return derivatives[str(oid)]
+
+    def generate_derivatives(self, oids, name, spec):
+        """
+            Get derivatives of many images, existing ones are looked up with one query,
+            missing ones are generated in parallel in thread pool.
+        :param oids: iterable of ObjectIDs in string of the source images
+        :return: dict {source oid: derivative oid}, missing source files and not readable images are not included
+        """
+        oids = set(str(oid) for oid in oids if oid)
+        derivatives = self._find_derivatives(oids, name)
+
+        futures = {oid: self._submit_derivative(oid, name, spec) for oid in oids if oid not in derivatives}
+        for oid, future in futures.items():
+            try:
+                derivatives[oid] = future.result()
+            except NoFile:
+                pass
+            except RENDER_ERRORS as e:
+                logger.error("Can't generate derivative {} of mongo file {}: {}".format(name, oid, e))
+        return derivatives
+
+    def _find_derivatives(self, oids, name):
+        derivatives = {}
+        missing = []
+        for oid in oids:
+            derivative_oid = self._derivative_cache.get('{}:{}'.format(oid, name))
+            if derivative_oid is None:
+                missing.append(ObjectId(oid))
+            else:
+                derivatives[oid] = derivative_oid
+
+        collections = [self.files_collection]
+        if self._reads_secondaries:
+            # generated by another process, not replicated to secondaries yet
+            collections.append(self.primary_files_collection)
+        for collection in collections:
+            if not missing:
+                break
+            query = {'source_id': {'$in': missing}, 'derivative': name}
+            for document in collection.find(query, {'source_id': 1}):
+                oid = str(document['source_id'])
+                derivatives[oid] = str(document['_id'])
+                self._derivative_cache.set('{}:{}'.format(oid, name), derivatives[oid])
+            missing = [oid for oid in missing if str(oid) not in derivatives]
+        return derivatives
+
+    def _reset_derivative_futures(self):
+        self._derivative_pid = os.getpid()
+        self._derivative_futures = {}
+        self._derivative_lock = threading.RLock()
+
+    def _submit_derivative(self, oid, name, spec):
+        # futures of the parent process are never done after fork, the lock could be held by its thread
+        if self._derivative_pid != os.getpid():
+            self._reset_derivative_futures()
+        key = '{}:{}'.format(oid, name)
+        with self._derivative_lock:
+            future = self._derivative_futures.get(key)
+            if future is None:
+                future = get_derivative_executor().submit(self._generate_derivative, oid, name, spec)
+                self._derivative_futures[key] = future
+                future.add_done_callback(lambda _: self._derivative_futures.pop(key, None))
+        return future
+
+    def _generate_derivative(self, oid, name, spec):
+        source = self.get_file(oid)
         try:
-            grid_in = self.fs.new_file(filename=filename, **kwargs)
-            for chunk in content.chunks():
-                grid_in.write(chunk)
-            return str(grid_in._id)
-        except Exception as e:
-            logger.exception("Can't write mongo file using storage")
+            filename = source.filename
+            data, content_type, width, height = render_derivative(source, spec)
         finally:
-            if grid_in:
-                grid_in.close()
+            source.close()
+
+        self._ensure_indexes()
+        # derivatives are not deduplicated, file document is linked to its source
+        writer = GridFSBatchWriter(self.primary_db, self.collection, chunk_size=self.chunk_size,
+                                   batch_size=self.write_batch_size, inline_threshold=self.inline_threshold,
+                                   filename=derivative_filename(filename, name, content_type),
+                                   content_type=content_type, width=width, height=height,
+                                   source_id=ObjectId(oid), derivative=name)
+        try:
+            writer.write(data)
+            derivative_oid = writer.close()
+        except DuplicateKeyError:
+            # generated concurrently by another process
+            writer.abort()
+            document = self.primary_files_collection.find_one({'source_id': ObjectId(oid), 'derivative': name})
+            if document is None:
+                raise
+            derivative_oid = document['_id']
+
+        self._mark_written(derivative_oid)
+        self._derivative_cache.set('{}:{}'.format(oid, name), str(derivative_oid))
+        return str(derivative_oid)
 
     def size(self, oid):
-        return self.fs.get(ObjectId(oid)).length
+        document = self._get_existing_metadata(oid)
+        return document.get('uncompressedLength', document['length'])
 
     def get_file_name(self, oid):
-        return self.fs.get(ObjectId(oid)).filename
+        return self._get_existing_metadata(oid)['filename']
 
     def listdir(self, path=None):
         """
@@ -149,7 +845,7 @@ class MongoStorage(Storage):
         return self.fs.list()
 
     def created_time(self, oid):
-        return self.fs.get(ObjectId(oid)).upload_date
+        return self._get_existing_metadata(oid)['uploadDate']
 
     def url(self, oid, app_label=None, model_name=None, pk=None):
         """
@@ -0,0 +1,173 @@
+import datetime
+
+from bson import ObjectId, Binary
+from bson.errors import InvalidId
+
+from django.conf import settings
+
+from django_mongo_storage.utils.writer import GridFSBatchWriter
+
+
+class UploadError(Exception):
+    pass
+
+
+class UploadNotFound(UploadError):
+    pass
+
+
+class UploadOffsetMismatch(UploadError):
+    """
+    Data was sent for other offset than the offset of the upload (ex. client resumed from wrong position).
+    """
+    def __init__(self, offset):
+        super(UploadOffsetMismatch, self).__init__('Upload offset is {}'.format(offset))
+        self.offset = offset
+
+
+class ResumableUploads(object):
+    """
+    Uploads of files in many requests (resumable after connection drop), for MongoStorage.
+    Received data is written directly as GridFS chunks of the pending file, state of the upload
+    (offset, number of chunks, bytes not filling the whole chunk yet) is kept in <collection>.uploads.
+    Unfinished uploads expire after settings.STORAGE_UPLOAD_EXPIRE seconds (default 24 hours),
+    their chunks are removed by mongo_storage_gc command.
+    Files are stored without compression and deduplication.
+    Use case:
+        uploads = storage.uploads
+        upload_id = uploads.create('video.mp4', length=2 * 1024 ** 3, content_type='video/mp4')
+        offset = uploads.append(upload_id, 0, data)
+        ...
+        oid = uploads.finish(upload_id)
+    """
+    def __init__(self, storage):
+        self.storage = storage
+        self.expire = getattr(settings, 'STORAGE_UPLOAD_EXPIRE', 24 * 3600)
+        self._indexes_ensured = False
+
+    @property
+    def collection(self):
+        return self.storage.primary_db['{}.uploads'.format(self.storage.collection)]
+
+    def _ensure_indexes(self):
+        if not self._indexes_ensured:
+            self.collection.create_index('created', expireAfterSeconds=self.expire)
+            self._indexes_ensured = True
+
+    def _get_upload_id(self, upload_id):
+        try:
+            return ObjectId(upload_id)
+        except (InvalidId, TypeError):
+            raise UploadNotFound(upload_id)
+
+    def create(self, filename, length, content_type=None, **metadata):
+        """
+            Start upload of the file.
+        :param filename: String
+        :param length: size of the file in bytes
+        :param metadata: stored in the upload document (ex. user uploading the file)
+        :return: id of the upload in string, the same as ObjectID of the file when it is finished
+        """
+        self.storage._ensure_indexes()
+        self._ensure_indexes()
+        document = dict(
+            metadata,
+            _id=ObjectId(),
+            filename=filename,
+            contentType=content_type,
+            length=length,
+            offset=0,
+            n=0,
+            tail=Binary(b''),
+            chunkSize=self.storage.chunk_size,
+            created=datetime.datetime.now(datetime.timezone.utc),
+        )
+        self.collection.insert_one(document)
+        return str(document['_id'])
+
+    def get(self, upload_id):
+        """
+        :return: upload document or None if there is no such upload (finished, expired)
+        """
+        return self.collection.find_one({'_id': self._get_upload_id(upload_id)})
+
+    def _get_existing(self, upload_id):
+        document = self.get(upload_id)
+        if document is None:
+            raise UploadNotFound(upload_id)
+        return document
+
+    def _resume_writer(self, document, **kwargs):
+        return GridFSBatchWriter.resume(self.storage.primary_db, self.storage.collection, document['_id'],
+                                        chunks_written=document['n'], length=document['offset'],
+                                        buffer=document['tail'], chunk_size=document['chunkSize'],
+                                        batch_size=self.storage.write_batch_size, **kwargs)
+
+    def append(self, upload_id, offset, data):
+        """
+            Write data at given offset of the upload, complete chunks are inserted to GridFS at once.
+        :return: new offset
+        :raise UploadOffsetMismatch: if offset isn't the offset of the upload
+        """
+        document = self._get_existing(upload_id)
+        if offset != document['offset']:
+            raise UploadOffsetMismatch(document['offset'])
+        if offset + len(data) > document['length']:
+            raise UploadError('Upload exceeds length of the file ({} bytes)'.format(document['length']))
+
+        # chunks of append interrupted before its offset was saved
+        chunks = self.storage.primary_db['{}.chunks'.format(self.storage.collection)]
+        chunks.delete_many({'files_id': document['_id'], 'n': {'$gte': document['n']}})
+
+        writer = self._resume_writer(document)
+        writer.write(data)
+        writer.flush()
+
+        result = self.collection.update_one(
+            {'_id': document['_id'], 'offset': offset},
+            {'$set': {'offset': writer.length, 'n': writer.chunks_written, 'tail': Binary(writer.buffer)}}
+        )
+        if not result.matched_count:
+            # concurrent append to the same upload
+            raise UploadOffsetMismatch(self._get_existing(upload_id)['offset'])
+        return writer.length
+
+    def finish(self, upload_id):
+        """
+            Write the file document of complete upload, the file is visible in GridFS from now on.
+        :return: ObjectID in string of the file
+        """
+        document = self.get(upload_id)
+        oid = self._get_upload_id(upload_id)
+        # finished by interrupted call, upload document wasn't removed
+        if self.storage.primary_files_collection.find_one({'_id': oid}, {'_id': 1}):
+            self.collection.delete_one({'_id': oid})
+            return str(oid)
+        if document is None:
+            raise UploadNotFound(upload_id)
+        if document['offset'] != document['length']:
+            raise UploadError('Upload is incomplete, {} of {} bytes received'.format(
+                document['offset'], document['length']))
+
+        chunks = self.storage.primary_db['{}.chunks'.format(self.storage.collection)]
+        # chunks of append interrupted before its offset was saved
+        chunks.delete_many({'files_id': oid, 'n': {'$gte': document['n']}})
+        stored = chunks.count_documents({'files_id': oid})
+        if stored != document['n']:
+            raise UploadError('Upload is corrupted, {} of {} chunks stored'.format(stored, document['n']))
+
+        kwargs = {'content_type': document['contentType']} if document.get('contentType') else {}
+        writer = self._resume_writer(document, filename=document['filename'], **kwargs)
+        oid = writer.close()
+        self.collection.delete_one({'_id': oid})
+        self.storage._mark_written(oid)
+        return str(oid)
+
+    def abort(self, upload_id):
+        """
+            Remove the upload and its chunks.
+        """
+        oid = self._get_upload_id(upload_id)
+        # chunks of finished upload belong to the file
+        if self.collection.delete_one({'_id': oid}).deleted_count:
+            self.storage.primary_db['{}.chunks'.format(self.storage.collection)].delete_many({'files_id': oid})
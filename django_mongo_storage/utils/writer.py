@@ -0,0 +1,317 @@
+import datetime
+import hashlib
+
+from bson import ObjectId, Binary
+from pymongo.errors import BulkWriteError
+
+from django_mongo_storage.utils.compression import get_compressor
+from django_mongo_storage.utils.executor import get_executor
+
+
+DEFAULT_CHUNK_SIZE = 255 * 1024
+
+DUPLICATE_KEY_ERROR = 11000
+
+
+class GridFSBatchWriter(object):
+    """
+    Writes file to GridFS inserting many chunks with one insert_many (instead of one insert per chunk).
+    File document (fs.files) is inserted on close(), so file is not visible until it's complete.
+    Use case:
+        writer = GridFSBatchWriter(db, 'fs', filename='test.txt', content_type='text/plain')
+        try:
+            for data in content.chunks():
+                writer.write(data)
+        except Exception:
+            writer.abort()
+            raise
+        oid = writer.close()
+
+    :param chunk_size: size of GridFS chunk in bytes
+    :param batch_size: number of chunks inserted in one round trip
+    :param overlap: if True batch is inserted in background thread while next one is being read
+        (at most one batch in flight, so at most 2 * batch_size chunks are kept in memory)
+    :param sha256: if True sha256 digest of content is stored in fs.files document (used for deduplication)
+    :param compression: codec ('gzip' or 'zstd') to compress content with, stored as compression field
+        with length of original content in uncompressedLength (length, md5 and chunks refer to stored bytes)
+    :param md5: if False md5 of content is not stored (ex. file written by many writers, see resume())
+    :param inline_threshold: stored content of at most that many bytes (and less than chunk_size) is embedded
+        in fs.files document (data field, inline: True) instead of chunks, so it's read with one query
+    :param kwargs: attributes of the file, stored in fs.files document (content_type is stored as contentType)
+    """
+    def __init__(self, db, collection, chunk_size=DEFAULT_CHUNK_SIZE, batch_size=16, overlap=False, sha256=False,
+                 compression=None, md5=True, inline_threshold=0, **kwargs):
+        self.files = db['{}.files'.format(collection)]
+        self.chunks = db['{}.chunks'.format(collection)]
+        self.chunk_size = chunk_size
+        self.batch_size = max(batch_size, 1)
+        self.overlap = overlap
+        self.inline_threshold = inline_threshold
+
+        if 'content_type' in kwargs:
+            kwargs['contentType'] = kwargs.pop('content_type')
+        self._id = kwargs.pop('_id', None) or ObjectId()
+        self.kwargs = kwargs
+
+        self.compression = compression
+        self._compressor = get_compressor(compression) if compression else None
+
+        self.length = 0
+        self.uncompressed_length = 0
+        self._md5 = hashlib.md5() if md5 else None
+        self._sha256 = hashlib.sha256() if sha256 else None
+        self._buffer = bytearray()
+        self._batch = []
+        self._n = 0
+        self._future = None
+        self._closed = False
+
+    def write(self, data):
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        # digest of original content, so the same content is deduplicated regardless of compression
+        if self._sha256 is not None:
+            self._sha256.update(data)
+        self.uncompressed_length += len(data)
+        if self._compressor is not None:
+            data = self._compressor.compress(data)
+        self._write_stored(data)
+
+    @classmethod
+    def resume(cls, db, collection, _id, chunks_written, length, buffer=b'', **kwargs):
+        """
+            Continue writing the file written partially by another writer (ex. resumable upload),
+            without md5, compression and sha256.
+        :param chunks_written: number of chunks already inserted
+        :param length: number of bytes written so far (inserted chunks and buffer)
+        :param buffer: bytes written, but not inserted as chunk yet (see flush())
+        """
+        writer = cls(db, collection, _id=_id, md5=False, **kwargs)
+        writer._n = chunks_written
+        writer.length = writer.uncompressed_length = length
+        writer._buffer = bytearray(buffer)
+        return writer
+
+    @property
+    def chunks_written(self):
+        return self._n
+
+    @property
+    def buffer(self):
+        return bytes(self._buffer)
+
+    def flush(self):
+        """
+            Insert complete chunks written so far, the rest of content stays in buffer.
+        """
+        self._flush()
+        self._wait()
+
+    def _write_stored(self, data):
+        if self._md5 is not None:
+            self._md5.update(data)
+        self.length += len(data)
+        self._buffer.extend(data)
+
+        while len(self._buffer) >= self.chunk_size:
+            self._add_chunk(bytes(self._buffer[:self.chunk_size]))
+            del self._buffer[:self.chunk_size]
+
+    def _add_chunk(self, data):
+        self._batch.append({'files_id': self._id, 'n': self._n, 'data': Binary(data)})
+        self._n += 1
+        if len(self._batch) >= self.batch_size:
+            self._flush()
+
+    def _flush(self):
+        batch, self._batch = self._batch, []
+        if not batch:
+            return
+        # wait for previous batch, so errors are raised and memory stays bounded
+        self._wait()
+        if self.overlap:
+            self._future = get_executor().submit(self.chunks.insert_many, batch)
+        else:
+            self.chunks.insert_many(batch)
+
+    def _wait(self):
+        if self._future is not None:
+            future, self._future = self._future, None
+            future.result()
+
+    @property
+    def sha256(self):
+        return self._sha256.hexdigest() if self._sha256 is not None else None
+
+    def close(self):
+        """
+            Write remaining chunks and file document.
+        :return: ObjectID of the file
+        """
+        if self._closed:
+            return self._id
+
+        document = self._finish()
+        self._flush()
+        self._wait()
+        self.files.insert_one(document)
+        self._closed = True
+        return self._id
+
+    def detach(self):
+        """
+            Complete the file without inserting the last batch of chunks and file document,
+            they are inserted by the caller together with other files (see GridFSBulkWriter).
+        :return: tuple (list of chunk documents, file document)
+        """
+        document = self._finish()
+        self._wait()
+        batch, self._batch = self._batch, []
+        self._closed = True
+        return batch, document
+
+    # write the rest of content, returns file document
+    def _finish(self):
+        if self._compressor is not None:
+            self._write_stored(self._compressor.flush())
+            self._compressor = None
+
+        inline = None
+        if self.inline_threshold and self._n == 0 and len(self._buffer) <= self.inline_threshold:
+            # whole content is in the buffer, no chunks
+            inline, self._buffer = bytes(self._buffer), bytearray()
+        elif self._buffer:
+            self._add_chunk(bytes(self._buffer))
+            self._buffer = bytearray()
+
+        document = {
+            '_id': self._id,
+            'length': self.length,
+            'chunkSize': self.chunk_size,
+            'uploadDate': datetime.datetime.now(datetime.timezone.utc),
+        }
+        if self._md5 is not None:
+            document['md5'] = self._md5.hexdigest()
+        if self._sha256 is not None:
+            document['sha256'] = self._sha256.hexdigest()
+        if self.compression:
+            document.update(compression=self.compression, uncompressedLength=self.uncompressed_length)
+        if inline is not None:
+            document.update(inline=True, data=Binary(inline))
+        document.update(self.kwargs)
+        return document
+
+    def abort(self):
+        """
+            Remove chunks written so far.
+        """
+        try:
+            self._wait()
+        except Exception:
+            pass
+        self._batch = []
+        self.chunks.delete_many({'files_id': self._id})
+        self._closed = True
+
+
+class GridFSBulkWriter(object):
+    """
+    Writes many files to GridFS sharing batches between them: chunks of consecutive files are inserted
+    with one insert_many per batch_size * chunk_size bytes, file documents with one insert_many on flush(),
+    so thousands of small files take a few round trips. Files are not visible until flush().
+    Use case:
+        writer = GridFSBulkWriter(db, 'fs')
+        try:
+            for name, content in files:
+                oid = writer.add(content.chunks(), filename=name)['_id']
+            conflicts = writer.flush()
+        except Exception:
+            writer.abort()
+            raise
+
+    :param kwargs: passed to GridFSBatchWriter of every file (ex. overlap)
+    """
+    def __init__(self, db, collection, chunk_size=DEFAULT_CHUNK_SIZE, batch_size=16, **kwargs):
+        self.db = db
+        self.collection = collection
+        self.files = db['{}.files'.format(collection)]
+        self.chunks = db['{}.chunks'.format(collection)]
+        self.chunk_size = chunk_size
+        self.batch_size = max(batch_size, 1)
+        self.kwargs = kwargs
+
+        self.length = 0
+        self.uncompressed_length = 0
+        # file documents not inserted yet by ObjectID
+        self.pending = {}
+        self._batch = []
+        self._batch_bytes = 0
+
+    def add(self, chunks, **kwargs):
+        """
+            Write content of the file, chunks of large files are inserted while they are written.
+        :param chunks: iterable of bytes
+        :param kwargs: see GridFSBatchWriter
+        :return: file document (inserted on flush(), can be updated until then)
+        """
+        writer = GridFSBatchWriter(self.db, self.collection, chunk_size=self.chunk_size,
+                                   batch_size=self.batch_size, **dict(self.kwargs, **kwargs))
+        try:
+            for data in chunks:
+                writer.write(data)
+            batch, document = writer.detach()
+        except Exception:
+            writer.abort()
+            raise
+
+        self.pending[document['_id']] = document
+        self.length += writer.length
+        self.uncompressed_length += writer.uncompressed_length
+        for chunk in batch:
+            self._batch.append(chunk)
+            self._batch_bytes += len(chunk['data'])
+            if self._batch_bytes >= self.chunk_size * self.batch_size:
+                self._flush_chunks()
+        return document
+
+    def _flush_chunks(self):
+        batch, self._batch, self._batch_bytes = self._batch, [], 0
+        if batch:
+            self.chunks.insert_many(batch)
+
+    def flush(self):
+        """
+            Insert remaining chunks and documents of files written so far.
+        :return: list of file documents not inserted because of duplicate key (ex. sha256 of deduplicated
+            file stored concurrently), their chunks are removed
+        :raise BulkWriteError: on other errors, documents inserted by the call are removed then and all
+            documents are left pending, so abort() removes all the files of the batch
+        """
+        self._flush_chunks()
+        documents, self.pending = list(self.pending.values()), {}
+        if not documents:
+            return []
+        try:
+            self.files.insert_many(documents, ordered=False)
+        except BulkWriteError as e:
+            errors = e.details.get('writeErrors', [])
+            conflicts = [documents[error['index']] for error in errors]
+            if any(error.get('code') != DUPLICATE_KEY_ERROR for error in errors):
+                # other documents were inserted (unordered insert)
+                failed = set(document['_id'] for document in conflicts)
+                self.files.delete_many({'_id': {'$in': [document['_id'] for document in documents
+                                                        if document['_id'] not in failed]}})
+                self.pending = {document['_id']: document for document in documents}
+                raise
+            self.chunks.delete_many({'files_id': {'$in': [document['_id'] for document in conflicts]}})
+            return conflicts
+        return []
+
+    def abort(self):
+        """
+            Remove chunks of files not inserted yet.
+        """
+        self._batch, self._batch_bytes = [], 0
+        if self.pending:
+            self.chunks.delete_many({'files_id': {'$in': list(self.pending)}})
+        self.pending = {}
@@ -1,49 +1,412 @@
+import base64
+import os
+import uuid
+
+from urllib.parse import urljoin
+
+from asgiref.sync import sync_to_async
+
+from gridfs import NoFile
+
 from django.contrib.auth.decorators import login_required
-from django.db.models.loading import get_model
-from django.http import FileResponse, HttpResponse, Http404
+from django.contrib.auth.views import redirect_to_login
+from django.core.exceptions import PermissionDenied
+from django.http import FileResponse, HttpResponse, HttpResponseNotAllowed, Http404, StreamingHttpResponse
 from django.shortcuts import get_object_or_404
-from django_mongo_storage.utils.storage import MongoStorage
-
-
-# get a file from GridFS (MongoDB) for specified model instance
-def _get_mongo_file(app_label, model_name, pk, file_oid):
-    Model = get_model(app_label, model_name)
-    model = get_object_or_404(Model, pk=pk)
-
-    for field in model._meta.get_fields():
-        from gridfs import NoFile
-        from django.db.models import FileField
-        if isinstance(field, FileField):
-            if isinstance(field.storage, MongoStorage):
-                try:
-                    file = field.storage.get_file(file_oid)
-                    return file
-                except NoFile:
-                    # no need to do anything, try other fields
-                    pass
-    return None
+from django.urls import reverse
+from django.utils.http import http_date
+from django_mongo_storage.registry import registry
+from django_mongo_storage.utils.compression import accepts_encoding
+from django_mongo_storage.utils.uploads import UploadError, UploadNotFound, UploadOffsetMismatch
+from django_mongo_storage.utils.http import (parse_range_header, iter_range, file_etag, file_last_modified,
+                                             document_etag, document_last_modified, is_not_modified,
+                                             if_range_matches)
+
+# requests answered with a part of the file or without content, they don't fill local disk cache
+PARTIAL_REQUEST_HEADERS = ('HTTP_RANGE', 'HTTP_IF_NONE_MATCH', 'HTTP_IF_MODIFIED_SINCE')
+
+
+# get mongo field of specified model instance storing the file (one query, columns of mongo fields only)
+def _get_mongo_field(app_label, model_name, pk, file_oid):
+    field = registry.get_field(app_label, model_name, pk, file_oid)
+    if field is None:
+        raise Http404('File not found')
+    return field
+
+
+# get derivative of image (generated on first request), returns (storage, derivative oid)
+def _get_derivative(app_label, model_name, pk, file_oid, name):
+    field = _get_mongo_field(app_label, model_name, pk, file_oid)
+    spec = getattr(field, 'derivatives', {}).get(name)
+    if spec is None:
+        return None, None
+    try:
+        return field.storage, field.storage.get_derivative(file_oid, name, spec)
+    except NoFile:
+        return None, None
+
+
+def _multipart_ranges(mongo_file, ranges, content_type, boundary):
+    length = mongo_file.length
+    for start, end in ranges:
+        yield '--{}\r\nContent-Type: {}\r\nContent-Range: bytes {}-{}/{}\r\n\r\n'.format(
+            boundary, content_type, start, end, length
+        ).encode('ascii')
+        for data in iter_range(mongo_file, start, end):
+            yield data
+        yield b'\r\n'
+    yield '--{}--\r\n'.format(boundary).encode('ascii')
+
+
+async def _amultipart_ranges(async_storage, mongo_file, ranges, content_type, boundary):
+    length = mongo_file.length
+    for start, end in ranges:
+        yield '--{}\r\nContent-Type: {}\r\nContent-Range: bytes {}-{}/{}\r\n\r\n'.format(
+            boundary, content_type, start, end, length
+        ).encode('ascii')
+        async for data in async_storage.iter_chunks(mongo_file._id, start, end, decompress=False):
+            yield data
+        yield b'\r\n'
+    yield '--{}--\r\n'.format(boundary).encode('ascii')
+
+
+# answer byte range request (206 Partial Content), seeking inside GridOut
+# so only chunks covering requested ranges are fetched from mongo
+def _range_response(request, mongo_file, content_type, etag, last_modified, async_storage=None):
+    if not if_range_matches(request, etag, last_modified):
+        return None
+    ranges = parse_range_header(request.META.get('HTTP_RANGE'), mongo_file.length)
+    if ranges is None:
+        return None
+
+    if not ranges:
+        response = HttpResponse(status=416)
+        response['Content-Range'] = 'bytes */{}'.format(mongo_file.length)
+        return response
+
+    content_type = content_type or 'application/octet-stream'
+
+    if len(ranges) == 1:
+        start, end = ranges[0]
+        if async_storage:
+            content = async_storage.iter_chunks(mongo_file._id, start, end, decompress=False)
+        else:
+            content = iter_range(mongo_file, start, end)
+        response = StreamingHttpResponse(content, status=206, content_type=content_type)
+        response['Content-Range'] = 'bytes {}-{}/{}'.format(start, end, mongo_file.length)
+        response['Content-Length'] = end - start + 1
+    else:
+        boundary = uuid.uuid4().hex
+        if async_storage:
+            content = _amultipart_ranges(async_storage, mongo_file, ranges, content_type, boundary)
+        else:
+            content = _multipart_ranges(mongo_file, ranges, content_type, boundary)
+        response = StreamingHttpResponse(content, status=206,
+                                         content_type='multipart/byteranges; boundary=' + boundary)
+    return response
+
+
+def _set_cache_headers(response, storage, etag, last_modified, compression=None):
+    response['ETag'] = etag
+    if compression:
+        # compressed files are sent encoded or decoded depending on Accept-Encoding
+        response['Vary'] = 'Accept-Encoding'
+    if last_modified is not None:
+        response['Last-Modified'] = http_date(last_modified)
+    if storage.cache_control:
+        response['Cache-Control'] = storage.cache_control
+
+
+# text and images are displayed in the browser, everything else is downloaded
+def _is_displayable(content_type):
+    return bool(content_type) and ('text' in content_type or 'image' in content_type)
 
 
 @login_required
 def view_file(request, app_label, model_name, pk, file_oid):
 
     # if user has proper perms then he can get a desired file
-    mongo_file = _get_mongo_file(app_label, model_name, pk, file_oid)
-    if not mongo_file:
+    derivative = request.GET.get('derivative')
+    if derivative:
+        storage, file_oid = _get_derivative(app_label, model_name, pk, file_oid, derivative)
+    else:
+        storage = _get_mongo_field(app_label, model_name, pk, file_oid).storage
+    document = storage.get_metadata(file_oid) if storage else None
+    if document is None:
         raise Http404('File not found')
+
+    # validators come from (cached) metadata, the file isn't opened for 304
+    compression = document.get('compression')
+    encoding = _get_encoding(request, compression)
+    etag = document_etag(document, encoding)
+    last_modified = document_last_modified(document)
+    if is_not_modified(request, etag, last_modified):
+        return _not_modified_response(storage, etag, last_modified, compression)
+
+    cache = not any(request.META.get(header) for header in PARTIAL_REQUEST_HEADERS)
+    try:
+        mongo_file = storage.get_file(file_oid, cache=cache)
+    except NoFile:
+        raise Http404('File not found')
+    return _file_response(request, storage, mongo_file)
+
+
+def _not_modified_response(storage, etag, last_modified, compression=None):
+    response = HttpResponse(status=304)
+    _set_cache_headers(response, storage, etag, last_modified, compression)
+    return response
+
+
+# response of view_file with content of the file (or 304, 206, 416)
+def _file_response(request, storage, mongo_file):
     filename = mongo_file.filename
     content_type = mongo_file.content_type
 
-    if content_type:
-        if 'text' in content_type or 'image' in content_type:
-            return HttpResponse(mongo_file.read(), content_type=content_type)
-        else:
+    # compressed file is sent as stored if client accepts its encoding
+    compression = getattr(mongo_file, 'compression', None)
+    encoding = _get_encoding(request, compression)
+    if encoding:
+        mongo_file = mongo_file.raw
+
+    # validators come from fs.files document only, chunks are not touched for 304
+    etag = file_etag(mongo_file, encoding)
+    last_modified = file_last_modified(mongo_file)
+    if is_not_modified(request, etag, last_modified):
+        return _not_modified_response(storage, etag, last_modified, compression)
+
+    response = None
+    # decompressed content can't be served from the file on disk
+    if not compression or encoding:
+        response = _offload_response(request, storage, mongo_file, content_type, encoding)
+    if response is None:
+        response = _range_response(request, mongo_file, content_type, etag, last_modified)
+    if response is None:
+        if _is_displayable(content_type):
+            response = HttpResponse(mongo_file.read(), content_type=content_type)
+        elif content_type:
             response = FileResponse(mongo_file, content_type=content_type)
-            response['Content-Disposition'] = 'attachment; filename=' + filename
-            return response
+        else:
+            response = FileResponse(mongo_file)
+
+    return _finish_response(response, storage, filename, content_type, etag, last_modified, compression, encoding)
+
+
+# send file from local disk cache without pushing its content through python
+def _offload_response(request, storage, mongo_file, content_type, encoding=None):
+    path = getattr(mongo_file, 'path', None)
+    if not path or not storage.serve_mode or storage.serve_mode == 'python':
+        return None
+    # web servers don't keep Content-Encoding of the response sending the file (ex. nginx internal redirect),
+    # encoded content is sent by sendfile only
+    if encoding and storage.serve_mode != 'sendfile':
+        return None
+
+    if storage.serve_mode == 'sendfile':
+        # ranges are sent by python, whole file with wsgi.file_wrapper (sendfile)
+        if request.META.get('HTTP_RANGE'):
+            return None
+        try:
+            file = open(path, 'rb')
+        except FileNotFoundError:
+            # evicted from the cache in the meantime, content is read from the opened (memory-mapped) file
+            return None
+        response = FileResponse(file, content_type=content_type or 'application/octet-stream')
     else:
-        response = FileResponse(mongo_file)
+        # web server sends the file (and handles ranges)
+        response = HttpResponse(content_type=content_type or 'application/octet-stream')
+        if storage.serve_mode == 'x-accel-redirect':
+            relative_path = os.path.relpath(path, storage.local_cache_dir).replace(os.sep, '/')
+            response['X-Accel-Redirect'] = urljoin(storage.serve_prefix, relative_path)
+        else:
+            response['X-Sendfile'] = path
+
+    mongo_file.close()
+    return response
+
+
+def _get_encoding(request, compression):
+    if compression and accepts_encoding(request, compression):
+        return compression
+    return None
+
+
+def _finish_response(response, storage, filename, content_type, etag, last_modified,
+                     compression=None, encoding=None):
+    if not _is_displayable(content_type) and response.status_code != 416:
         response['Content-Disposition'] = 'attachment; filename=' + filename
-        return response
+    if encoding:
+        response['Content-Encoding'] = encoding
+    response['Accept-Ranges'] = 'bytes'
+    _set_cache_headers(response, storage, etag, last_modified, compression)
+    return response
+
+
+async def async_view_file(request, app_label, model_name, pk, file_oid):
+    """
+        Asyncio version of view_file (for ASGI), file content is streamed from GridFS
+        through async iterator, without occupying a thread for the whole transfer.
+    """
+    if not await sync_to_async(lambda: request.user.is_authenticated)():
+        return redirect_to_login(request.get_full_path())
+
+    # if user has proper perms then he can get a desired file
+    derivative = request.GET.get('derivative')
+    if derivative:
+        storage, file_oid = await sync_to_async(_get_derivative)(app_label, model_name, pk, file_oid, derivative)
+        if storage is None:
+            raise Http404('File not found')
+    else:
+        storage = (await sync_to_async(_get_mongo_field)(app_label, model_name, pk, file_oid)).storage
+    async_storage = storage.async_storage
+    try:
+        mongo_file = await async_storage.open(file_oid)
+    except NoFile:
+        raise Http404('File not found')
+
+    filename = mongo_file.filename
+    content_type = mongo_file.content_type
+
+    compression = getattr(mongo_file, 'compression', None)
+    encoding = _get_encoding(request, compression)
+
+    etag = file_etag(mongo_file, encoding)
+    last_modified = file_last_modified(mongo_file)
+    if is_not_modified(request, etag, last_modified):
+        return _not_modified_response(storage, etag, last_modified, compression)
+
+    response = None
+    # ranges of compressed content can be sent only as stored (encoded)
+    if not compression or encoding:
+        response = _range_response(request, mongo_file, content_type, etag, last_modified,
+                                   async_storage=async_storage)
+    if response is None:
+        response = StreamingHttpResponse(async_storage.iter_chunks(file_oid, decompress=not encoding),
+                                         content_type=content_type or 'application/octet-stream')
+        if compression and not encoding:
+            response['Content-Length'] = mongo_file.uncompressedLength
+        else:
+            response['Content-Length'] = mongo_file.length
+
+    return _finish_response(response, storage, filename, content_type, etag, last_modified, compression, encoding)
+
+
+TUS_VERSION = '1.0.0'
+
+
+def _tus_response(status, **headers):
+    response = HttpResponse(status=status)
+    response['Tus-Resumable'] = TUS_VERSION
+    # state of upload must not be cached
+    response['Cache-Control'] = 'no-store'
+    for name, value in headers.items():
+        response[name.replace('_', '-')] = value
+    return response
+
+
+# parse Upload-Metadata header: comma separated "key base64(value)" pairs
+def _parse_upload_metadata(header):
+    metadata = {}
+    for pair in header.split(','):
+        key, _, value = pair.strip().partition(' ')
+        if key:
+            try:
+                metadata[key] = base64.b64decode(value).decode('utf-8')
+            except (ValueError, UnicodeDecodeError):
+                pass
+    return metadata
+
+
+def _get_header_int(request, header):
+    try:
+        value = int(request.META[header])
+    except (KeyError, ValueError):
+        return None
+    return value if value >= 0 else None
+
+
+# get model instance and mongo field the file is uploaded to, user has to be able to change the instance
+def _get_upload_target(request, app_label, model_name, pk, field_name):
+    try:
+        model, fields = registry.get_model_fields(app_label, model_name)
+    except LookupError:
+        raise Http404('Model not found')
+    field = next((field for field in fields if field.name == field_name), None)
+    if field is None:
+        raise Http404('Field not found')
+
+    if not request.user.has_perm('{}.change_{}'.format(model._meta.app_label, model._meta.model_name)):
+        raise PermissionDenied
+    instance = get_object_or_404(model._default_manager, pk=pk)
+    return instance, field
+
+
+@login_required
+def create_upload(request, app_label, model_name, pk, field_name):
+    """
+        Start resumable upload of the file (tus protocol, creation extension) to the field of model instance.
+        Headers: Upload-Length (required), Upload-Metadata (filename and filetype).
+        Response: 201 with Location of the upload, data is sent there with PATCH requests.
+    """
+    if request.method != 'POST':
+        return HttpResponseNotAllowed(['POST'])
+    instance, field = _get_upload_target(request, app_label, model_name, pk, field_name)
+
+    length = _get_header_int(request, 'HTTP_UPLOAD_LENGTH')
+    if length is None:
+        return _tus_response(400)
+    metadata = _parse_upload_metadata(request.META.get('HTTP_UPLOAD_METADATA', ''))
+
+    upload_id = field.storage.uploads.create(metadata.get('filename', 'upload'), length,
+                                             content_type=metadata.get('filetype'), user=request.user.pk)
+    location = reverse(upload, kwargs={'app_label': app_label, 'model_name': model_name, 'pk': pk,
+                                       'field_name': field_name, 'upload_id': upload_id})
+    return _tus_response(201, Location=request.build_absolute_uri(location))
+
+
+@login_required
+def upload(request, app_label, model_name, pk, field_name, upload_id):
+    """
+        Resumable upload (tus protocol):
+            HEAD - offset of the upload (Upload-Offset header), to know where to resume from
+            PATCH - append body (Content-Type: application/offset+octet-stream) at Upload-Offset,
+                when the last byte is received the file is set to the field of model instance
+            DELETE - cancel the upload
+    """
+    instance, field = _get_upload_target(request, app_label, model_name, pk, field_name)
+    uploads = field.storage.uploads
+
+    document = uploads.get(upload_id)
+    if document is None or document.get('user') != request.user.pk:
+        raise Http404('Upload not found')
+
+    if request.method == 'HEAD':
+        return _tus_response(200, Upload_Offset=document['offset'], Upload_Length=document['length'])
+
+    if request.method == 'DELETE':
+        uploads.abort(upload_id)
+        return _tus_response(204)
+
+    if request.method != 'PATCH':
+        return HttpResponseNotAllowed(['HEAD', 'PATCH', 'DELETE'])
+
+    if request.content_type != 'application/offset+octet-stream':
+        return _tus_response(415)
+    offset = _get_header_int(request, 'HTTP_UPLOAD_OFFSET')
+    if offset is None:
+        return _tus_response(400)
 
+    # body is streamed to GridFS, data received before connection drop is kept
+    try:
+        block_size = field.storage.chunk_size * field.storage.write_batch_size
+        for data in iter(lambda: request.read(block_size), b''):
+            offset = uploads.append(upload_id, offset, data)
+    except UploadOffsetMismatch as e:
+        return _tus_response(409, Upload_Offset=e.offset)
+    except UploadNotFound:
+        raise Http404('Upload not found')
+    except UploadError:
+        return _tus_response(400)
 
+    if offset == document['length']:
+        getattr(instance, field.name).attach(uploads.finish(upload_id))
+    return _tus_response(204, Upload_Offset=offset)